@@ -1,5 +1,6 @@
 from .optimizer import optimal_switch_time, optimal_switch_time_continuous
-from .two_stage_dfba import two_stage_timecourse, one_stage_timecourse, two_stage_timecourse_continuous
+from .two_stage_dfba import two_stage_timecourse, one_stage_timecourse, two_stage_timecourse_continuous, \
+    one_stage_time_grid, multi_stage_timecourse
 from .fermentation_metrics import *
 import numpy as np
 
@@ -49,7 +50,8 @@ class TwoStageFermentation(object):
         self.data, self.time = two_stage_timecourse(self.initial_concentrations, self.time_end,
                                                     self.optimal_switch_time,
                                                     [self.stage_one_fluxes, self.stage_two_fluxes],
-                                                    num_of_points=self.settings.num_timepoints)
+                                                    num_of_points=self.settings.num_timepoints,
+                                                    settings=self.settings)
         self.time_end = self.time[-1]
         self.batch_productivity = batch_productivity(self.data, self.time, self.settings)
         self.batch_productivity = self.batch_productivity*(self.batch_productivity > 0)
@@ -65,7 +67,8 @@ class TwoStageFermentation(object):
 
 
 class FermentationExtrema(object):
-    def __init__(self, model, max_growth, biomass_rxn, substrate_rxn, target_rxn, settings, extrema_type='ts_best'):
+    def __init__(self, model, max_growth, biomass_rxn, substrate_rxn, target_rxn, settings, extrema_type='ts_best',
+                 initial_guesses=None):
         self.settings = settings
         self.initial_concentrations = [self.settings.initial_biomass, self.settings.initial_substrate,
                                        self.settings.initial_product]
@@ -90,6 +93,7 @@ class FermentationExtrema(object):
         self.objective_value = None
         self.constraint_flag = True
         self.extrema_type = extrema_type
+        self.initial_guesses = initial_guesses
 
         try:
             self.objective = objective_dict[self.settings.objective]
@@ -104,7 +108,7 @@ class FermentationExtrema(object):
                                                     self.max_growth, self.biomass_rxn, self.substrate_rxn,
                                                     self.target_rxn, self.settings, self.objective,
                                                     self.productivity_constraint, self.yield_constraint,
-                                                    self.titer_constraint, self.extrema_type)
+                                                    self.titer_constraint, self.extrema_type, self.initial_guesses)
         if not opt_result.success:
             print(opt_result.message)
             self.constraint_flag = False
@@ -158,8 +162,139 @@ class OneStageFermentation(object):
         self.calculate_fermentation_data()
 
     def calculate_fermentation_data(self):
-        self.time = np.linspace(0, self.time_end, self.settings.num_timepoints)
-        self.data, self.time = one_stage_timecourse(self.initial_concentrations, self.time, self.fluxes)
+        self.time = one_stage_time_grid(self.initial_concentrations, self.fluxes, self.settings)
+        self.data, self.time = one_stage_timecourse(self.initial_concentrations, self.time, self.fluxes, self.settings)
+        self.time_end = self.time[-1]
+        self.batch_productivity = batch_productivity(self.data, self.time, self.settings)
+        self.batch_productivity = self.batch_productivity*(self.batch_productivity > 0)
+        self.batch_yield = batch_yield(self.data, self.time, self.settings)
+        self.batch_yield = self.batch_yield*(self.batch_yield > 0)
+        self.batch_titer = batch_end_titer(self.data, self.time, self.settings)
+        self.batch_titer = self.batch_titer*(self.batch_titer > 0)
+
+        if not((self.batch_productivity >= self.productivity_constraint) and
+               (self.batch_yield >= self.yield_constraint) and
+               (self.batch_titer >= self.titer_constraint)):
+            self.constraint_flag = False
+
+        self.linear_combination = linear_combination(self.data, self.time, self.settings)
+        try:
+            self.objective_value = getattr(self, self.settings.objective)
+        except AttributeError:
+            self.objective_value = getattr(self, 'batch_productivity')
+
+
+class MultiProductOneStageFermentation(object):
+
+    def __init__(self, fluxes, settings):
+        """fluxes is a vector containing flux data for biomass, substrate and products 1 to k respectively.
+           All the products are integrated together and the metrics are reported as arrays with one entry per
+           product."""
+        self.settings = settings
+        self.fluxes = fluxes
+        self.num_products = len(fluxes) - 2
+        self.initial_concentrations = [self.settings.initial_biomass, self.settings.initial_substrate] + \
+                                      [self.settings.initial_product]*self.num_products
+        self.time_end = self.settings.time_end
+        self.data = []
+        self.time = []
+        self.batch_yield = None
+        self.batch_productivity = None
+        self.batch_titer = None
+        self.linear_combination = None
+        self.objective_value = None
+        self.productivity_constraint = settings.productivity_constraint
+        self.yield_constraint = settings.yield_constraint
+        self.titer_constraint = settings.titer_constraint
+        self.constraint_flag = None
+        if self.settings.objective in objective_dict:
+            self.objective = self.settings.objective
+        else:
+            self.objective = 'batch_productivity'
+
+        self.calculate_fermentation_data()
+
+    def calculate_fermentation_data(self):
+        self.time = one_stage_time_grid(self.initial_concentrations, self.fluxes, self.settings)
+        self.data, self.time = one_stage_timecourse(self.initial_concentrations, self.time, self.fluxes, self.settings)
+        self.time_end = self.time[-1]
+        metrics = product_metrics(self.data, self.time, self.settings)
+        self.batch_productivity = metrics['productivity']*(metrics['productivity'] > 0)
+        self.batch_yield = metrics['yield']*(metrics['yield'] > 0)
+        self.batch_titer = metrics['titer']*(metrics['titer'] > 0)
+        self.linear_combination = metrics['linear_combination']
+        self.constraint_flag = ((self.batch_productivity >= self.productivity_constraint) &
+                                (self.batch_yield >= self.yield_constraint) &
+                                (self.batch_titer >= self.titer_constraint))
+        self.objective_value = getattr(self, self.objective)
+
+
+class MultiProductTwoStageFermentation(object):
+
+    def __init__(self, stage_one_fluxes, stage_two_fluxes, settings):
+        """stage_one_fluxes and stage_two_fluxes are vectors containing flux data for biomass, substrate and
+           products 1 to k respectively. The optimal switch time is specific to each product, so a two stage
+           fermentation is optimized for every product and the metrics are reported as arrays with one entry per
+           product."""
+        self.settings = settings
+        self.stage_one_fluxes = stage_one_fluxes
+        self.stage_two_fluxes = stage_two_fluxes
+        self.num_products = len(stage_one_fluxes) - 2
+        self.fermentations = []
+        self.optimal_switch_time = None
+        self.batch_yield = None
+        self.batch_productivity = None
+        self.batch_titer = None
+        self.linear_combination = None
+        self.objective_value = None
+        self.constraint_flag = None
+
+        self.calculate_fermentation_data()
+
+    def calculate_fermentation_data(self):
+        self.fermentations = [TwoStageFermentation(list(self.stage_one_fluxes[:2]) + [self.stage_one_fluxes[2 + i]],
+                                                   list(self.stage_two_fluxes[:2]) + [self.stage_two_fluxes[2 + i]],
+                                                   self.settings)
+                              for i in range(self.num_products)]
+        self.optimal_switch_time = np.array([ferm.optimal_switch_time for ferm in self.fermentations])
+        self.batch_productivity = np.array([ferm.batch_productivity for ferm in self.fermentations])
+        self.batch_yield = np.array([ferm.batch_yield for ferm in self.fermentations])
+        self.batch_titer = np.array([ferm.batch_titer for ferm in self.fermentations])
+        self.linear_combination = np.array([ferm.linear_combination for ferm in self.fermentations])
+        self.objective_value = np.array([ferm.objective_value for ferm in self.fermentations])
+        self.constraint_flag = np.array([ferm.constraint_flag for ferm in self.fermentations])
+
+
+class MultiStageFermentation(object):
+
+    def __init__(self, stage_fluxes, switch_times, settings):
+        """stage_fluxes is a list of flux vectors [biomass, substrate, product] for stages one to n and switch_times
+           is a list of the n - 1 times at which the stages change. The last stage runs until the substrate is
+           depleted."""
+        self.settings = settings
+        self.stage_fluxes = stage_fluxes
+        self.switch_times = switch_times
+        self.num_stages = len(stage_fluxes)
+        self.initial_concentrations = [self.settings.initial_biomass, self.settings.initial_substrate,
+                                       self.settings.initial_product]
+        self.time_end = self.settings.time_end
+        self.data = []
+        self.time = []
+        self.batch_yield = None
+        self.batch_productivity = None
+        self.batch_titer = None
+        self.linear_combination = None
+        self.objective_value = None
+        self.productivity_constraint = settings.productivity_constraint
+        self.yield_constraint = settings.yield_constraint
+        self.titer_constraint = settings.titer_constraint
+        self.constraint_flag = True
+
+        self.calculate_fermentation_data()
+
+    def calculate_fermentation_data(self):
+        self.data, self.time = multi_stage_timecourse(self.initial_concentrations, self.switch_times,
+                                                      self.stage_fluxes, self.settings)
         self.time_end = self.time[-1]
         self.batch_productivity = batch_productivity(self.data, self.time, self.settings)
         self.batch_productivity = self.batch_productivity*(self.batch_productivity > 0)
@@ -4,3 +4,20 @@ from .mcPECASO import *
 from .Fermentation import *
 from .optimizer import *
 from .fermentation_metrics import *
+from .sparse_lp import *
+from .work_queue import *
+from .export import *
+from .multi_stage import *
+from .switch_time_curves import *
+from .knockout_screening import *
+from .service import *
+from .model_cache import *
+from .model_compression import *
+from .candidate_reduction import *
+from .warm_start import *
+from .fidelity import *
+from .batch_runner import *
+from .envelope_surface import *
+from .uncertainty import *
+from .sensitivity import *
+from .kernels import *
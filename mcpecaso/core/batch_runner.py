@@ -0,0 +1,293 @@
+import os
+import json
+import time
+import argparse
+import warnings
+import itertools
+import multiprocessing
+import numpy as np
+import pandas as pd
+from copy import deepcopy
+from joblib import Parallel, delayed
+from .mcPECASO import mcPECASO, thread_safe_batches
+from .model_cache import load_cached_model
+from .export import export_results, save_table, format_extensions
+from .settings import Settings, envelope_settings
+
+__all__ = ['read_run_file', 'expand_run', 'run_batch']
+
+
+def read_run_file(path):
+
+    """This function reads a run file. Files ending in .yml or .yaml need PyYAML to be installed, all other files
+       are read as JSON."""
+
+    with open(path) as f:
+        if os.path.splitext(path)[1].lower() in ['.yml', '.yaml']:
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError('YAML run files need PyYAML to be installed (pip install pyyaml), or use a JSON '
+                                  'run file instead')
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def make_settings(*settings_dicts):
+
+    """This function returns a Settings object with the values of the given dictionaries applied in order. Each
+       analysis of a run runs in a single worker, so settings.parallel is always turned off."""
+
+    analysis_settings = Settings()
+    for settings_dict in settings_dicts:
+        for key, value in (settings_dict or {}).items():
+            if not hasattr(analysis_settings, key):
+                raise KeyError('Unknown setting ' + str(key) + ' in run file')
+            setattr(analysis_settings, key, deepcopy(value))
+    analysis_settings.parallel = False
+    return analysis_settings
+
+
+def grid_points(grid):
+
+    """This function returns the cartesian product of a settings grid, e.g. {'objective': ['batch_productivity',
+       'batch_titer'], 'initial_substrate': [20, 50]} gives four dictionaries of settings."""
+
+    grid = grid or {}
+    keys = sorted(grid.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*[grid[key] for key in keys])]
+
+
+def envelope_key(analysis):
+
+    """This function returns the key of the production envelope of an analysis. Analyses with the same model,
+       condition, reactions and envelope settings share one envelope."""
+
+    return json.dumps([analysis['model'], analysis['bounds'], analysis['biomass_rxn'], analysis['substrate_rxn'],
+                       analysis['target_rxn'], {key: getattr(analysis['settings'], key) for key in envelope_settings}],
+                      sort_keys=True, default=str)
+
+
+def expand_entry(run, entry, entry_name, base_path):
+
+    """This function expands one entry of a run into its analyses (see expand_run)."""
+
+    analyses = []
+    targets = entry.get('target_rxns', [entry.get('target_rxn')])
+    if not targets or None in targets:
+        raise KeyError('Entry ' + entry_name + ' needs a target_rxn or target_rxns')
+    conditions = entry.get('conditions', {'None': {}})
+    points = grid_points(entry.get('grid'))
+    for target_rxn in targets:
+        for condition, bounds in conditions.items():
+            for point_index, point in enumerate(points):
+                name = '_'.join([entry_name, str(target_rxn), str(condition)])
+                if len(points) > 1:
+                    name += '_' + str(point_index).zfill(3)
+                analyses.append({'name': name,
+                                 'entry': entry_name,
+                                 'model': os.path.join(base_path, entry['model']),
+                                 'biomass_rxn': entry['biomass_rxn'],
+                                 'substrate_rxn': entry['substrate_rxn'],
+                                 'target_rxn': target_rxn,
+                                 'condition': str(condition),
+                                 'bounds': {rxn_id: list(rxn_bounds) for rxn_id, rxn_bounds in bounds.items()},
+                                 'grid_point': point,
+                                 'settings': make_settings(run.get('settings'), entry.get('settings'), point)})
+    return analyses
+
+
+def expand_run(run, base_path='.'):
+
+    """This function expands the entries of a run into a list of analyses, one per entry, target, condition and
+       settings grid point. Model paths are relative to base_path (the folder of the run file). An entry that
+       cannot be expanded, e.g. because of a missing key or an unknown setting, is returned as a single analysis
+       with an 'error' instead, which run_batch records as failed without stopping the other entries."""
+
+    analyses = []
+    for entry_index, entry in enumerate(run['entries']):
+        entry_name = str(entry.get('name', 'entry_' + str(entry_index)))
+        try:
+            analyses += expand_entry(run, entry, entry_name, base_path)
+        except Exception as error:
+            analyses.append({'name': entry_name, 'entry': entry_name, 'error': repr(error)})
+    return analyses
+
+
+def build_pecaso(analysis, cache_dir):
+
+    """This function loads the model of an analysis (from the binary model cache), applies the bounds of its
+       condition and returns an mcPECASO object without an envelope."""
+
+    model = load_cached_model(analysis['model'], 'cobra', cache_dir)
+    for rxn_id, rxn_bounds in analysis['bounds'].items():
+        model.reactions.get_by_id(rxn_id).bounds = tuple(rxn_bounds)
+    pecaso = mcPECASO(model=model, biomass_rxn=model.reactions.get_by_id(analysis['biomass_rxn']),
+                      substrate_rxn=model.reactions.get_by_id(analysis['substrate_rxn']),
+                      target_rxn=model.reactions.get_by_id(analysis['target_rxn']), condition=analysis['condition'],
+                      calculate_envelope=False)
+    pecaso.settings = deepcopy(analysis['settings'])
+    return pecaso
+
+
+def envelope_job(analysis, cache_dir):
+
+    """This function calculates the production envelope of an analysis. Returns the envelope (None if it could not
+       be calculated), the time it took and the error, if any."""
+
+    start_time = time.time()
+    try:
+        pecaso = build_pecaso(analysis, cache_dir)
+        pecaso.calculate_production_envelope()
+        if pecaso.production_envelope is None:
+            raise Exception('The production envelope could not be generated. The model is incomplete.')
+        return pecaso.production_envelope, time.time() - start_time, None
+    except Exception as error:
+        return None, time.time() - start_time, repr(error)
+
+
+def analysis_job(analysis, envelope, envelope_error, output_path, file_format, include_trajectories, cache_dir):
+
+    """This function runs the fermentation characteristics of one analysis on a precomputed envelope, exports
+       them to output_path/name and returns a summary row. Failed analyses are reported in the row instead of
+       stopping the run."""
+
+    start_time = time.time()
+    row = {'name': analysis['name'], 'entry': analysis['entry'], 'condition': analysis['condition'],
+           'target_rxn': analysis['target_rxn'], 'status': 'ok', 'error': ''}
+    row.update({'grid_' + key: str(value) if isinstance(value, (dict, list)) else value
+                for key, value in analysis['grid_point'].items()})
+    try:
+        if envelope is None:
+            raise Exception(envelope_error)
+        pecaso = build_pecaso(analysis, cache_dir)
+        pecaso.production_envelope = envelope
+        pecaso.mark_computed('production_envelope')
+        pecaso.calculate_fermentation_characteristics()
+        export_results(pecaso, os.path.join(output_path, analysis['name']), file_format, include_trajectories)
+        for stage, batch in [('two_stage', pecaso.two_stage_best_batch), ('one_stage', pecaso.one_stage_best_batch)]:
+            for metric in ['batch_productivity', 'batch_yield', 'batch_titer', 'objective_value']:
+                row[stage + '_' + metric.replace('batch_', '')] = np.nan if batch is None else getattr(batch, metric)
+    except Exception as error:
+        row['status'] = 'failed'
+        row['error'] = repr(error)
+    row['time'] = time.time() - start_time
+    return row
+
+
+def thread_safe_analysis(analysis):
+
+    """This function returns True if the fermentation characteristics of an analysis can run on a thread: the
+       global scope with closed form one stage and two stage batches (see thread_safe_batches) and no validation
+       against the reference path, so that no odeint, LSODA or COBYLA call is made."""
+
+    analysis_settings = analysis['settings']
+    return analysis_settings.scope == 'global' and thread_safe_batches(analysis_settings, two_stage=True) and \
+        not (analysis_settings.fidelity != 'reference' and analysis_settings.fidelity_validation_samples)
+
+
+def run_jobs(function, arguments, num_workers, backend, thread_safe=True):
+    if backend == 'serial' or num_workers == 1:
+        return [function(*args) for args in arguments]
+    if backend == 'threads' and not thread_safe:
+        warnings.warn('These analyses use odeint, LSODA or COBYLA, which are not guaranteed to be thread safe. '
+                      'They run on processes instead of threads.')
+        joblib_backend = 'loky'
+    elif backend == 'threads':
+        joblib_backend = 'threading'
+    elif backend == 'processes':
+        joblib_backend = 'loky'
+    else:
+        raise Exception('Unknown parallel backend')
+    return Parallel(n_jobs=num_workers, backend=joblib_backend)(delayed(function)(*args) for args in arguments)
+
+
+def run_batch(run, output_path, base_path='.', num_workers=None, backend='processes', file_format='npz',
+              include_trajectories=False, cache_dir=None):
+
+    """This function runs all the analyses of a run (see expand_run) on a pool of num_workers workers (all cores
+       if None) and returns the summary table. The production envelopes are calculated first, once for every
+       group of analyses that share one (see envelope_key), and then every analysis is run on its envelope and
+       exported to output_path/name in file_format. With backend='threads', the envelopes run on threads, but the
+       analyses only do if they are all thread safe (see thread_safe_analysis) and run on processes otherwise.
+       The summary of all analyses, in which entries that could not be expanded are listed as failed, and a
+       timing report (timing.json) are written to output_path."""
+
+    start_time = time.time()
+    num_workers = num_workers or multiprocessing.cpu_count()
+    analyses = expand_run(run, base_path)
+    invalid_rows = [{'name': analysis['name'], 'entry': analysis['entry'], 'condition': None, 'target_rxn': None,
+                     'status': 'failed', 'error': analysis['error'], 'time': 0.}
+                    for analysis in analyses if 'error' in analysis]
+    analyses = [analysis for analysis in analyses if 'error' not in analysis]
+    groups = {}
+    for analysis in analyses:
+        groups.setdefault(envelope_key(analysis), []).append(analysis)
+    keys = list(groups.keys())
+
+    envelope_results = run_jobs(envelope_job, [(groups[key][0], cache_dir) for key in keys], num_workers, backend)
+    envelopes = {key: result for key, result in zip(keys, envelope_results)}
+    analysis_envelopes = [envelopes[envelope_key(analysis)] for analysis in analyses]
+    envelope_time = time.time() - start_time
+
+    os.makedirs(output_path, exist_ok=True)
+    rows = run_jobs(analysis_job, [(analysis, envelope, envelope_error, output_path, file_format,
+                                    include_trajectories, cache_dir)
+                                   for analysis, (envelope, job_time, envelope_error)
+                                   in zip(analyses, analysis_envelopes)], num_workers, backend,
+                    all(thread_safe_analysis(analysis) for analysis in analyses))
+    summary = pd.DataFrame(rows + invalid_rows)
+    summary.insert(1, 'envelope', [keys.index(envelope_key(analysis)) for analysis in analyses] +
+                   [-1]*len(invalid_rows))
+    save_table(summary, output_path, 'summary', file_format)
+
+    timing = {'analyses': len(analyses),
+              'envelopes': len(keys),
+              'failed': int((summary['status'] != 'ok').sum()),
+              'workers': num_workers,
+              'backend': backend,
+              'envelope_phase_time': envelope_time,
+              'analysis_phase_time': time.time() - start_time - envelope_time,
+              'total_time': time.time() - start_time,
+              'envelope_times': [result[1] for result in envelope_results],
+              'analysis_times': {row['name']: row['time'] for row in rows}}
+    with open(os.path.join(output_path, 'timing.json'), 'w') as f:
+        json.dump(timing, f, indent=2)
+    return summary
+
+
+def main(argv=None):
+
+    """Entry point of the mcpecaso-run command. Options given on the command line override the ones in the run
+       file. Returns the exit status, which is 1 if any analysis failed."""
+
+    parser = argparse.ArgumentParser(description='Runs the mcPECASO analyses listed in a YAML or JSON run file.')
+    parser.add_argument('run_file', help='YAML or JSON file listing models, reactions, conditions and settings')
+    parser.add_argument('--output', default=None, help='result folder (default: output in the run file, or the '
+                                                       'name of the run file)')
+    parser.add_argument('--workers', type=int, default=None, help='number of workers (default: all cores)')
+    parser.add_argument('--backend', choices=['processes', 'threads', 'serial'], default=None,
+                        help='threads are only used for the envelopes and for analyses on the closed form paths; '
+                             'the other analyses run on processes')
+    parser.add_argument('--format', choices=list(format_extensions.keys()), default=None)
+    parser.add_argument('--trajectories', action='store_true', help='also export the fermentation timecourses')
+    parser.add_argument('--cache-dir', default=None, help='binary model cache folder')
+    arguments = parser.parse_args(argv)
+
+    run = read_run_file(arguments.run_file)
+    base_path = os.path.dirname(os.path.abspath(arguments.run_file))
+    output_path = arguments.output or os.path.join(base_path, run.get('output', os.path.splitext(
+        os.path.basename(arguments.run_file))[0] + '_results'))
+    summary = run_batch(run, output_path, base_path,
+                        num_workers=arguments.workers or run.get('workers'),
+                        backend=arguments.backend or run.get('backend', 'processes'),
+                        file_format=arguments.format or run.get('format', 'npz'),
+                        include_trajectories=arguments.trajectories or run.get('trajectories', False),
+                        cache_dir=arguments.cache_dir or run.get('cache_dir'))
+    num_failed = int((summary['status'] != 'ok').sum())
+    print('Completed', len(summary), 'analyses,', num_failed, 'failed. Results in', output_path)
+    return 1 if num_failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
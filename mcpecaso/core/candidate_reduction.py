@@ -0,0 +1,142 @@
+import numpy as np
+
+__all__ = ['DominatedTwoStageFermentation', 'two_stage_candidates', 'expand_two_stage_grid']
+
+
+class DominatedTwoStageFermentation(object):
+    def __init__(self, stage_one_fluxes, stage_two_fluxes, settings):
+        """Stands in for a two stage pair of the global grid that was not simulated, because a stage two phenotype
+           that is at least as good exists for the same stage one. The metrics are NaN, so the pair shows up as a
+           gap in the characteristics and is never selected as a best batch."""
+        self.settings = settings
+        self.stage_one_fluxes = stage_one_fluxes
+        self.stage_two_fluxes = stage_two_fluxes
+        self.data = np.zeros((3, 0))
+        self.time = np.zeros(0)
+        self.time_end = np.nan
+        self.optimal_switch_time = np.nan
+        self.batch_productivity = np.nan
+        self.batch_yield = np.nan
+        self.batch_titer = np.nan
+        self.linear_combination = np.nan
+        self.objective_value = np.nan
+        self.constraint_flag = True
+
+
+def unique_phenotypes(flux_list, decimals=9):
+
+    """This function returns the index of the first phenotype with the same fluxes (rounded to decimals) for every
+       phenotype of flux_list."""
+
+    first_index = {}
+    representatives = []
+    for index, fluxes in enumerate(flux_list):
+        key = tuple(np.around(np.asarray(fluxes, dtype=float), decimals=decimals))
+        representatives.append(first_index.setdefault(key, index))
+    return representatives
+
+
+def dominance_applies(settings):
+
+    """This function returns True if stage two dominance can be used to skip pairs for the objective and
+       constraints in settings.
+
+       With constant kinetics, the substrate is used up at the same rate in a stage no matter what is made from it.
+       A stage two phenotype with a growth rate, a substrate uptake rate and a product yield (production over
+       uptake) that are all at least as large as those of another therefore makes at least as much product from
+       the same starting point, in at most the same time, for any switch time. Its productivity and titer are at
+       least as large, but its yield can be lower when the batch ends before the substrate is depleted. Dominance
+       is therefore only used for objectives and constraints without a yield term."""
+
+    if settings.kinetics != 'constant' or settings.yield_constraint:
+        return False
+    if settings.objective in ['batch_productivity', 'batch_titer']:
+        return True
+    return settings.objective == 'linear_combination' and settings.yield_coefficient == 0 and \
+        settings.productivity_coefficient >= 0 and settings.titer_coefficient >= 0
+
+
+def stage_two_dominators(flux_list, candidates, tolerance=1e-9):
+
+    """This function returns, for every index in candidates, the list of the other candidates that dominate it as a
+       stage two phenotype (see dominance_applies). Phenotypes that do not take up substrate or do not make product
+       are never used to dominate others."""
+
+    fluxes = np.asarray([flux_list[index] for index in candidates], dtype=float)
+    growth_rates = fluxes[:, 0]
+    uptake_rates = -fluxes[:, 1]
+    production_rates = fluxes[:, 2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        yields = np.where(uptake_rates > tolerance, production_rates/uptake_rates, np.nan)
+
+    at_least = (growth_rates[:, None] >= growth_rates[None, :] - tolerance) & \
+               (uptake_rates[:, None] >= uptake_rates[None, :] - tolerance) & \
+               (yields[:, None] >= yields[None, :] - tolerance)
+    better = (growth_rates[:, None] > growth_rates[None, :] + tolerance) | \
+             (uptake_rates[:, None] > uptake_rates[None, :] + tolerance) | \
+             (yields[:, None] > yields[None, :] + tolerance)
+    usable = (uptake_rates > tolerance) & (production_rates >= 0)
+    # dominates[k, j] is True if candidate k dominates candidate j
+    dominates = at_least & better & usable[:, None] & usable[None, :]
+    return {candidates[j]: [candidates[k] for k in np.flatnonzero(dominates[:, j])] for j in range(len(candidates))}
+
+
+def two_stage_candidates(flux_list, settings):
+
+    """This function reduces the N x N two stage grid of flux_list to the pairs that have to be simulated. Returns
+       the list of (stage one fluxes, stage two fluxes) pairs to simulate and, for every pair of the full grid
+       (ordered by stage one index, then stage two index), the position of its result in that list or None if the
+       pair was skipped.
+
+       If settings.reduce_candidates is set, phenotypes with identical fluxes are only simulated once, and pairs
+       whose stage two phenotype is dominated by a phenotype other than the stage one phenotype are skipped when
+       dominance_applies. Neither can change the best two stage batch, and the pair of the traditional two stage
+       batch (maximum growth, then minimum growth) is always simulated."""
+
+    num_points = len(flux_list)
+    if not settings.reduce_candidates:
+        flux_pairs = [(stage_one_fluxes, stage_two_fluxes) for stage_one_fluxes in flux_list
+                      for stage_two_fluxes in flux_list]
+        return flux_pairs, list(range(len(flux_pairs)))
+
+    representatives = unique_phenotypes(flux_list)
+    candidates = sorted(set(representatives))
+    if dominance_applies(settings):
+        dominators = stage_two_dominators(flux_list, candidates)
+    else:
+        dominators = {index: [] for index in candidates}
+    growth_rates = [fluxes[0] for fluxes in flux_list]
+    traditional_pair = (representatives[int(np.argmax(growth_rates))], representatives[int(np.argmin(growth_rates))])
+
+    flux_pairs = []
+    pair_positions = {}
+    grid = []
+    for stage_one_index in range(num_points):
+        for stage_two_index in range(num_points):
+            pair = (representatives[stage_one_index], representatives[stage_two_index])
+            if pair not in pair_positions:
+                if pair != traditional_pair and any(index != pair[0] for index in dominators[pair[1]]):
+                    pair_positions[pair] = None
+                else:
+                    pair_positions[pair] = len(flux_pairs)
+                    flux_pairs.append((flux_list[pair[0]], flux_list[pair[1]]))
+            grid.append(pair_positions[pair])
+    return flux_pairs, grid
+
+
+def expand_two_stage_grid(flux_list, grid, ts_ferm_list, settings):
+
+    """This function maps the fermentations of the simulated pairs (see two_stage_candidates) back onto the full
+       grid of flux_list, in the order set_fermentation_results expects. Skipped pairs get a
+       DominatedTwoStageFermentation."""
+
+    num_points = len(flux_list)
+    full_list = []
+    for grid_index, position in enumerate(grid):
+        stage_one_fluxes = flux_list[grid_index // num_points]
+        stage_two_fluxes = flux_list[grid_index % num_points]
+        if position is None:
+            full_list.append(DominatedTwoStageFermentation(stage_one_fluxes, stage_two_fluxes, settings))
+        else:
+            full_list.append(ts_ferm_list[position])
+    return full_list
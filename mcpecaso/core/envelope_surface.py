@@ -0,0 +1,179 @@
+import numpy as np
+import warnings
+from scipy.interpolate import RegularGridInterpolator
+from .substrate_dependent_envelopes import get_uptake_model
+from .sparse_lp import SparseLPModel
+
+__all__ = ['EnvelopeSurface', 'min_feasible_uptake', 'production_rate_bounds']
+
+
+def fixed_growth_bounds(sparse_model, biomass_rxn, growth_rate):
+    lower_bounds = sparse_model.lower_bounds.copy()
+    upper_bounds = sparse_model.upper_bounds.copy()
+    lower_bounds[sparse_model.index(biomass_rxn)] = growth_rate
+    upper_bounds[sparse_model.index(biomass_rxn)] = growth_rate
+    return lower_bounds, upper_bounds
+
+
+def min_feasible_uptake(lp_model, biomass_rxn, substrate_rxn, growth_rate):
+
+    """This function returns the substrate flux closest to zero (the smallest uptake) that supports growth_rate.
+       lp_model is a cobra model or a SparseLPModel."""
+
+    if isinstance(lp_model, SparseLPModel):
+        lower_bounds, upper_bounds = fixed_growth_bounds(lp_model, biomass_rxn, growth_rate)
+        return lp_model.solve(lp_model.objective_vector(substrate_rxn), 'maximize', lower_bounds, upper_bounds)
+    with lp_model as model:
+        biomass_rxn.bounds = (growth_rate, growth_rate)
+        model.objective = substrate_rxn.id
+        return model.optimize(objective_sense='maximize').objective_value
+
+
+def production_rate_bounds(lp_model, biomass_rxn, substrate_rxn, target_rxn, growth_rate, substrate_uptake_rate):
+
+    """This function returns the minimum and maximum target flux at the given growth rate and substrate flux
+       (negative for uptake). Bounds whose LP is not feasible are returned as None."""
+
+    if isinstance(lp_model, SparseLPModel):
+        lower_bounds, upper_bounds = fixed_growth_bounds(lp_model, biomass_rxn, growth_rate)
+        lower_bounds[lp_model.index(substrate_rxn)] = substrate_uptake_rate
+        objective = lp_model.objective_vector(target_rxn)
+        return (lp_model.solve(objective, 'minimize', lower_bounds, upper_bounds),
+                lp_model.solve(objective, 'maximize', lower_bounds, upper_bounds))
+    with lp_model as model:
+        biomass_rxn.bounds = (growth_rate, growth_rate)
+        substrate_rxn.lower_bound = substrate_uptake_rate
+        model.objective = target_rxn.id
+        sol_min = model.optimize(objective_sense='minimize')
+        production_rate_lb = sol_min.objective_value if model.solver.status == 'optimal' else None
+        sol_max = model.optimize(objective_sense='maximize')
+        production_rate_ub = sol_max.objective_value if model.solver.status == 'optimal' else None
+    return production_rate_lb, production_rate_ub
+
+
+class EnvelopeSurface(object):
+
+    def __init__(self, lp_model, biomass_rxn, substrate_rxn, target_rxns, growth_points=51, uptake_points=21,
+                 max_uptake=None):
+        """Solves the minimum and maximum target fluxes once on a grid of growth rate x substrate uptake rate, so
+           that the production envelope of any uptake model and parameters can be interpolated without new LPs.
+           lp_model is a cobra model or a SparseLPModel, and target_rxns a list of target reactions.
+
+           Every row of the grid is one growth rate, from the maximum growth rate down to zero, and runs in
+           uptake_points even steps from the minimum feasible uptake at that growth rate up to max_uptake (the
+           uptake bound of the substrate reaction in the model if None). The maximum target flux is concave and the
+           minimum convex in the growth and substrate fluxes, and the interpolation weights are also the weights
+           of the grid points that make up the interpolated point, so interpolated envelopes never leave the true
+           envelope. Points beyond max_uptake are solved exactly."""
+        self.lp_model = lp_model
+        self.biomass_rxn = biomass_rxn
+        self.substrate_rxn = substrate_rxn
+        self.target_ids = [target_rxn.id for target_rxn in target_rxns]
+        self.target_rxns = dict(zip(self.target_ids, target_rxns))
+        self.num_solves = 0
+
+        if isinstance(lp_model, SparseLPModel):
+            max_growth = lp_model.solve()
+            if max_uptake is None:
+                max_uptake = -lp_model.lower_bounds[lp_model.index(substrate_rxn)]
+        else:
+            max_growth = lp_model.optimize().objective_value
+            if max_uptake is None:
+                max_uptake = -substrate_rxn.lower_bound
+        self.max_growth = max_growth
+        self.max_uptake = max_uptake
+        self.growth_rates = np.linspace(max_growth, 0, growth_points)
+        self.uptake_fractions = np.linspace(0, 1, uptake_points)
+        self.min_feasible_uptakes = np.array([min_feasible_uptake(lp_model, biomass_rxn, substrate_rxn, growth_rate)
+                                              for growth_rate in self.growth_rates])
+
+        self.production_rates_lb = {}
+        self.production_rates_ub = {}
+        for target_id in self.target_ids:
+            self.production_rates_lb[target_id] = np.zeros((growth_points, uptake_points))
+            self.production_rates_ub[target_id] = np.zeros((growth_points, uptake_points))
+        for i, growth_rate in enumerate(self.growth_rates):
+            for j, substrate_uptake_rate in enumerate(self.substrate_fluxes(self.min_feasible_uptakes[i],
+                                                                            self.uptake_fractions)):
+                for target_id in self.target_ids:
+                    self.production_rates_lb[target_id][i, j], self.production_rates_ub[target_id][i, j] = \
+                        self.solve_production_rates(target_id, growth_rate, substrate_uptake_rate)
+
+        # The interpolators work on increasing growth rates
+        self.interpolators = {}
+        for target_id in self.target_ids:
+            self.interpolators[target_id] = [RegularGridInterpolator((self.growth_rates[::-1], self.uptake_fractions),
+                                                                     values[::-1])
+                                             for values in [self.production_rates_lb[target_id],
+                                                            self.production_rates_ub[target_id]]]
+
+    def substrate_fluxes(self, min_feasible_uptakes, uptake_fractions):
+        """Returns the substrate fluxes at the given fractions of the way from the minimum feasible uptakes to
+           max_uptake."""
+        return min_feasible_uptakes + uptake_fractions*(-self.max_uptake - min_feasible_uptakes)
+
+    def solve_production_rates(self, target_id, growth_rate, substrate_uptake_rate):
+        self.num_solves += 1
+        production_rate_lb, production_rate_ub = production_rate_bounds(self.lp_model, self.biomass_rxn,
+                                                                        self.substrate_rxn,
+                                                                        self.target_rxns[target_id], growth_rate,
+                                                                        substrate_uptake_rate)
+        if production_rate_lb is None:
+            print("Min Solver wasn't feasible for Growth Rate: ", growth_rate,
+                  " with uptake rate: ", substrate_uptake_rate)
+            production_rate_lb = 0
+        if production_rate_ub is None:
+            print("Max Solver wasn't feasible for Growth Rate: ", growth_rate,
+                  " with uptake rate: ", substrate_uptake_rate)
+            production_rate_ub = 0
+        return production_rate_lb, production_rate_ub
+
+    def production_rates(self, growth_rates, substrate_uptake_rates, target_rxn=None):
+        """Returns the interpolated minimum and maximum target fluxes (of the first target if target_rxn is None) at
+           arrays of growth rates and substrate fluxes. Substrate fluxes above the minimum feasible uptake are
+           treated as the minimum feasible uptake, and points beyond max_uptake are solved exactly."""
+        target_id = self.target_ids[0] if target_rxn is None else getattr(target_rxn, 'id', target_rxn)
+        growth_rates = np.asarray(growth_rates, dtype=float)
+        substrate_uptake_rates = np.asarray(substrate_uptake_rates, dtype=float)
+        min_feasible_uptakes = np.interp(growth_rates, self.growth_rates[::-1], self.min_feasible_uptakes[::-1])
+        uptake_ranges = min_feasible_uptakes + self.max_uptake
+        with np.errstate(divide='ignore', invalid='ignore'):
+            uptake_fractions = np.where(uptake_ranges > 0, (min_feasible_uptakes - substrate_uptake_rates) /
+                                        uptake_ranges, 0.)
+        points = np.column_stack((growth_rates, np.clip(uptake_fractions, 0, 1)))
+        production_rates_lb, production_rates_ub = [interpolator(points)
+                                                    for interpolator in self.interpolators[target_id]]
+        for index in np.flatnonzero(uptake_fractions > 1):
+            production_rates_lb[index], production_rates_ub[index] = \
+                self.solve_production_rates(target_id, growth_rates[index], substrate_uptake_rates[index])
+        return production_rates_lb, production_rates_ub
+
+    def envelopes(self, uptake_fun, uptake_params, num_points=25):
+        """Returns the envelope data of every target for the given uptake model at num_points growth rates, in the
+           format of multi_target_envelope_calculator. The minimum feasible uptake is interpolated between the rows
+           of the grid as well, which can only overestimate the uptake that is needed."""
+        growth_rates = np.linspace(self.max_growth, 0, num_points)
+        sub_model_predictions = get_uptake_model(uptake_fun, uptake_params).fluxes(growth_rates)
+        min_feasible_uptakes = np.interp(growth_rates, self.growth_rates[::-1], self.min_feasible_uptakes[::-1])
+        if np.any(sub_model_predictions > min_feasible_uptakes):
+            warnings.warn('The parameters used with the model for substrate uptake resulted in rates that are lower'
+                          ' than thee minimum feasible uptake for one or more cases. The minimum feasible uptake'
+                          ' rate was used in these cases')
+        substrate_uptake_rates = np.minimum(sub_model_predictions, min_feasible_uptakes)
+
+        envelopes = {}
+        for target_id in self.target_ids:
+            production_rates_lb, production_rates_ub = self.production_rates(growth_rates, substrate_uptake_rates,
+                                                                             target_id)
+            envelopes[target_id] = {'growth_rates': list(growth_rates),
+                                    'substrate_uptake_rates': list(-substrate_uptake_rates),
+                                    'production_rates_lb': list(production_rates_lb),
+                                    'production_rates_ub': list(production_rates_ub),
+                                    'yield_lb': list(np.divide(production_rates_lb, -substrate_uptake_rates)),
+                                    'yield_ub': list(np.divide(production_rates_ub, -substrate_uptake_rates))}
+        return envelopes
+
+    def envelope(self, uptake_fun, uptake_params, num_points=25, target_rxn=None):
+        """Returns the envelope data of one target (the first one if None) in the format of envelope_calculator."""
+        target_id = self.target_ids[0] if target_rxn is None else getattr(target_rxn, 'id', target_rxn)
+        return self.envelopes(uptake_fun, uptake_params, num_points)[target_id]
@@ -0,0 +1,187 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+__all__ = ['save_table', 'load_table', 'save_trajectories', 'load_trajectory', 'export_results', 'load_metadata',
+           'load_results', 'sweep_folder_names', 'export_sweep']
+
+table_names = ['production_envelope', 'two_stage_characteristics', 'one_stage_characteristics']
+format_extensions = {'parquet': '.parquet', 'hdf5': '.h5', 'npz': '.npz'}
+
+
+def save_table(table, path, name, file_format):
+
+    """This function saves a DataFrame as path/name in the given columnar format. Parquet needs pyarrow (or
+       fastparquet) and HDF5 needs pytables to be installed, NPZ only needs numpy."""
+
+    if file_format == 'parquet':
+        table.to_parquet(os.path.join(path, name + '.parquet'), index=False)
+    elif file_format == 'hdf5':
+        table.to_hdf(os.path.join(path, name + '.h5'), key=name, mode='w', format='table')
+    elif file_format == 'npz':
+        # Object columns are stored as strings so that the file can be loaded without pickle
+        np.savez(os.path.join(path, name + '.npz'),
+                 **{column: table[column].values.astype(str) if table[column].dtype == object else table[column].values
+                    for column in table.columns})
+    else:
+        raise KeyError('Unknown export format specified. Only ', [key for key in format_extensions.keys()],
+                       'are acceptable formats.')
+
+
+def load_table(path, name, columns=None):
+
+    """This function loads the table name from an exported result folder. Only the given columns are read if
+       columns is not None, which avoids reading the whole table for the parquet and npz formats."""
+
+    for file_format, extension in format_extensions.items():
+        file_path = os.path.join(path, name + extension)
+        if not os.path.exists(file_path):
+            continue
+        if file_format == 'parquet':
+            return pd.read_parquet(file_path, columns=columns)
+        elif file_format == 'hdf5':
+            return pd.read_hdf(file_path, key=name, columns=columns)
+        else:
+            with np.load(file_path, allow_pickle=False) as data:
+                return pd.DataFrame({column: data[column] for column in (columns or data.files)})
+    raise FileNotFoundError('No table named ' + name + ' was found in ' + path)
+
+
+def fermentation_table(characteristics, fermentation_list):
+
+    """This function returns the characteristics of a fermentation list as a DataFrame, with the optimal switch
+       time and batch time of every fermentation added when they are available."""
+
+    table = pd.DataFrame(characteristics)
+    if len(fermentation_list) == len(table):
+        table['batch time'] = [ferm.time_end for ferm in fermentation_list]
+        if all(hasattr(ferm, 'optimal_switch_time') for ferm in fermentation_list):
+            table['optimal switch time'] = [ferm.optimal_switch_time for ferm in fermentation_list]
+    return table
+
+
+def save_trajectories(fermentation_list, path, name):
+
+    """This function saves the timecourse data of a list of fermentations as flat .npy arrays, so that they can be
+       memory mapped when loading. name_data holds the concatenated [biomass, substrate, product] data,
+       name_time the concatenated timepoints and name_offsets the start of every fermentation in them."""
+
+    lengths = [len(ferm.time) for ferm in fermentation_list]
+    offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+    if fermentation_list:
+        data = np.concatenate([np.asarray(ferm.data, dtype=float) for ferm in fermentation_list], axis=1)
+        time = np.concatenate([np.asarray(ferm.time, dtype=float) for ferm in fermentation_list])
+    else:
+        data = np.zeros((3, 0))
+        time = np.zeros(0)
+    np.save(os.path.join(path, name + '_data.npy'), data)
+    np.save(os.path.join(path, name + '_time.npy'), time)
+    np.save(os.path.join(path, name + '_offsets.npy'), offsets)
+
+
+def load_trajectory(path, name, index):
+
+    """This function returns the (data, time) of fermentation number index from exported trajectories. The arrays
+       are memory mapped, so only the requested fermentation is read from disk."""
+
+    offsets = np.load(os.path.join(path, 'trajectories', name + '_offsets.npy'), mmap_mode='r')
+    data = np.load(os.path.join(path, 'trajectories', name + '_data.npy'), mmap_mode='r')
+    time = np.load(os.path.join(path, 'trajectories', name + '_time.npy'), mmap_mode='r')
+    start, end = offsets[index], offsets[index + 1]
+    return np.asarray(data[:, start:end]), np.asarray(time[start:end])
+
+
+def export_results(pecaso, path, file_format='npz', include_trajectories=False):
+
+    """This function exports the production envelope and the one stage and two stage characteristics of an
+       mcPECASO object to the folder path in a columnar format ('parquet', 'hdf5' or 'npz'). The model, reaction
+       ids and settings are saved to metadata.json. If include_trajectories is True, the timecourse data of the
+       fermentations is saved as memory mappable .npy files in path/trajectories."""
+
+    os.makedirs(path, exist_ok=True)
+    if pecaso.production_envelope is not None:
+        save_table(pecaso.production_envelope, path, 'production_envelope', file_format)
+    save_table(fermentation_table(pecaso.two_stage_characteristics, pecaso.two_stage_fermentation_list), path,
+               'two_stage_characteristics', file_format)
+    save_table(fermentation_table(pecaso.one_stage_characteristics, pecaso.one_stage_fermentation_list), path,
+               'one_stage_characteristics', file_format)
+
+    if include_trajectories:
+        os.makedirs(os.path.join(path, 'trajectories'), exist_ok=True)
+        save_trajectories(pecaso.two_stage_fermentation_list, os.path.join(path, 'trajectories'), 'two_stage')
+        save_trajectories(pecaso.one_stage_fermentation_list, os.path.join(path, 'trajectories'), 'one_stage')
+
+    metadata = {'condition': pecaso.condition,
+                'model': getattr(pecaso.model, 'id', None),
+                'biomass_rxn': getattr(pecaso.biomass_rxn, 'id', None),
+                'substrate_rxn': getattr(pecaso.substrate_rxn, 'id', None),
+                'target_rxn': getattr(pecaso.target_rxn, 'id', None),
+                'objective_name': pecaso.objective_name,
+                'file_format': file_format,
+                'trajectories': include_trajectories,
+                'settings': vars(pecaso.settings)}
+    with open(os.path.join(path, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f, indent=2, default=str)
+
+
+def load_metadata(path):
+    with open(os.path.join(path, 'metadata.json')) as f:
+        return json.load(f)
+
+
+def load_results(path):
+
+    """This function loads all the tables of an exported result folder into a dictionary of DataFrames."""
+
+    results = {}
+    for name in table_names:
+        try:
+            results[name] = load_table(path, name)
+        except FileNotFoundError:
+            results[name] = None
+    results['metadata'] = load_metadata(path)
+    return results
+
+
+def sweep_folder_names(pecaso_list, names=None):
+
+    """This function returns the sub folder name of every mcPECASO object of a sweep: the given names, or the
+       condition and target reaction id joined by an underscore if names is None. Duplicate names raise an
+       exception, since their results would overwrite each other."""
+
+    if names is None:
+        names = [str(pecaso.condition) + '_' + str(getattr(pecaso.target_rxn, 'id', None)) for pecaso in pecaso_list]
+    names = [str(name) for name in names]
+    if len(names) != len(pecaso_list):
+        raise Exception('export_sweep needs one name per mcPECASO object')
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        raise Exception('The sub folder names of the sweep are not unique: ' + ', '.join(duplicates) +
+                        '. Give every mcPECASO object a unique condition or pass unique names.')
+    return names
+
+
+def export_sweep(pecaso_list, path, file_format='npz', include_trajectories=False, names=None):
+
+    """This function exports several mcPECASO objects to one sub folder each of path (see sweep_folder_names), and
+       writes a summary table with the folder and the best one stage and two stage batch of every object.
+       Dashboards can read the summary and then load a single result with load_results(os.path.join(path,
+       folder))."""
+
+    folders = sweep_folder_names(pecaso_list, names)
+    summary = {'folder': [], 'condition': [], 'target_rxn': [], 'two_stage_productivity': [], 'two_stage_yield': [],
+               'two_stage_titer': [], 'two_stage_objective_value': [], 'one_stage_productivity': [],
+               'one_stage_yield': [], 'one_stage_titer': [], 'one_stage_objective_value': []}
+    for pecaso, folder in zip(pecaso_list, folders):
+        export_results(pecaso, os.path.join(path, folder), file_format, include_trajectories)
+        summary['folder'].append(folder)
+        summary['condition'].append(str(pecaso.condition))
+        summary['target_rxn'].append(getattr(pecaso.target_rxn, 'id', None))
+        for stage, batch in [('two_stage', pecaso.two_stage_best_batch), ('one_stage', pecaso.one_stage_best_batch)]:
+            summary[stage + '_productivity'].append(np.nan if batch is None else batch.batch_productivity)
+            summary[stage + '_yield'].append(np.nan if batch is None else batch.batch_yield)
+            summary[stage + '_titer'].append(np.nan if batch is None else batch.batch_titer)
+            summary[stage + '_objective_value'].append(np.nan if batch is None else batch.objective_value)
+    os.makedirs(path, exist_ok=True)
+    save_table(pd.DataFrame(summary), path, 'summary', file_format)
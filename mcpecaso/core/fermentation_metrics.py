@@ -1,32 +1,90 @@
+import numpy as np
+
+objective_metrics = {'batch_productivity': 'productivity',
+                     'batch_yield': 'yield',
+                     'batch_titer': 'titer',
+                     'linear_combination': 'linear_combination'}
+
+
+def batch_metrics(initial_states, final_states, end_times, settings, clip=False):
+    """ This function returns the productivity, yield, end titer and linear combination of many batches at once as
+        arrays. initial_states and final_states hold the [biomass, substrate, product] concentrations along their
+        last axis, and broadcast against each other and against end_times, so a single initial state can be used
+        for all batches. With clip=True, negative productivities, yields and titers are set to zero (like in the
+        fermentation classes) before the linear combination is formed. The linear combination is left out if
+        settings is None."""
+    initial_states = np.asarray(initial_states, dtype=float)
+    final_states = np.asarray(final_states, dtype=float)
+    end_times = np.asarray(end_times, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        productivity = np.where(end_times > 0, final_states[..., 2] / end_times, 0.)
+        sub_used = initial_states[..., 1] - final_states[..., 1]
+        product_yield = np.where(sub_used > 0, (final_states[..., 2] - initial_states[..., 2]) / sub_used, 0.)
+    titer = final_states[..., 2] + np.zeros(np.shape(productivity))
+    if clip:
+        productivity = productivity*(productivity > 0)
+        product_yield = product_yield*(product_yield > 0)
+        titer = titer*(titer > 0)
+    metrics = {'productivity': productivity,
+               'yield': product_yield,
+               'titer': titer}
+    if settings is not None:
+        metrics['linear_combination'] = settings.productivity_coefficient*productivity + \
+            settings.yield_coefficient*product_yield + settings.titer_coefficient*titer
+    return metrics
+
+
+def objective_values(metrics, settings):
+    """ This function returns the objective in settings from the arrays of batch_metrics. Unknown objectives fall
+        back to the productivity, like in the fermentation classes."""
+    return metrics[objective_metrics.get(settings.objective, 'productivity')]
+
+
+def constraint_mask(metrics, settings):
+    """ This function returns a boolean array that is True for the batches of batch_metrics that meet the
+        productivity, yield and titer constraints in settings."""
+    return ((metrics['productivity'] >= settings.productivity_constraint) &
+            (metrics['yield'] >= settings.yield_constraint) &
+            (metrics['titer'] >= settings.titer_constraint))
+
+
+def timecourse_metrics(dfba_data, time, settings):
+    """ This function returns batch_metrics for a single batch as 0-d arrays.
+        Input dfba_data should be in the order [biomass, substrate, product]"""
+    dfba_data = np.asarray(dfba_data, dtype=float)
+    return batch_metrics(dfba_data[:, 0], dfba_data[:, -1], time[-1], settings)
+
+
 def batch_productivity(dfba_data, time, settings):
     """ This function returns the productivity of a batch.
         Input dfba_data should be in the order [biomass, substrate, product]"""
-    if time[-1] > 0:
-        return dfba_data[2, -1] / time[-1]
-    else:
-        return 0
+    return timecourse_metrics(dfba_data, time, settings)['productivity'][()]
 
 
 def batch_yield(dfba_data, time, settings):
     """ This function returns the yield of a batch.
         Input dfba_data should be in the order [biomass, substrate, product]"""
-    sub_used = dfba_data[1, 0] - dfba_data[1, -1]
-    if sub_used > 0:
-        return (dfba_data[2, -1] - dfba_data[2, 0]) / sub_used
-    else:
-        return 0
+    return timecourse_metrics(dfba_data, time, settings)['yield'][()]
 
 
 def batch_end_titer(dfba_data, time, settings):
     """ This function returns the end titer of a batch.
         Input dfba_data should be in the order [biomass, substrate, product]"""
 
-    return dfba_data[2, -1]
+    return timecourse_metrics(dfba_data, time, settings)['titer'][()]
 
 
 def linear_combination(dfba_data, time, settings):
     """ This function returns a linear combination of the above defined metrics in case it is needed as an
         objective function. Input dfba_data should be in the order [biomass, substrate, product]"""
-    return settings.productivity_coefficient*batch_productivity(dfba_data, time, settings) + \
-        settings.yield_coefficient*batch_yield(dfba_data, time, settings) + \
-        settings.titer_coefficient*batch_end_titer(dfba_data, time, settings)
+    return timecourse_metrics(dfba_data, time, settings)['linear_combination'][()]
+
+
+def product_metrics(dfba_data, time, settings):
+    """ This function returns the productivity, yield, end titer and linear combination of every product in a
+        batch as arrays. Input dfba_data should be in the order [biomass, substrate, product_1, ..., product_k]"""
+    dfba_data = np.asarray(dfba_data, dtype=float)
+    # Every product is a batch of its own with the shared biomass and substrate
+    states = np.stack([np.broadcast_to(dfba_data[0], dfba_data[2:].shape),
+                       np.broadcast_to(dfba_data[1], dfba_data[2:].shape), dfba_data[2:]], axis=-1)
+    return batch_metrics(states[:, 0], states[:, -1], time[-1], settings)
@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+from copy import deepcopy
+from .Fermentation import TwoStageFermentation
+
+__all__ = ['fidelity_tiers', 'fidelity_settings', 'validate_fidelity', 'cheapest_fidelity']
+
+# From the slowest and most accurate to the fastest tier:
+# reference - odeint timecourses, and COBYLA switch times started from the default guesses
+# fast      - closed form timecourses, and extrema searches started from a coarse global grid
+# fastest   - like fast, with the switch times of the global grid picked from sampled switch time curves
+fidelity_tiers = ['reference', 'fast', 'fastest']
+validation_metrics = {'productivity': 'batch_productivity',
+                      'yield': 'batch_yield',
+                      'titer': 'batch_titer',
+                      'objective value': 'objective_value',
+                      'switch time': 'optimal_switch_time'}
+
+
+def fidelity_settings(settings, fidelity):
+
+    """This function returns a copy of settings with the given fidelity tier."""
+
+    if fidelity not in fidelity_tiers:
+        raise KeyError('Unknown fidelity specified. Only ', fidelity_tiers, 'are acceptable fidelities.')
+    tier_settings = deepcopy(settings)
+    tier_settings.fidelity = fidelity
+    tier_settings.parallel = False
+    return tier_settings
+
+
+def validate_fidelity(flux_list, settings, num_samples=20, seed=None, ts_ferm_list=None):
+
+    """This function reruns a random sample of num_samples two stage pairs of flux_list on the reference path and
+       compares them with the fidelity tier in settings. The tier results are taken from ts_ferm_list (the global
+       grid in the order of set_fermentation_results) if it is given, otherwise they are simulated too. Returns a
+       table with the tier and reference metrics of every sampled pair and a summary with the largest absolute and
+       relative differences of every metric, and the largest relative amount the tier objective falls short of the
+       reference. Relative differences are taken with respect to the largest reference value of the sample, so
+       that metrics close to zero do not dominate them."""
+
+    num_points = len(flux_list)
+    grid_indices = np.arange(num_points*num_points)
+    if ts_ferm_list is not None:
+        grid_indices = np.array([index for index in grid_indices
+                                 if not np.isnan(ts_ferm_list[index].objective_value)], dtype=int)
+    random_state = np.random.RandomState(seed)
+    grid_indices = np.sort(random_state.choice(grid_indices, min(num_samples, len(grid_indices)), replace=False))
+
+    tier_settings = fidelity_settings(settings, settings.fidelity)
+    reference = fidelity_settings(settings, 'reference')
+    rows = []
+    for grid_index in grid_indices:
+        stage_one_fluxes = flux_list[grid_index // num_points]
+        stage_two_fluxes = flux_list[grid_index % num_points]
+        if ts_ferm_list is not None:
+            tier_ferm = ts_ferm_list[grid_index]
+        else:
+            tier_ferm = TwoStageFermentation(stage_one_fluxes, stage_two_fluxes, tier_settings)
+        reference_ferm = TwoStageFermentation(stage_one_fluxes, stage_two_fluxes, reference)
+        row = {'stage_one_growth_rate': stage_one_fluxes[0], 'stage_two_growth_rate': stage_two_fluxes[0]}
+        for metric, attribute in validation_metrics.items():
+            row[metric] = getattr(tier_ferm, attribute)
+            row['reference ' + metric] = getattr(reference_ferm, attribute)
+        rows.append(row)
+    table = pd.DataFrame(rows)
+
+    summary = {'fidelity': settings.fidelity, 'num_samples': len(table)}
+    for metric in validation_metrics:
+        if table.empty:
+            summary['max ' + metric + ' difference'] = np.nan
+            summary['max relative ' + metric + ' difference'] = np.nan
+            continue
+        table[metric + ' difference'] = (table[metric] - table['reference ' + metric]).abs()
+        scale = table['reference ' + metric].abs().max()
+        summary['max ' + metric + ' difference'] = table[metric + ' difference'].max()
+        summary['max relative ' + metric + ' difference'] = \
+            summary['max ' + metric + ' difference']/scale if scale > 0 else 0.
+    # COBYLA can stop in a worse local optimum than the faster tiers, so only the objective values that the tier
+    # falls short of the reference by count against it
+    if table.empty:
+        summary['max relative objective value shortfall'] = np.nan
+    else:
+        scale = table['reference objective value'].abs().max()
+        shortfall = max(0., (table['reference objective value'] - table['objective value']).max())
+        summary['max relative objective value shortfall'] = shortfall/scale if scale > 0 else 0.
+    return table, summary
+
+
+def cheapest_fidelity(flux_list, settings, tolerance=0.01, num_samples=20, seed=None):
+
+    """This function validates the fast tiers on a sample of num_samples pairs, from the fastest one down, and
+       returns the first tier whose objective values fall short of the reference path by at most a relative
+       tolerance, and the validation summaries of all the tiers that were tried. Falls back to the reference
+       tier."""
+
+    summaries = {}
+    for fidelity in fidelity_tiers[:0:-1]:
+        table, summaries[fidelity] = validate_fidelity(flux_list, fidelity_settings(settings, fidelity), num_samples,
+                                                       seed)
+        if summaries[fidelity]['max relative objective value shortfall'] <= tolerance:
+            return fidelity, summaries
+    return 'reference', summaries
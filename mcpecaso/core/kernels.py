@@ -0,0 +1,175 @@
+import time
+import numpy as np
+import pandas as pd
+from copy import deepcopy
+
+try:
+    import numba
+    numba_available = True
+except ImportError:
+    numba_available = False
+
+__all__ = ['kernel_backends', 'numba_available', 'get_kernels', 'benchmark_kernels']
+
+kernel_backends = ['auto', 'numba', 'numpy', 'python']
+kinetics_codes = {'constant': 0, 'monod': 1}
+
+# Dormand-Prince 5(4) coefficients
+dopri_a = np.array([[0, 0, 0, 0, 0],
+                    [1/5, 0, 0, 0, 0],
+                    [3/40, 9/40, 0, 0, 0],
+                    [44/45, -56/15, 32/9, 0, 0],
+                    [19372/6561, -25360/2187, 64448/6561, -212/729, 0],
+                    [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656]])
+dopri_b = np.array([35/384, 0, 500/1113, 125/192, -2187/6784, 11/84])
+dopri_e = np.array([71/57600, 0, -71/16695, 71/1920, -17253/339200, 22/525, -1/40])
+
+
+def kinetic_rhs(concentrations, fluxes, kinetics, K_s):
+
+    """This function returns the time derivatives of the concentrations, like dfba_fun_kinetic, for the kinetics
+       with code kinetics (see kinetics_codes)."""
+
+    if concentrations[1] <= 0:
+        return 0.*fluxes
+    if kinetics == 1:
+        return concentrations[0]*concentrations[1]/(K_s + concentrations[1])*fluxes
+    return concentrations[0]*fluxes
+
+
+def dopri_step(concentrations, step, fluxes, kinetics, K_s, rtol, atol, a, b, e):
+
+    """This function takes one Dormand-Prince step and returns the new concentrations and the norm of the error
+       estimate relative to the tolerances (the step is accepted if it is at most one)."""
+
+    stages = np.empty((7, concentrations.shape[0]))
+    stages[0] = _kinetic_rhs(concentrations, fluxes, kinetics, K_s)
+    for i in range(1, 6):
+        state = concentrations.copy()
+        for j in range(i):
+            state += step*a[i, j]*stages[j]
+        stages[i] = _kinetic_rhs(state, fluxes, kinetics, K_s)
+    new_concentrations = concentrations.copy()
+    for j in range(6):
+        new_concentrations += step*b[j]*stages[j]
+    stages[6] = _kinetic_rhs(new_concentrations, fluxes, kinetics, K_s)
+    error = 0.
+    for i in range(concentrations.shape[0]):
+        estimate = 0.
+        for j in range(7):
+            estimate += step*e[j]*stages[j, i]
+        scale = atol + rtol*max(abs(concentrations[i]), abs(new_concentrations[i]))
+        error += (estimate/scale)**2
+    return new_concentrations, np.sqrt(error/concentrations.shape[0])
+
+
+def kinetic_stage(initial_concentrations, time, fluxes, kinetics, K_s, threshold, rtol, atol, a, b, e):
+
+    """This function integrates one stage with substrate dependent kinetics on the timepoints in time with an
+       adaptive Dormand-Prince method, which never steps past a timepoint, until the substrate drops to threshold.
+       The depletion time is located by bisection within the step that crosses it. Returns the data at the
+       timepoints that were reached (with the concentrations at the depletion time last, if it was reached), the
+       depletion time (np.inf if the substrate is left) and the number of timepoints before it."""
+
+    data = np.empty((initial_concentrations.shape[0], time.shape[0] + 1))
+    data[:, 0] = initial_concentrations
+    concentrations = initial_concentrations.copy()
+    current_time = time[0]
+    step = (time[-1] - time[0])*1e-3
+    for k in range(1, time.shape[0]):
+        while current_time < time[k]:
+            trial_step = min(step, time[k] - current_time)
+            new_concentrations, error = _dopri_step(concentrations, trial_step, fluxes, kinetics, K_s, rtol, atol,
+                                                   a, b, e)
+            if error > 1:
+                step = trial_step*max(0.2, 0.9*error**-0.2)
+                continue
+            if new_concentrations[1] < threshold:
+                lower, upper = 0., trial_step
+                for iteration in range(60):
+                    middle = (lower + upper)/2
+                    if _dopri_step(concentrations, middle, fluxes, kinetics, K_s, rtol, atol, a, b, e)[0][1] < \
+                            threshold:
+                        upper = middle
+                    else:
+                        lower = middle
+                data[:, k] = _dopri_step(concentrations, upper, fluxes, kinetics, K_s, rtol, atol, a, b, e)[0]
+                data[1, k] = min(data[1, k], threshold)
+                return data[:, :k + 1], current_time + upper, k
+            current_time += trial_step
+            concentrations = new_concentrations
+            if trial_step == step:
+                step = trial_step*min(5., 0.9*error**-0.2) if error > 0 else 5*trial_step
+        data[:, k] = concentrations
+    return data[:, :time.shape[0]], np.inf, time.shape[0]
+
+
+# The kernels call the compiled versions of each other when Numba is installed, and the plain functions otherwise
+if numba_available:
+    _kinetic_rhs = numba.njit(cache=True)(kinetic_rhs)
+    _dopri_step = numba.njit(cache=True)(dopri_step)
+    _kinetic_stage = numba.njit(cache=True)(kinetic_stage)
+else:
+    _kinetic_rhs, _dopri_step, _kinetic_stage = kinetic_rhs, dopri_step, kinetic_stage
+
+# With the numpy backend, stages with substrate dependent kinetics are integrated by solve_ivp, since the stage
+# integrator is slower than solve_ivp as a Python loop. The python backend runs it as a Python loop anyway, which
+# checks its results against the numpy backend without Numba (see benchmark_kernels)
+numpy_kernels = {'kinetic_stage': None}
+python_kernels = {'kinetic_stage': kinetic_stage}
+numba_kernels = {'kinetic_stage': _kinetic_stage}
+
+
+def get_kernels(settings):
+
+    """This function returns the kernels for settings.kernel_backend: compiled with Numba for 'numba' (and for
+       'auto' if Numba is installed), the NumPy and SciPy fallbacks for 'numpy' (and 'auto' otherwise), or the
+       uncompiled kernels for 'python'."""
+
+    backend = 'auto' if settings is None else settings.kernel_backend
+    if backend not in kernel_backends:
+        raise KeyError('Unknown kernel backend specified. Only ', kernel_backends, 'are acceptable kernel backends.')
+    if backend == 'numba' and not numba_available:
+        raise ImportError('The numba kernel backend needs Numba to be installed (pip install numba)')
+    if backend == 'numba' or (backend == 'auto' and numba_available):
+        return numba_kernels
+    if backend == 'python':
+        return python_kernels
+    return numpy_kernels
+
+
+def benchmark_kernels(flux_list, settings, backends=None, num_pairs=None, seed=None):
+
+    """This function simulates num_pairs two stage pairs of the global grid of flux_list (all of them if None, a
+       random sample otherwise) with every kernel backend in backends (all the available ones if None) and returns
+       a table with the time per pair, the speedup over the 'numpy' backend and the largest difference of the
+       objective values from it. The kernels are compiled before the timing starts."""
+
+    # Imported here since the fermentation classes depend on the modules that use the kernels
+    from .Fermentation import TwoStageFermentation
+    if backends is None:
+        backends = ['numpy'] + (['numba'] if numba_available else [])
+    num_points = len(flux_list)
+    grid_indices = np.arange(num_points*num_points)
+    if num_pairs is not None and num_pairs < len(grid_indices):
+        grid_indices = np.sort(np.random.RandomState(seed).choice(grid_indices, num_pairs, replace=False))
+    pairs = [(flux_list[index // num_points], flux_list[index % num_points]) for index in grid_indices]
+
+    rows = []
+    objectives = {}
+    for backend in backends:
+        backend_settings = deepcopy(settings)
+        backend_settings.kernel_backend = backend
+        TwoStageFermentation(pairs[0][0], pairs[0][1], backend_settings)
+        start_time = time.time()
+        objectives[backend] = np.array([TwoStageFermentation(stage_one_fluxes, stage_two_fluxes,
+                                                             backend_settings).objective_value
+                                        for stage_one_fluxes, stage_two_fluxes in pairs])
+        rows.append({'backend': backend, 'pairs': len(pairs), 'time per pair': (time.time() - start_time)/len(pairs)})
+    table = pd.DataFrame(rows)
+    if 'numpy' in backends:
+        reference = table.loc[table['backend'] == 'numpy', 'time per pair'].iloc[0]
+        table['speedup'] = reference/table['time per pair']
+        table['max objective difference'] = [np.nanmax(np.abs(objectives[backend] - objectives['numpy']))
+                                             for backend in backends]
+    return table
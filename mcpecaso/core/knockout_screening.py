@@ -0,0 +1,132 @@
+import numpy as np
+import pandas as pd
+from .substrate_dependent_envelopes import envelope_calculator
+from .sparse_lp import SparseLPModel, sparse_envelope_calculator
+from .switch_time_curves import switch_time_curves, rank_switch_time_curves, best_ranked_batch
+from .Fermentation import OneStageFermentation, TwoStageFermentation
+
+__all__ = ['apply_knockouts', 'screen_design', 'rank_designs']
+
+
+def apply_knockouts(model, knockouts, aliases=None):
+
+    """This function knocks out the given reaction or gene ids in model. Use it inside a `with model:` block so
+       that the knockouts are reverted afterwards. Ids in aliases are replaced by what they map to first, and ids
+       that map to None are skipped (see knockout_aliases for compressed models)."""
+
+    for knockout_id in knockouts:
+        if aliases and knockout_id in aliases:
+            knockout_id = aliases[knockout_id]
+            if knockout_id is None:
+                continue
+        if model.reactions.has_id(knockout_id):
+            model.reactions.get_by_id(knockout_id).knock_out()
+        elif model.genes.has_id(knockout_id):
+            model.genes.get_by_id(knockout_id).knock_out()
+        else:
+            raise KeyError('Unknown reaction or gene ' + str(knockout_id) + ' in knockout set')
+
+
+def best_strategies(flux_list, settings):
+
+    """This function returns the best two stage and one stage batches of an envelope as dictionaries of metrics.
+       The stored switch time curves are ranked for constant kinetics, otherwise the global grid is simulated."""
+
+    if settings.kinetics == 'constant':
+        two_stage_table, one_stage_table = rank_switch_time_curves(switch_time_curves(flux_list, settings), settings)
+        two_stage = best_ranked_batch(two_stage_table)
+        one_stage = best_ranked_batch(one_stage_table, two_stage=False)
+        return (None if two_stage is None else dict(two_stage)), (None if one_stage is None else dict(one_stage))
+
+    two_stage = None
+    for stage_one_fluxes in flux_list:
+        for stage_two_fluxes in flux_list:
+            if stage_one_fluxes == stage_two_fluxes:
+                continue
+            ferm = TwoStageFermentation(stage_one_fluxes, stage_two_fluxes, settings)
+            if ferm.constraint_flag and (two_stage is None or ferm.objective_value > two_stage['objective value']):
+                two_stage = {'stage_one_growth_rate': stage_one_fluxes[0], 'stage_two_growth_rate': stage_two_fluxes[0],
+                             'productivity': ferm.batch_productivity, 'yield': ferm.batch_yield,
+                             'titer': ferm.batch_titer, 'objective value': ferm.objective_value,
+                             'optimal switch time': ferm.optimal_switch_time}
+    one_stage = None
+    for fluxes in flux_list:
+        ferm = OneStageFermentation(fluxes, settings)
+        if ferm.constraint_flag and (one_stage is None or ferm.objective_value > one_stage['objective value']):
+            one_stage = {'growth_rate': fluxes[0], 'productivity': ferm.batch_productivity,
+                         'yield': ferm.batch_yield, 'titer': ferm.batch_titer, 'objective value': ferm.objective_value}
+    return two_stage, one_stage
+
+
+def screen_design(model, biomass_rxn_id, substrate_rxn_id, target_rxn_id, knockouts, settings, aliases=None):
+
+    """This function evaluates one knockout set on model. The knockouts are applied in a `with model:` block, and
+       the maximum target flux is solved first: designs that are infeasible or cannot make the target are returned
+       straight away, without an envelope or strategies, and so are designs with ids that are not in the model.
+       Returns a dictionary of results."""
+
+    result = {'knockouts': ', '.join(knockouts), 'status': 'ok', 'max_target_flux': np.nan, 'max_growth': np.nan}
+    with model:
+        try:
+            apply_knockouts(model, knockouts, aliases)
+        except KeyError:
+            result['status'] = 'unknown knockout'
+            return result
+        model.objective = target_rxn_id
+        solution = model.optimize(objective_sense='maximize')
+        if model.solver.status != 'optimal':
+            result['status'] = 'infeasible'
+            return result
+        result['max_target_flux'] = solution.objective_value
+        if solution.objective_value <= 1e-9:
+            result['status'] = 'no production'
+            return result
+
+        model.objective = biomass_rxn_id
+        if settings.lp_backend == 'highs':
+            envelope = sparse_envelope_calculator(SparseLPModel(model), biomass_rxn_id, substrate_rxn_id,
+                                                  target_rxn_id, settings)
+        else:
+            envelope = envelope_calculator(model, model.reactions.get_by_id(biomass_rxn_id),
+                                           model.reactions.get_by_id(substrate_rxn_id),
+                                           model.reactions.get_by_id(target_rxn_id), settings)
+    envelope = pd.DataFrame(envelope)
+    result['max_growth'] = envelope['growth_rates'].max()
+    flux_list = [[envelope['growth_rates'][i], -envelope['substrate_uptake_rates'][i],
+                  envelope['production_rates_ub'][i]] for i in range(len(envelope))]
+
+    two_stage, one_stage = best_strategies(flux_list, settings)
+    for stage, batch, keys in [('two_stage', two_stage, ['stage_one_growth_rate', 'stage_two_growth_rate',
+                                                         'optimal switch time']),
+                               ('one_stage', one_stage, ['growth_rate'])]:
+        for key in ['productivity', 'yield', 'titer', 'objective value'] + keys:
+            result[stage + '_' + key.replace(' ', '_')] = np.nan if batch is None else batch[key]
+    return result
+
+
+def screen_design_chunk(model, biomass_rxn_id, substrate_rxn_id, target_rxn_id, knockout_sets, aliases, settings):
+
+    """This function evaluates a list of (index, knockout set) on one model copy, one design after another. The
+       settings come last, as in all the tasks of mcPECASO.run_tasks."""
+
+    results = []
+    for index, knockouts in knockout_sets:
+        result = screen_design(model, biomass_rxn_id, substrate_rxn_id, target_rxn_id, knockouts, settings, aliases)
+        result['design'] = index
+        results.append(result)
+    return results
+
+
+def rank_designs(results):
+
+    """This function returns the results of screened designs as a table sorted by the two stage objective, then
+       the one stage objective. Designs without a feasible strategy are placed last."""
+
+    table = pd.DataFrame(results)
+    if 'two_stage_objective_value' not in table:
+        table['two_stage_objective_value'] = np.nan
+        table['one_stage_objective_value'] = np.nan
+    table = table.sort_values(['two_stage_objective_value', 'one_stage_objective_value', 'design'],
+                              ascending=[False, False, True], na_position='last', ignore_index=True)
+    table.insert(0, 'rank', np.arange(1, len(table) + 1))
+    return table
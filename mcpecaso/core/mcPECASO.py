@@ -1,15 +1,52 @@
 import cobra
+import numpy as np
 import pandas as pd
-from .substrate_dependent_envelopes import envelope_calculator
+from .substrate_dependent_envelopes import multi_target_envelope_calculator
+from .sparse_lp import SparseLPModel, sparse_multi_target_envelope_calculator
 from .Fermentation import *
+from .multi_stage import optimal_multi_stage_strategies
+from .switch_time_curves import switch_time_curves, rank_switch_time_curves, best_ranked_batch
+from .warm_start import extrema_initial_guesses
+from .two_stage_dfba import closed_form_integration
+from .knockout_screening import screen_design_chunk, rank_designs
+from .candidate_reduction import DominatedTwoStageFermentation, two_stage_candidates, expand_two_stage_grid
+from .fidelity import validate_fidelity, cheapest_fidelity
+from .model_compression import compress_cobra_model, verify_compression, knockout_aliases
+from .envelope_surface import EnvelopeSurface, production_rate_bounds
+from .sensitivity import best_batch_sensitivities
+from .uncertainty import EnvelopeLPCache, uptake_uncertainty, confidence_summary, envelope_confidence_band
 from joblib import Parallel, delayed
 import multiprocessing
 import time
 import warnings
-from .settings import settings
+from .settings import settings, settings_dependencies
 from copy import deepcopy
 
 
+def extrema_task(lp_model, max_growth, biomass_rxn_id, substrate_rxn_id, target_rxn_id, extrema_type,
+                 initial_guesses, settings):
+
+    """This function runs one FermentationExtrema search. The reactions are passed by id so that they are looked up
+       in the model the task runs on, which is a copy when the task runs in another process or thread."""
+
+    if isinstance(lp_model, SparseLPModel):
+        reactions = [biomass_rxn_id, substrate_rxn_id, target_rxn_id]
+    else:
+        reactions = [lp_model.reactions.get_by_id(rxn_id) for rxn_id in [biomass_rxn_id, substrate_rxn_id,
+                                                                          target_rxn_id]]
+    return FermentationExtrema(lp_model, max_growth, *reactions, settings, extrema_type, initial_guesses)
+
+
+def thread_safe_batches(settings, two_stage=False):
+
+    """This function returns True if one stage (or with two_stage, two stage) batches can run on threads for the
+       given settings. odeint, LSODA and COBYLA wrap Fortran code that SciPy does not guarantee to be re-entrant,
+       so only the closed form timecourses and, for two stage batches, the sampled switch times of the 'fastest'
+       fidelity tier qualify."""
+
+    return closed_form_integration(settings) and (not two_stage or settings.fidelity == 'fastest')
+
+
 class mcPECASO(object):
 
     def __init__(self, **kwargs):
@@ -17,8 +54,15 @@ class mcPECASO(object):
         self.biomass_rxn = None
         self.substrate_rxn = None
         self.target_rxn = None
+        self.target_rxns = []
         self.condition = 'None'
         self.production_envelope = None
+        self.production_envelopes = {}
+        self.sparse_model = None
+        self.sparse_model_source = None
+        self.uncompressed_model = None
+        self.compression_report = None
+        self.knockout_aliases = {}
         self.model_complete_flag = False
         self.two_stage_fermentation_list = []
         self.one_stage_fermentation_list = []
@@ -40,14 +84,54 @@ class mcPECASO(object):
                                           'yield': [],
                                           'titer': [],
                                           'objective value': []}
+        self.two_stage_product_characteristics = {'target': [],
+                                                  'stage_one_growth_rate': [],
+                                                  'stage_two_growth_rate': [],
+                                                  'productivity': [],
+                                                  'yield': [],
+                                                  'titer': [],
+                                                  'objective value': []}
+        self.one_stage_product_characteristics = {'target': [],
+                                                  'growth_rate': [],
+                                                  'productivity': [],
+                                                  'yield': [],
+                                                  'titer': [],
+                                                  'objective value': []}
+        self.two_stage_product_best_batches = {}
+        self.one_stage_product_best_batches = {}
+        self.multi_stage_strategies = {}
+        self.multi_stage_comparison = None
+        self.envelope_lp_cache = None
+        self.envelope_lp_cache_source = None
+        self.envelope_surface = None
+        self.envelope_surface_source = None
+        self.switch_time_curves = None
+        self.two_stage_ranking = None
+        self.one_stage_ranking = None
+        self.two_stage_ranked_best = None
+        self.one_stage_ranked_best = None
+        self.knockout_screen = None
+        self.artifact_states = {}
+        self.computed_fermentations = {}
+        self.uncertainty_samples = None
+        self.uncertainty_summary = None
+        self.uncertainty_envelope_band = None
+        self.sensitivities = None
+        self.fidelity_validation = None
+        self.fidelity_validation_summary = None
         self.continuous_flag = False
 
         for key in kwargs:
 
-            if key in ['model', 'biomass_rxn', 'substrate_rxn', 'target_rxn', 'condition']:
+            if key in ['model', 'biomass_rxn', 'substrate_rxn', 'target_rxn', 'target_rxns', 'condition']:
                 setattr(self, key, kwargs[key])
 
-        self.calculate_production_envelope()
+        if self.target_rxns and self.target_rxn is None:
+            self.target_rxn = self.target_rxns[0]
+
+        # The envelope can be deferred (calculate_envelope=False) so that it is computed by an executor instead
+        if kwargs.get('calculate_envelope', True):
+            self.calculate_production_envelope()
 
     def check_model_complete(self):
         self.model_complete_flag = False
@@ -71,18 +155,177 @@ class mcPECASO(object):
                   "and its parent is the model.")
             flag = False
 
+        for target_rxn in self.target_rxns:
+            if type(target_rxn) != cobra.core.reaction.Reaction or target_rxn.model != self.model:
+                print("Please check your target reaction objects. Ensure that they are standard cobra Reaction "
+                      "objects and their parent is the model.")
+                flag = False
+                break
+
         if flag:
             print("The model is complete.")
             self.model_complete_flag = True
         else:
             warnings.warn("The model is incomplete. Please check to ensure all the required fields are present.")
 
-    def calculate_production_envelope(self):
+    def artifact_state(self, artifact):
+        """Returns what a computed result depends on: the values of its settings (see settings_dependencies) and the
+           model inputs or upstream results it was calculated from, which are compared by identity."""
+        values = {field: deepcopy(getattr(self.settings, field)) for field in settings_dependencies[artifact]}
+        if artifact in ['model_check', 'production_envelope']:
+            inputs = [self.model, self.biomass_rxn, self.substrate_rxn, self.target_rxn] + list(self.target_rxns)
+        else:
+            inputs = [self.production_envelope]
+        return values, inputs
+
+    def mark_computed(self, artifact):
+        self.artifact_states[artifact] = self.artifact_state(artifact)
+
+    def is_stale(self, artifact):
+        """Returns True if a result has not been calculated yet or one of its dependencies has changed since."""
+        if artifact not in self.artifact_states:
+            return True
+        if artifact == 'production_envelope' and self.production_envelope is None:
+            return True
+        values, inputs = self.artifact_states[artifact]
+        current_values, current_inputs = self.artifact_state(artifact)
+        return values != current_values or len(inputs) != len(current_inputs) or \
+            any(a is not b for a, b in zip(inputs, current_inputs))
+
+    def invalidate(self, artifact=None):
+        """Marks a result (all results if None) to be recalculated, e.g. after the model was changed in place.
+           Results that depend on it are recalculated as well."""
+        if artifact is None:
+            self.artifact_states = {}
+        else:
+            self.artifact_states.pop(artifact, None)
+        if artifact in [None, 'model_check', 'production_envelope']:
+            self.sparse_model = None
+            self.envelope_surface = None
+            self.envelope_lp_cache = None
+
+    def compress_model(self, num_verification_points=5, tolerance=1e-6):
+        """Replaces the model with a compressed copy for all the following LPs (see compress_cobra_model): blocked
+           reactions are removed, directions that cannot carry flux are closed and linear pathways are lumped. The
+           biomass, substrate and target reactions are kept exact. The maximum growth rate and the target flux
+           ranges of both models are compared at num_verification_points envelope growth rates first, and the model
+           is only replaced if they agree within tolerance. The original model is kept in uncompressed_model.
+           Returns the compression report."""
         self.check_model_complete()
+        if not self.model_complete_flag:
+            warnings.warn("The model could not be compressed. This is likely due to missing fields in the model.")
+            return None
+
+        target_ids = [self.target_rxn.id] + [rxn.id for rxn in self.target_rxns if rxn.id != self.target_rxn.id]
+        start_time = time.time()
+        compressed, report = compress_cobra_model(self.model, self.biomass_rxn.id, self.substrate_rxn.id, target_ids)
+        report['difference'] = verify_compression(self.model, compressed, self.biomass_rxn.id, self.substrate_rxn.id,
+                                                  target_ids, self.settings, num_verification_points)
+        report['verified'] = report['difference'] <= tolerance
+        self.compression_report = report
+        print("Completed compression in ", str(time.time()-start_time), "s")
+        if not report['verified']:
+            warnings.warn("The compressed model changed the envelope by " + str(report['difference']) +
+                          ". The original model is kept.")
+            return report
+
+        aliases = knockout_aliases(self.model, compressed, report)
+        self.knockout_aliases = {knockout_id: aliases.get(alias, alias) if alias is not None else None
+                                 for knockout_id, alias in self.knockout_aliases.items()}
+        self.knockout_aliases.update(aliases)
+        self.uncompressed_model = self.model
+        self.model = compressed
+        self.biomass_rxn = compressed.reactions.get_by_id(self.biomass_rxn.id)
+        self.substrate_rxn = compressed.reactions.get_by_id(self.substrate_rxn.id)
+        self.target_rxn = compressed.reactions.get_by_id(self.target_rxn.id)
+        self.target_rxns = [compressed.reactions.get_by_id(rxn.id) for rxn in self.target_rxns]
+        print("Compressed the model from ", report['reactions'][0], " to ", report['reactions'][1], " reactions")
+        return report
+
+    def get_lp_model(self):
+        """Returns the model the LPs are solved on for the LP backend selected in the settings. For the 'highs'
+           backend, the sparse representation of the model is extracted once and reused."""
+        if self.settings.lp_backend == 'highs':
+            if self.sparse_model is None or self.sparse_model_source is not self.model:
+                self.sparse_model = SparseLPModel(self.model)
+                self.sparse_model_source = self.model
+            return self.sparse_model
+        elif self.settings.lp_backend == 'cobra':
+            return self.model
+        else:
+            raise Exception('Unknown LP backend')
+
+    def get_envelope_surface(self, lp_model=None):
+        """Returns the growth rate x substrate uptake surface of the target fluxes (see EnvelopeSurface) that the
+           envelopes are interpolated from when settings.envelope_surface is set. The surface does not depend on the
+           uptake model, so it is only solved again when the model, the reactions, the LP backend or the surface
+           settings change. If lp_model is given (a copy of the model for a worker thread), a new surface is solved
+           on it rather than on get_lp_model()."""
+        target_rxns = [self.target_rxn] + [rxn for rxn in self.target_rxns if rxn.id != self.target_rxn.id]
+        source = [self.get_lp_model(), self.biomass_rxn, self.substrate_rxn] + target_rxns
+        surface_settings = [self.settings.surface_growth_points, self.settings.surface_uptake_points,
+                            self.settings.surface_max_uptake]
+        if self.envelope_surface is None or self.envelope_surface_source[1] != surface_settings or \
+                len(self.envelope_surface_source[0]) != len(source) or \
+                any(a is not b for a, b in zip(self.envelope_surface_source[0], source)):
+            start_time = time.time()
+            if lp_model is None or isinstance(lp_model, SparseLPModel):
+                self.envelope_surface = EnvelopeSurface(source[0], self.biomass_rxn, self.substrate_rxn, target_rxns,
+                                                        *surface_settings)
+            else:
+                reactions = [lp_model.reactions.get_by_id(rxn.id)
+                             for rxn in [self.biomass_rxn, self.substrate_rxn] + target_rxns]
+                self.envelope_surface = EnvelopeSurface(lp_model, reactions[0], reactions[1], reactions[2:],
+                                                        *surface_settings)
+            self.envelope_surface_source = (source, surface_settings)
+            print("Completed envelope surface in ", str(time.time()-start_time), "s")
+        return self.envelope_surface
+
+    def get_envelope_lp_cache(self):
+        """Returns the EnvelopeLPCache of the uncertainty analysis. Like the envelope surface, it is only built again
+           when the model, the reactions, the LP backend, the condition or the number of points change, or after
+           invalidate()."""
+        lp_model = self.get_lp_model()
+        source = [lp_model, self.biomass_rxn, self.substrate_rxn, self.target_rxn]
+        cache_settings = [self.settings.num_points, self.condition]
+        if self.envelope_lp_cache is None or self.envelope_lp_cache_source[1] != cache_settings or \
+                any(a is not b for a, b in zip(self.envelope_lp_cache_source[0], source)):
+            self.envelope_lp_cache = EnvelopeLPCache(lp_model, self.biomass_rxn, self.substrate_rxn, self.target_rxn,
+                                                     self.settings.num_points)
+            self.envelope_lp_cache_source = (source, cache_settings)
+        return self.envelope_lp_cache
+
+    def production_envelope_data(self, lp_model=None):
+        """Returns the envelope data of the target reaction and every reaction in target_rxns, keyed by reaction id.
+           The envelopes are interpolated from the envelope surface if settings.envelope_surface is set and solved
+           with the envelope LPs otherwise. The LPs are solved on lp_model if given (e.g. a copy of the model for a
+           worker thread, see AnalysisService) and on get_lp_model() otherwise."""
+        target_rxns = [self.target_rxn] + [rxn for rxn in self.target_rxns if rxn.id != self.target_rxn.id]
+        if self.settings.envelope_surface:
+            return self.get_envelope_surface(lp_model).envelopes(self.settings.uptake_fun, self.settings.uptake_params,
+                                                                 self.settings.num_points)
+        if lp_model is None:
+            lp_model = self.get_lp_model()
+        if isinstance(lp_model, SparseLPModel):
+            return sparse_multi_target_envelope_calculator(lp_model, self.biomass_rxn, self.substrate_rxn,
+                                                           target_rxns, self.settings)
+        reactions = [lp_model.reactions.get_by_id(rxn.id) for rxn in [self.biomass_rxn, self.substrate_rxn] +
+                     target_rxns]
+        return multi_target_envelope_calculator(lp_model, reactions[0], reactions[1], reactions[2:], self.settings)
+
+    def set_production_envelopes(self, envelopes):
+        self.production_envelopes = {rxn_id: pd.DataFrame(envelopes[rxn_id]) for rxn_id in envelopes}
+        self.production_envelope = self.production_envelopes[self.target_rxn.id]
+        self.switch_time_curves = None
+        self.mark_computed('production_envelope')
+
+    def calculate_production_envelope(self):
+        self.switch_time_curves = None
+        if self.is_stale('model_check'):
+            self.check_model_complete()
+            self.mark_computed('model_check')
         if self.model_complete_flag:
-            self.production_envelope = pd.DataFrame(envelope_calculator(self.model, self.biomass_rxn,
-                                                                        self.substrate_rxn, self.target_rxn,
-                                                                        self.settings))
+            self.set_production_envelopes(self.production_envelope_data())
         else:
             warnings.warn("The production envelope could not be generated.")
 
@@ -106,6 +349,8 @@ class mcPECASO(object):
         self.two_stage_characteristics['titer'].append(two_stage_fermentation.batch_titer)
         self.two_stage_characteristics['objective value'].append(two_stage_fermentation.objective_value)
 
+        if isinstance(two_stage_fermentation, DominatedTwoStageFermentation):
+            return
         if not two_stage_fermentation.constraint_flag:
             self.two_stage_constraint_flag = False
             warnings.warn("The constraints set for the fermentation metrics could not be met for one or more one stage "
@@ -154,10 +399,7 @@ class mcPECASO(object):
             else:
                 self.one_stage_best_batch = one_stage_fermentation
 
-    def calculate_fermentation_characteristics(self):
-        if self.production_envelope is None:
-            self.calculate_production_envelope()
-
+    def update_objective_name(self):
         objective_name = ''
         if self.settings.productivity_coefficient:
             objective_name += str(self.settings.productivity_coefficient) + ' * productivity + '
@@ -176,61 +418,394 @@ class mcPECASO(object):
             warnings.warn("Please check your objective. The objective provided in the settings class isn't valid.")
             self.objective_name = objective_dict['batch_productivity']
 
+    def get_flux_list(self):
+        """Returns the [growth, substrate, product] flux vectors of the production envelope points."""
+        envelope = self.production_envelope
+        flux_list = [list(envelope[['growth_rates', 'substrate_uptake_rates', 'production_rates_ub']].iloc[i])
+                     for i in range(len(envelope))]
+        for i in range(len(flux_list)):
+            flux_list[i][1] = -flux_list[i][1]
+        return flux_list
+
+    def set_fermentation_results(self, os_ferm_list, ts_ferm_list):
+        """Replaces the fermentation results with the given one stage and two stage fermentations. The two stage
+           list should be ordered by stage one index, then stage two index."""
+        self.two_stage_fermentation_list = []
+        self.one_stage_fermentation_list = []
+        self.two_stage_suboptimal_batch = None
+        self.two_stage_best_batch = None
+        self.one_stage_best_batch = None
+        self.two_stage_constraint_flag = True
+        self.one_stage_constraint_flag = True
+        for key in self.two_stage_characteristics:
+            self.two_stage_characteristics[key] = []
+        for key in self.one_stage_characteristics:
+            self.one_stage_characteristics[key] = []
+        for ts_ferm in ts_ferm_list:
+            self.add_two_stage_fermentation(ts_ferm)
+        for os_ferm in os_ferm_list:
+            self.add_one_stage_fermentation(os_ferm)
+
+    def run_tasks(self, function, arguments, thread_safe=True):
+        """Calls function(*args, settings) for every tuple of args in arguments and returns the results in order.
+           If settings.parallel is set, the calls run on a joblib pool of settings.num_workers (all cores if None)
+           processes or, with settings.parallel_backend = 'threads', threads. Threads avoid process startup and the
+           pickling of the settings, models and results, but they are only used for tasks that the caller marks as
+           thread_safe: the LP and closed form paths. Tasks that integrate with odeint or LSODA or optimize with
+           COBYLA (see thread_safe_batches) run on processes instead, since SciPy does not guarantee that these are
+           re-entrant. All the calls share one copy of the settings that is taken before they start and is only
+           read, so the settings can be changed while a pool is running."""
+        settings_snapshot = deepcopy(self.settings)
+        if not settings_snapshot.parallel:
+            return [function(*(args + (settings_snapshot,))) for args in arguments]
+
+        if settings_snapshot.parallel_backend == 'threads' and not thread_safe:
+            warnings.warn('These tasks use odeint, LSODA or COBYLA, which are not guaranteed to be thread safe. '
+                          'They run on processes instead of threads.')
+            backend = 'loky'
+        elif settings_snapshot.parallel_backend == 'threads':
+            backend = 'threading'
+        elif settings_snapshot.parallel_backend == 'processes':
+            backend = 'loky'
+        else:
+            raise Exception('Unknown parallel backend')
+        num_workers = settings_snapshot.num_workers or multiprocessing.cpu_count()
+        print('Starting parallel pool')
+        return Parallel(n_jobs=num_workers, backend=backend, verbose=5)(
+            delayed(function)(*(args + (settings_snapshot,))) for args in arguments)
+
+    def calculate_fermentation_characteristics(self):
+        """Calculates the one stage and two stage (or extrema) batches of the production envelope. Results are kept
+           between calls, and only the ones whose settings (see settings_dependencies) or inputs have changed are
+           recalculated: changing the objective reruns the batches but not the envelope LPs, and changing the
+           uptake parameters reruns the envelope without checking the model again. Use invalidate after changing
+           the model in place."""
+        if self.is_stale('production_envelope'):
+            self.calculate_production_envelope()
+
+        self.update_objective_name()
+
         if self.production_envelope is not None:
-            self.two_stage_fermentation_list = []
-            self.one_stage_fermentation_list = []
-            self.two_stage_suboptimal_batch = None
-            self.two_stage_best_batch = None
-            self.one_stage_best_batch = None
-            envelope = self.production_envelope
-            flux_list = [list(envelope[['growth_rates', 'substrate_uptake_rates', 'production_rates_ub']].iloc[i])
-                         for i in range(len(envelope))]
-            for i in range(len(flux_list)):
-                flux_list[i][1] = -flux_list[i][1]
+            flux_list = self.get_flux_list()
+            start_time = time.time()
             if self.settings.scope == 'global':
-                if self.settings.parallel:
-                    print('Starting parallel pool')
-                    num_cores = multiprocessing.cpu_count()
-                    start_time = time.time()
-                    os_ferm_list = Parallel(n_jobs=num_cores, verbose=5)(
-                        delayed(OneStageFermentation)(flux_list[index], self.settings)
-                        for index in range(len(flux_list)))
-                    ts_ferm_list = Parallel(n_jobs=num_cores, verbose=5)(
-                        delayed(TwoStageFermentation)(flux_list[stage_one_index], flux_list[stage_two_index], self.settings)
-                        for stage_one_index in range(len(flux_list))
-                        for stage_two_index in range(len(flux_list)))
-                    end_time = time.time()
-                else:
-                    start_time = time.time()
-                    os_ferm_list = [OneStageFermentation(flux_list[index], self.settings)
-                                    for index in range(len(flux_list))]
-                    ts_ferm_list = [TwoStageFermentation(flux_list[stage_one_index], flux_list[stage_two_index], self.settings)
-                                    for stage_one_index in range(len(flux_list))
-                                    for stage_two_index in range(len(flux_list))]
-                    end_time = time.time()
+                if self.is_stale('one_stage'):
+                    self.computed_fermentations['one_stage'] = self.run_tasks(
+                        OneStageFermentation, [(flux_list[index],) for index in range(len(flux_list))],
+                        thread_safe_batches(self.settings))
+                    self.mark_computed('one_stage')
+                if self.is_stale('two_stage'):
+                    flux_pairs, grid = two_stage_candidates(flux_list, self.settings)
+                    self.computed_fermentations['two_stage'] = expand_two_stage_grid(
+                        flux_list, grid, self.run_tasks(TwoStageFermentation, flux_pairs,
+                                                        thread_safe_batches(self.settings, two_stage=True)),
+                        self.settings)
+                    self.mark_computed('two_stage')
+                    if self.settings.fidelity != 'reference' and self.settings.fidelity_validation_samples:
+                        self.validate_fidelity(self.settings.fidelity_validation_samples)
+                os_ferm_list = self.computed_fermentations['one_stage']
+                ts_ferm_list = self.computed_fermentations['two_stage']
+                end_time = time.time()
             elif self.settings.scope == 'extrema':
-                start_time = time.time()
-                max_growth = max(self.production_envelope.growth_rates)
-                ts_ferm_list = []
-                os_ferm_list = []
-                ts_ferm_list.append(FermentationExtrema(self.model, max_growth, self.biomass_rxn, self.substrate_rxn,
-                                                        self.target_rxn, self.settings, 'ts_best'))
-                ts_ferm_list.append(FermentationExtrema(self.model, max_growth, self.biomass_rxn, self.substrate_rxn,
-                                                        self.target_rxn, self.settings, 'ts_sub'))
-                os_ferm_list.append(FermentationExtrema(self.model, max_growth, self.biomass_rxn, self.substrate_rxn,
-                                                        self.target_rxn, self.settings, 'os_best'))
+                if self.is_stale('extrema'):
+                    max_growth = max(self.production_envelope.growth_rates)
+                    lp_model = self.get_lp_model()
+                    extrema_types = ['ts_best', 'ts_sub', 'os_best']
+                    if self.settings.extrema_warm_start or self.settings.fidelity != 'reference':
+                        initial_guesses = extrema_initial_guesses(flux_list, max_growth, self.settings)
+                    else:
+                        initial_guesses = {extrema_type: None for extrema_type in extrema_types}
+                    # The extrema searches use COBYLA, so they never run on threads
+                    self.computed_fermentations['extrema'] = self.run_tasks(
+                        extrema_task, [(lp_model, max_growth, self.biomass_rxn.id, self.substrate_rxn.id,
+                                        self.target_rxn.id, extrema_type, initial_guesses[extrema_type])
+                                       for extrema_type in extrema_types], thread_safe=False)
+                    self.mark_computed('extrema')
+                ts_ferm_list = self.computed_fermentations['extrema'][:2]
+                os_ferm_list = self.computed_fermentations['extrema'][2:]
                 end_time = time.time()
             else:
                 raise Exception('Unknown Scope')
 
             time.sleep(0.5)
             print("Completed analysis in ", str(end_time-start_time), "s")
-            for ts_ferm in ts_ferm_list:
-                self.add_two_stage_fermentation(ts_ferm)
-            for os_ferm in os_ferm_list:
-                self.add_one_stage_fermentation(os_ferm)
+            self.set_fermentation_results(os_ferm_list, ts_ferm_list)
+
+        else:
+            warnings.warn("A production envelope could not be generated for the given model. This is likely due to "
+                          "missing fields in the model.")
+
+    def validate_fidelity(self, num_samples=20, seed=None):
+        """Reruns a random sample of num_samples pairs of the global grid on the reference path (odeint and COBYLA)
+           and compares them with the results of the fidelity tier in the settings. The comparison is stored in
+           fidelity_validation and its largest differences in fidelity_validation_summary, which is returned. Warns
+           if the objective values fall short of the reference by more than settings.fidelity_tolerance
+           (relative)."""
+        if self.is_stale('production_envelope'):
+            self.calculate_production_envelope()
+        ts_ferm_list = None if self.is_stale('two_stage') else self.computed_fermentations['two_stage']
+        self.fidelity_validation, self.fidelity_validation_summary = validate_fidelity(
+            self.get_flux_list(), self.settings, num_samples, seed, ts_ferm_list)
+        shortfall = self.fidelity_validation_summary['max relative objective value shortfall']
+        if shortfall > self.settings.fidelity_tolerance:
+            warnings.warn("The objective values of the " + str(self.settings.fidelity) + " fidelity tier fall short of "
+                          "the reference path by up to " + str(shortfall) + " (relative). Consider a higher "
+                          "fidelity.")
+        return self.fidelity_validation_summary
+
+    def select_fidelity(self, tolerance=None, num_samples=20, seed=None):
+        """Sets settings.fidelity to the cheapest tier whose objective values fall short of the reference path by at
+           most tolerance (relative, default settings.fidelity_tolerance) on a random sample of num_samples pairs of
+           the global grid (see cheapest_fidelity). Returns the validation summaries of the tiers that were tried."""
+        if self.is_stale('production_envelope'):
+            self.calculate_production_envelope()
+        if tolerance is None:
+            tolerance = self.settings.fidelity_tolerance
+        self.settings.fidelity, summaries = cheapest_fidelity(self.get_flux_list(), self.settings, tolerance,
+                                                              num_samples, seed)
+        print("Selected the " + self.settings.fidelity + " fidelity tier")
+        return summaries
+
+    def calculate_switch_time_curves(self, num_switch_times=200):
+        """Samples the metrics of every two stage pair of the production envelope against the switch time (see
+           switch_time_curves) so that the grid can be ranked again under other objectives and constraints."""
+        if self.is_stale('production_envelope'):
+            self.calculate_production_envelope()
+        if self.production_envelope is None:
+            warnings.warn("A production envelope could not be generated for the given model. This is likely due to "
+                          "missing fields in the model.")
+            return None
+        self.switch_time_curves = switch_time_curves(self.get_flux_list(), self.settings, num_switch_times)
+        return self.switch_time_curves
+
+    def rerank_fermentation_characteristics(self, num_switch_times=200):
+        """Ranks the one stage and two stage batches of the envelope under the objective, coefficients and
+           constraints currently in the settings, using the stored switch time curves. The curves are only sampled
+           again if they are missing or the initial concentrations or batch time have changed, so changing the
+           objective or the constraints only takes milliseconds. The tables are sorted by objective value and stored
+           in two_stage_ranking and one_stage_ranking; two_stage_ranked_best and one_stage_ranked_best hold the
+           best rows that meet the constraints. Returns the two stage table."""
+        initial_concentrations = [self.settings.initial_biomass, self.settings.initial_substrate,
+                                  self.settings.initial_product]
+        curves = self.switch_time_curves
+        if (curves is None or list(curves['initial_concentrations']) != initial_concentrations or
+                curves['time_end'] != self.settings.time_end or curves['auto_time_end'] != self.settings.auto_time_end):
+            curves = self.calculate_switch_time_curves(num_switch_times)
+        if curves is None:
+            return None
+
+        self.update_objective_name()
+        two_stage_ranking, one_stage_ranking = rank_switch_time_curves(curves, self.settings)
+        self.two_stage_ranked_best = best_ranked_batch(two_stage_ranking)
+        self.one_stage_ranked_best = best_ranked_batch(one_stage_ranking, two_stage=False)
+        self.two_stage_ranking = two_stage_ranking.sort_values('objective value', ascending=False, ignore_index=True)
+        self.one_stage_ranking = one_stage_ranking.sort_values('objective value', ascending=False, ignore_index=True)
+        if not two_stage_ranking['constraint flag'].all() or not one_stage_ranking['constraint flag'].all():
+            warnings.warn("The constraints set for the fermentation metrics could not be met for one or more "
+                          "fermentation batches. These batches were not considered while determining the best batch.")
+        return self.two_stage_ranking
+
+    def screen_knockouts(self, knockout_sets):
+        """Screens a list of knockout sets (lists of reaction or gene ids) through the envelope and strategy
+           pipeline and returns a table of the designs ranked by the best two stage objective. Every worker of the
+           pool in the settings (or the serial loop) gets its own copy of the model, applies each knockout set in a
+           `with model:` block and skips the envelope of designs that are infeasible or cannot make the target.
+           After compress_model, ids of removed or lumped reactions are mapped to the compressed model (see
+           knockout_aliases), and designs with unknown ids get the status 'unknown knockout'. The table is stored
+           in knockout_screen."""
+        self.check_model_complete()
+        if not self.model_complete_flag:
+            warnings.warn("The knockouts could not be screened for the given model. This is likely due to missing "
+                          "fields in the model.")
+            return None
 
+        self.update_objective_name()
+        start_time = time.time()
+        designs = [(index, [getattr(knockout, 'id', knockout) for knockout in knockouts])
+                   for index, knockouts in enumerate(knockout_sets)]
+        if self.settings.parallel:
+            num_chunks = min(self.settings.num_workers or multiprocessing.cpu_count(), len(designs))
         else:
+            num_chunks = 1
+        chunk_results = self.run_tasks(screen_design_chunk,
+                                       [(self.model.copy() if num_chunks > 1 else self.model, self.biomass_rxn.id,
+                                         self.substrate_rxn.id, self.target_rxn.id, designs[chunk::num_chunks],
+                                         self.knockout_aliases)
+                                        for chunk in range(num_chunks)],
+                                       self.settings.kinetics == 'constant')
+        self.knockout_screen = rank_designs([result for results in chunk_results for result in results])
+        print("Completed analysis in ", str(time.time()-start_time), "s")
+        return self.knockout_screen
+
+    def calculate_product_characteristics(self):
+        """Calculates the one stage and two stage characteristics of every reaction in target_rxns over the shared
+           production envelope. Biomass, substrate and all the products are integrated together for the one stage
+           batches. The characteristics are stored in long format with a 'target' column."""
+        if not self.target_rxns:
+            warnings.warn("No target reactions were provided. Please set target_rxns to calculate the "
+                          "characteristics of multiple products.")
+            return
+        if self.settings.scope != 'global':
+            raise Exception('Multiple products are only supported for the global scope')
+        if not self.production_envelopes or self.is_stale('production_envelope'):
+            self.calculate_production_envelope()
+        if not self.production_envelopes:
             warnings.warn("A production envelope could not be generated for the given model. This is likely due to "
                           "missing fields in the model.")
+            return
+
+        target_ids = [rxn.id for rxn in self.target_rxns]
+        envelope = self.production_envelope
+        flux_list = [[envelope['growth_rates'][i], -envelope['substrate_uptake_rates'][i]] +
+                     [self.production_envelopes[target_id]['production_rates_ub'][i] for target_id in target_ids]
+                     for i in range(len(envelope))]
+
+        start_time = time.time()
+        os_ferm_list = self.run_tasks(MultiProductOneStageFermentation, [(flux_list[index],)
+                                                                         for index in range(len(flux_list))],
+                                      thread_safe_batches(self.settings))
+        ts_ferm_list = self.run_tasks(MultiProductTwoStageFermentation,
+                                      [(flux_list[stage_one_index], flux_list[stage_two_index])
+                                       for stage_one_index in range(len(flux_list))
+                                       for stage_two_index in range(len(flux_list))],
+                                      thread_safe_batches(self.settings, two_stage=True))
+        end_time = time.time()
+        print("Completed analysis in ", str(end_time-start_time), "s")
+
+        for key in self.one_stage_product_characteristics:
+            self.one_stage_product_characteristics[key] = []
+        for key in self.two_stage_product_characteristics:
+            self.two_stage_product_characteristics[key] = []
+        self.one_stage_product_best_batches = {}
+        self.two_stage_product_best_batches = {}
+
+        for index, target_id in enumerate(target_ids):
+            best_objective = None
+            for os_ferm in os_ferm_list:
+                self.one_stage_product_characteristics['target'].append(target_id)
+                self.one_stage_product_characteristics['growth_rate'].append(os_ferm.fluxes[0])
+                self.one_stage_product_characteristics['productivity'].append(os_ferm.batch_productivity[index])
+                self.one_stage_product_characteristics['yield'].append(os_ferm.batch_yield[index])
+                self.one_stage_product_characteristics['titer'].append(os_ferm.batch_titer[index])
+                self.one_stage_product_characteristics['objective value'].append(os_ferm.objective_value[index])
+                if os_ferm.constraint_flag[index] and (best_objective is None or
+                                                       os_ferm.objective_value[index] > best_objective):
+                    best_objective = os_ferm.objective_value[index]
+                    self.one_stage_product_best_batches[target_id] = os_ferm
+
+            best_objective = None
+            for ts_ferm in ts_ferm_list:
+                self.two_stage_product_characteristics['target'].append(target_id)
+                self.two_stage_product_characteristics['stage_one_growth_rate'].append(ts_ferm.stage_one_fluxes[0])
+                self.two_stage_product_characteristics['stage_two_growth_rate'].append(ts_ferm.stage_two_fluxes[0])
+                self.two_stage_product_characteristics['productivity'].append(ts_ferm.batch_productivity[index])
+                self.two_stage_product_characteristics['yield'].append(ts_ferm.batch_yield[index])
+                self.two_stage_product_characteristics['titer'].append(ts_ferm.batch_titer[index])
+                self.two_stage_product_characteristics['objective value'].append(ts_ferm.objective_value[index])
+                if (ts_ferm.constraint_flag[index] and ts_ferm.stage_one_fluxes != ts_ferm.stage_two_fluxes and
+                        (best_objective is None or ts_ferm.objective_value[index] > best_objective)):
+                    best_objective = ts_ferm.objective_value[index]
+                    self.two_stage_product_best_batches[target_id] = ts_ferm
+
+    def calculate_multi_stage_strategies(self, num_stages=3, num_switch_points=50):
+        """Finds the best strategies with one to num_stages stages over the production envelope with dynamic
+           programming (see optimal_multi_stage_strategies) and compares them to the best two stage batch of the
+           global grid, if it has been calculated. Returns the comparison table."""
+        if self.is_stale('production_envelope'):
+            self.calculate_production_envelope()
+        if self.production_envelope is None:
+            warnings.warn("A production envelope could not be generated for the given model. This is likely due to "
+                          "missing fields in the model.")
+            return None
+
+        self.update_objective_name()
+        start_time = time.time()
+        self.multi_stage_strategies = optimal_multi_stage_strategies(self.get_flux_list(), self.settings, num_stages,
+                                                                     num_switch_points)
+        print("Completed analysis in ", str(time.time()-start_time), "s")
+
+        comparison = {'strategy': [], 'stages': [], 'switch times': [], 'stage growth rates': [], 'productivity': [],
+                      'yield': [], 'titer': [], 'objective value': []}
+        batches = [(str(num_stages) + ' stage dynamic programming', strategy)
+                   for num_stages, strategy in self.multi_stage_strategies.items() if strategy is not None]
+        if self.two_stage_best_batch is not None and self.settings.scope == 'global':
+            batches.append(('two stage grid', self.two_stage_best_batch))
+        for name, batch in batches:
+            comparison['strategy'].append(name)
+            if isinstance(batch, MultiStageFermentation):
+                comparison['stages'].append(batch.num_stages)
+                comparison['switch times'].append(list(batch.switch_times))
+                comparison['stage growth rates'].append([fluxes[0] for fluxes in batch.stage_fluxes])
+            else:
+                comparison['stages'].append(2)
+                comparison['switch times'].append([batch.optimal_switch_time])
+                comparison['stage growth rates'].append([batch.stage_one_fluxes[0], batch.stage_two_fluxes[0]])
+            comparison['productivity'].append(batch.batch_productivity)
+            comparison['yield'].append(batch.batch_yield)
+            comparison['titer'].append(batch.batch_titer)
+            comparison['objective value'].append(batch.objective_value)
+        self.multi_stage_comparison = pd.DataFrame(comparison)
+        return self.multi_stage_comparison
+
+    def calculate_uptake_uncertainty(self, param_distributions, num_samples=100, confidence=0.95, seed=None,
+                                     num_switch_points=50):
+        """Propagates the uncertainty of the substrate uptake parameters (param_distributions maps parameter names to
+           the (mean, standard deviation) of a normal distribution) to the production envelope and the best one
+           stage and two stage strategies. The LPs are cached in an EnvelopeLPCache that is kept between calls, so
+           only uptake rates that have not been seen before are solved. Returns the summary of the samples with
+           the central confidence interval of the given level."""
+        self.check_model_complete()
+        if not self.model_complete_flag:
+            warnings.warn("The uncertainty could not be calculated for the given model. This is likely due to "
+                          "missing fields in the model.")
+            return None
+
+        self.update_objective_name()
+        start_time = time.time()
+        self.uncertainty_samples, envelopes = uptake_uncertainty(self.get_envelope_lp_cache(), self.settings,
+                                                                 param_distributions, num_samples, seed,
+                                                                 num_switch_points)
+        self.uncertainty_summary = confidence_summary(self.uncertainty_samples, confidence)
+        self.uncertainty_envelope_band = envelope_confidence_band(envelopes, confidence)
+        print("Completed analysis in ", str(time.time()-start_time), "s")
+        return self.uncertainty_summary
+
+    def production_rates(self, growth_rates, substrate_fluxes):
+        """Returns the maximum target fluxes at arrays of growth rates and substrate fluxes, interpolated from the
+           envelope surface if settings.envelope_surface is set and from the envelope LPs otherwise."""
+        if self.settings.envelope_surface:
+            return self.get_envelope_surface().production_rates(growth_rates, substrate_fluxes, self.target_rxn)[1]
+        lp_model = self.get_lp_model()
+        production_rates = []
+        for growth_rate, substrate_flux in zip(growth_rates, substrate_fluxes):
+            production_rate = production_rate_bounds(lp_model, self.biomass_rxn, self.substrate_rxn, self.target_rxn,
+                                                     growth_rate, substrate_flux)[1]
+            production_rates.append(0 if production_rate is None else production_rate)
+        return np.array(production_rates)
+
+    def calculate_sensitivities(self, parameters=None, relative_step=1e-4, num_switch_times=200):
+        """Calculates the local sensitivities of the metrics of the best two stage and one stage batches of the
+           global grid to the initial concentrations, batch time, uptake parameters and envelope fluxes (see
+           best_batch_sensitivities), in one batched closed form evaluation per batch. The production rates of the
+           uptake parameter steps come from the envelope LPs or the envelope surface. The table, with a 'batch'
+           column, is stored in sensitivities and returned."""
+        if self.settings.scope != 'global':
+            raise Exception('Sensitivities are only supported for the global scope')
+        if self.is_stale('production_envelope') or self.is_stale('one_stage') or self.is_stale('two_stage'):
+            self.calculate_fermentation_characteristics()
+        if self.two_stage_best_batch is None or self.one_stage_best_batch is None:
+            warnings.warn("The sensitivities could not be calculated since no best batch was found.")
+            return None
 
+        start_time = time.time()
+        tables = []
+        for batch, stage_one_fluxes, stage_two_fluxes in [
+                ('two_stage', self.two_stage_best_batch.stage_one_fluxes, self.two_stage_best_batch.stage_two_fluxes),
+                ('one_stage', self.one_stage_best_batch.fluxes, None)]:
+            table = best_batch_sensitivities(stage_one_fluxes, self.settings, stage_two_fluxes, parameters,
+                                             self.production_rates, relative_step, num_switch_times)
+            table.insert(0, 'batch', batch)
+            tables.append(table)
+        self.sensitivities = pd.concat(tables, ignore_index=True)
+        print("Completed analysis in ", str(time.time()-start_time), "s")
+        return self.sensitivities
@@ -0,0 +1,97 @@
+import os
+import uuid
+import pickle
+import hashlib
+import cobra
+from .sparse_lp import SparseLPModel
+
+__all__ = ['read_model', 'load_cached_model', 'clear_model_cache']
+
+model_readers = {'.xml': cobra.io.read_sbml_model,
+                 '.sbml': cobra.io.read_sbml_model,
+                 '.json': cobra.io.load_json_model,
+                 '.yml': cobra.io.load_yaml_model,
+                 '.yaml': cobra.io.load_yaml_model,
+                 '.mat': cobra.io.load_matlab_model}
+# Bumped whenever the pickled representation changes, e.g. new SparseLPModel attributes
+cache_format = '2'
+
+
+def default_cache_dir():
+    return os.environ.get('MCPECASO_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'mcpecaso'))
+
+
+def file_hash(path):
+
+    """This function returns the SHA-256 hash of a file, read in blocks so that large models are not loaded into
+       memory at once."""
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def read_model(path):
+
+    """This function parses a model file with the cobra reader for its extension."""
+
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.gz':
+        extension = os.path.splitext(path[:-3])[1].lower()
+    if extension not in model_readers.keys():
+        raise KeyError('Unknown model file format specified. Only ', [key for key in model_readers.keys()],
+                       'are acceptable formats.')
+    return model_readers[extension](path)
+
+
+def cache_path(path, representation, cache_dir):
+
+    """This function returns the cache file of a model file. The key includes the hash of the file contents, the
+       representation, the cobra version and the cache format, so edited files, cobra upgrades and changes of
+       the pickled representation never hit stale entries."""
+
+    key = '-'.join([file_hash(path), representation, cobra.__version__, cache_format])
+    return os.path.join(cache_dir, key + '.pkl')
+
+
+def load_cached_model(path, representation='cobra', cache_dir=None):
+
+    """This function returns the model in the file at path as a cobra model (representation='cobra') or directly as
+       a SparseLPModel (representation='sparse'). The parsed model is pickled to cache_dir (the MCPECASO_CACHE_DIR
+       environment variable or ~/.cache/mcpecaso by default), keyed by the hash of the file, so later loads of the
+       same file skip the SBML/JSON parsing. Unreadable cache entries are replaced."""
+
+    if representation not in ['cobra', 'sparse']:
+        raise KeyError('Unknown model representation specified. Only cobra and sparse are acceptable representations.')
+    cache_dir = cache_dir or default_cache_dir()
+    cache_file = cache_path(path, representation, cache_dir)
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            pass
+
+    model = read_model(path)
+    if representation == 'sparse':
+        model = SparseLPModel(model)
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_file = os.path.join(cache_dir, '.' + uuid.uuid4().hex + '.tmp')
+    with open(temp_file, 'wb') as f:
+        pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_file, cache_file)
+    return model
+
+
+def clear_model_cache(cache_dir=None):
+
+    """This function deletes all the cached models in cache_dir."""
+
+    cache_dir = cache_dir or default_cache_dir()
+    if not os.path.isdir(cache_dir):
+        return
+    for file_name in os.listdir(cache_dir):
+        if file_name.endswith('.pkl'):
+            os.remove(os.path.join(cache_dir, file_name))
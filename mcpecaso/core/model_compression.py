@@ -0,0 +1,230 @@
+import numpy as np
+import warnings
+from cobra import Reaction
+from cobra.util.solver import linear_reaction_coefficients
+from .substrate_dependent_envelopes import get_uptake_model
+
+__all__ = ['compress_cobra_model', 'verify_compression', 'knockout_aliases']
+
+
+def flux_directions(model, biomass_rxn_id, substrate_rxn_id, tolerance=1e-9, num_samples=4, seed=0):
+
+    """This function returns the sets of reactions that can carry forward and reverse flux with the biomass flux
+       free between zero and its upper bound and the substrate flux free between -1000 and 1000. The envelope and
+       extrema LPs only tighten these two reactions, so a direction that cannot carry flux here cannot in any of
+       them.
+
+       Instead of a full flux variability analysis, every LP solution is used as a witness for all the directions
+       it carries flux in. A few LPs with random objectives find most directions at once, and single reaction LPs
+       are only solved for the directions that have not been seen yet."""
+
+    forward = set()
+    reverse = set()
+    variable_names = [(rxn.id, rxn.forward_variable.name, rxn.reverse_variable.name) for rxn in model.reactions]
+
+    def solve(coefficients, direction):
+        # The objective coefficients are set on the solver directly, like in cobra's flux variability analysis,
+        # which is much faster than replacing model.objective for every LP
+        model.solver.objective.set_linear_coefficients(coefficients)
+        model.solver.objective.direction = direction
+        if model.slim_optimize(error_value=None) is not None:
+            primal_values = model.solver.primal_values
+            for rxn_id, forward_name, reverse_name in variable_names:
+                flux = primal_values[forward_name] - primal_values[reverse_name]
+                if flux > tolerance:
+                    forward.add(rxn_id)
+                elif flux < -tolerance:
+                    reverse.add(rxn_id)
+        model.solver.objective.set_linear_coefficients({variable: 0 for variable in coefficients})
+
+    random_state = np.random.RandomState(seed)
+    with model:
+        model.reactions.get_by_id(biomass_rxn_id).lower_bound = 0
+        model.reactions.get_by_id(substrate_rxn_id).bounds = (-1000, 1000)
+        model.objective = model.problem.Objective(0, direction='max')
+        for sample in range(num_samples):
+            coefficients = {}
+            for rxn, weight in zip(model.reactions, random_state.rand(len(model.reactions))):
+                coefficients[rxn.forward_variable] = weight
+                coefficients[rxn.reverse_variable] = -weight
+            for direction in ['max', 'min']:
+                solve(coefficients, direction)
+        for rxn in model.reactions:
+            coefficients = {rxn.forward_variable: 1, rxn.reverse_variable: -1}
+            if rxn.upper_bound > 0 and rxn.id not in forward:
+                solve(coefficients, 'max')
+            if rxn.lower_bound < 0 and rxn.id not in reverse:
+                solve(coefficients, 'min')
+    return forward, reverse
+
+
+def lump_linear_pathways(compressed, protected_ids, tolerance=1e-9):
+
+    """This function lumps the two reactions of every metabolite that only they use into one reaction, until no
+       such metabolite is left. The lumps are worked out on plain dictionaries and written to the model at once,
+       since changing the solver one coefficient at a time is slow for genome scale models. The lumped reaction
+       keeps the id of its first reaction, and its gene rule requires the genes of both. Returns a list of (kept
+       id, removed id, flux ratio of the removed reaction)."""
+
+    stoichiometry = {rxn.id: {met.id: coefficient for met, coefficient in rxn.metabolites.items()}
+                     for rxn in compressed.reactions}
+    bounds = {rxn.id: rxn.bounds for rxn in compressed.reactions}
+    rules = {rxn.id: rxn.gene_reaction_rule for rxn in compressed.reactions}
+    met_reactions = {met.id: {rxn.id for rxn in met.reactions} for met in compressed.metabolites}
+
+    lumped = []
+    changed_ids = set()
+    changed = True
+    while changed:
+        changed = False
+        for met_id in list(met_reactions):
+            if len(met_reactions[met_id]) != 2:
+                continue
+            first, second = sorted(met_reactions[met_id])
+            if first in protected_ids:
+                first, second = second, first
+            if first in protected_ids or second in protected_ids:
+                continue
+            ratio = -stoichiometry[first][met_id]/stoichiometry[second][met_id]
+            if ratio > 0:
+                lower_bound, upper_bound = bounds[second][0]/ratio, bounds[second][1]/ratio
+            else:
+                lower_bound, upper_bound = bounds[second][1]/ratio, bounds[second][0]/ratio
+            lower_bound = max(bounds[first][0], lower_bound)
+            upper_bound = min(bounds[first][1], upper_bound)
+            if lower_bound > upper_bound + tolerance:
+                continue
+            # Bounds that only cross by rounding are clamped, since cobra rejects a lower bound above the upper bound
+            lower_bound = min(lower_bound, upper_bound)
+
+            coefficients = dict(stoichiometry[first])
+            for other_met_id, coefficient in stoichiometry[second].items():
+                coefficients[other_met_id] = coefficients.get(other_met_id, 0) + ratio*coefficient
+            coefficients = {other_met_id: coefficient for other_met_id, coefficient in coefficients.items()
+                            if other_met_id != met_id and abs(coefficient) > tolerance}
+            for other_met_id in set(stoichiometry[first]) | set(stoichiometry[second]):
+                met_reactions[other_met_id].discard(first)
+                met_reactions[other_met_id].discard(second)
+            for other_met_id in coefficients:
+                met_reactions[other_met_id].add(first)
+            del met_reactions[met_id]
+            stoichiometry[first] = coefficients
+            bounds[first] = (lower_bound, upper_bound)
+            rules[first] = ' and '.join('(' + rule + ')' for rule in [rules[first], rules[second]] if rule)
+            for mapping in [stoichiometry, bounds, rules]:
+                del mapping[second]
+            changed_ids.add(first)
+            changed_ids.discard(second)
+            lumped.append((first, second, ratio))
+            changed = True
+
+    new_reactions = []
+    for rxn_id in changed_ids:
+        rxn = compressed.reactions.get_by_id(rxn_id)
+        new_rxn = Reaction(rxn_id, rxn.name, rxn.subsystem, *bounds[rxn_id])
+        new_rxn.add_metabolites({compressed.metabolites.get_by_id(met_id): coefficient
+                                 for met_id, coefficient in stoichiometry[rxn_id].items()})
+        new_rxn.gene_reaction_rule = rules[rxn_id]
+        new_reactions.append(new_rxn)
+    compressed.remove_reactions([second for first, second, ratio in lumped] + list(changed_ids))
+    compressed.add_reactions(new_reactions)
+    compressed.remove_metabolites([met for met in compressed.metabolites if not met.reactions])
+    return lumped
+
+
+def compress_cobra_model(model, biomass_rxn_id, substrate_rxn_id, protected_ids, tolerance=1e-9):
+
+    """This function returns a compressed copy of model and a report of what was done. The reactions in
+       protected_ids (which should include the biomass, substrate and target reactions) are never changed.
+
+       1. Blocked reactions, which cannot carry flux in any envelope or extrema LP, are removed.
+       2. Directions that cannot carry flux are closed by setting the lower or upper bound to zero.
+       3. Linear pathways, i.e. metabolites that only two reactions use, are lumped into single reactions.
+
+       The flux directions of steps 1 and 2 are found once (see flux_directions)."""
+
+    compressed = model.copy()
+    protected_ids = set(protected_ids) | {biomass_rxn_id, substrate_rxn_id} | \
+        {rxn.id for rxn in linear_reaction_coefficients(compressed)}
+    forward, reverse = flux_directions(compressed, biomass_rxn_id, substrate_rxn_id, tolerance)
+
+    blocked = [rxn.id for rxn in compressed.reactions if rxn.id not in protected_ids and
+               rxn.id not in forward and rxn.id not in reverse]
+    compressed.remove_reactions(blocked, remove_orphans=True)
+
+    closed = []
+    for rxn in compressed.reactions:
+        if rxn.id in protected_ids:
+            continue
+        if rxn.id not in reverse and rxn.lower_bound < 0:
+            rxn.lower_bound = 0
+            closed.append(rxn.id)
+        elif rxn.id not in forward and rxn.upper_bound > 0:
+            rxn.upper_bound = 0
+            closed.append(rxn.id)
+
+    lumped = lump_linear_pathways(compressed, protected_ids, tolerance)
+
+    report = {'reactions': (len(model.reactions), len(compressed.reactions)),
+              'metabolites': (len(model.metabolites), len(compressed.metabolites)),
+              'blocked': blocked,
+              'closed': closed,
+              'lumped': lumped}
+    return compressed, report
+
+
+def knockout_aliases(model, compressed, report):
+
+    """This function maps the reaction and gene ids of model that are missing from its compressed copy to what
+       knocks out the same flux there: a lumped reaction maps to the reaction it was lumped into, since their fluxes
+       are proportional, and blocked reactions and their genes map to None, since knocking them out changes
+       nothing."""
+
+    lumped_into = {second: first for first, second, ratio in report['lumped']}
+    aliases = {rxn_id: None for rxn_id in report['blocked']}
+    for rxn_id in lumped_into:
+        target_id = lumped_into[rxn_id]
+        while target_id in lumped_into:
+            target_id = lumped_into[target_id]
+        aliases[rxn_id] = target_id
+    for gene in model.genes:
+        if not compressed.genes.has_id(gene.id):
+            aliases[gene.id] = None
+    return aliases
+
+
+def production_rate_range(model, biomass_rxn_id, substrate_rxn_id, target_rxn_id, growth_rate, substrate_flux):
+    with model:
+        model.reactions.get_by_id(biomass_rxn_id).bounds = (growth_rate, growth_rate)
+        model.reactions.get_by_id(substrate_rxn_id).lower_bound = substrate_flux
+        model.objective = target_rxn_id
+        production_rate_lb = model.optimize(objective_sense='minimize').objective_value
+        production_rate_ub = model.optimize(objective_sense='maximize').objective_value
+    return production_rate_lb, production_rate_ub
+
+
+def verify_compression(model, compressed, biomass_rxn_id, substrate_rxn_id, target_rxn_ids, settings, num_points=5):
+
+    """This function compares the maximum growth rate and the minimum and maximum target fluxes of model and its
+       compressed copy at num_points growth rates of the envelope, with the substrate uptake of the uptake model in
+       settings. Returns the largest absolute difference."""
+
+    max_growth = model.slim_optimize()
+    difference = abs(max_growth - compressed.slim_optimize())
+    growth_rates = np.linspace(max_growth, 0, num_points)
+    substrate_fluxes = get_uptake_model(settings.uptake_fun, settings.uptake_params).fluxes(growth_rates)
+    for growth_rate, substrate_flux in zip(growth_rates, substrate_fluxes):
+        for target_rxn_id in target_rxn_ids:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                original = production_rate_range(model, biomass_rxn_id, substrate_rxn_id, target_rxn_id, growth_rate,
+                                                 substrate_flux)
+                reduced = production_rate_range(compressed, biomass_rxn_id, substrate_rxn_id, target_rxn_id,
+                                                growth_rate, substrate_flux)
+            for original_value, reduced_value in zip(original, reduced):
+                if (original_value is None) != (reduced_value is None) or \
+                        (original_value is not None and np.isnan(original_value) != np.isnan(reduced_value)):
+                    return np.inf
+                if original_value is not None and not np.isnan(original_value):
+                    difference = max(difference, abs(original_value - reduced_value))
+    return difference
@@ -0,0 +1,166 @@
+import numpy as np
+from .Fermentation import MultiStageFermentation
+from .fermentation_metrics import batch_metrics, objective_values, constraint_mask
+
+__all__ = ['closed_form_state', 'closed_form_depletion_time', 'optimal_multi_stage_strategies']
+
+
+def closed_form_state(concentrations, fluxes, duration):
+
+    """This function returns the concentrations after a stage with constant fluxes has run for duration hours.
+       concentrations (..., 3), fluxes (..., 3) and duration (...) are broadcast against each other, so whole grids
+       of stages can be evaluated in one call. Only valid while substrate is left."""
+
+    growth_rate = fluxes[..., 0]
+    growth = growth_rate*duration
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        biomass_integral = concentrations[..., 0]*np.where(growth_rate != 0, np.expm1(growth) /
+                                                           np.where(growth_rate != 0, growth_rate, 1), duration)
+        state = concentrations + fluxes*biomass_integral[..., None]
+        state[..., 0] = concentrations[..., 0]*np.exp(growth)
+    return state
+
+
+def closed_form_depletion_time(concentrations, fluxes):
+
+    """This function returns the time a stage with constant fluxes takes to deplete the substrate, np.inf if it
+       never does. The arguments are broadcast like in closed_form_state."""
+
+    biomass, substrate = concentrations[..., 0], concentrations[..., 1]
+    growth_rate, substrate_flux = fluxes[..., 0], fluxes[..., 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        linear = -substrate/(substrate_flux*biomass)
+        exponential = np.log(1 - substrate*growth_rate/(substrate_flux*biomass))/growth_rate
+        depletion_time = np.where(growth_rate == 0, linear, exponential)
+    depletion_time = np.where((substrate_flux >= 0) | (biomass <= 0) | np.isnan(depletion_time) |
+                              (depletion_time < 0), np.inf, depletion_time)
+    return np.where(substrate <= 0, 0, depletion_time)
+
+
+def closed_form_objective(initial_concentrations, final_concentrations, end_time, settings):
+
+    """This function returns the objective of batches from their initial and final concentrations and end times,
+       with -np.inf for batches that do not meet the constraints in the settings."""
+
+    metrics = batch_metrics(initial_concentrations, final_concentrations, end_time, settings, clip=True)
+    objective = objective_values(metrics, settings)
+    feasible = constraint_mask(metrics, settings)
+    return np.where(feasible & np.isfinite(objective), objective, -np.inf)
+
+
+def final_stage_completion(initial_concentrations, concentrations, start_times, fluxes, settings):
+
+    """This function finds the best final stage for each of the given partial batches (concentrations (M, 3) at
+       start_times (M,)). The final stage runs until the substrate is depleted or settings.time_end is reached.
+       Returns the best objective, the index of the best final phenotype and the end time of every batch."""
+
+    best_objective = np.full(len(concentrations), -np.inf)
+    best_phenotype = np.zeros(len(concentrations), dtype=int)
+    best_end_time = np.zeros(len(concentrations))
+    for phenotype in range(len(fluxes)):
+        depletion_time = closed_form_depletion_time(concentrations, fluxes[phenotype])
+        duration = np.minimum(depletion_time, settings.time_end - start_times)
+        if settings.auto_time_end:
+            duration = np.where(np.isfinite(depletion_time), depletion_time, duration)
+        final_concentrations = closed_form_state(concentrations, fluxes[phenotype], np.maximum(duration, 0))
+        objective = closed_form_objective(initial_concentrations, final_concentrations, start_times + duration,
+                                          settings)
+        objective = np.where(duration >= 0, objective, -np.inf)
+        improved = objective > best_objective
+        best_objective = np.where(improved, objective, best_objective)
+        best_phenotype = np.where(improved, phenotype, best_phenotype)
+        best_end_time = np.where(improved, start_times + duration, best_end_time)
+    return best_objective, best_phenotype, best_end_time
+
+
+def optimal_multi_stage_strategies(flux_list, settings, num_stages=3, num_switch_points=50):
+
+    """This function finds the best strategies with one to num_stages stages built from the phenotypes in flux_list
+       (the [biomass, substrate, product] fluxes of the production envelope points).
+
+       Dynamic programming is used over num_switch_points substrate levels between the initial substrate and
+       depletion, at which stages may switch. The state after m stages is kept for every (substrate level,
+       phenotype of stage m) pair, and only the path whose best closed form completion with one final stage is
+       highest is kept for each pair. Every stage is evaluated with the closed form solution for constant fluxes,
+       so the cost grows as num_stages * (num_switch_points * number of phenotypes)^2 instead of exponentially with
+       the number of stages. Switching to the same phenotype is allowed, so a k stage strategy is the best strategy
+       with at most k distinct stages.
+
+       Returns a dictionary of MultiStageFermentation objects (simulated with the usual dFBA path) keyed by the
+       number of stages."""
+
+    if settings.kinetics != 'constant':
+        raise Exception('Multi stage strategies need constant kinetics')
+    fluxes = np.array(flux_list, dtype=float)[:, :3]
+    num_phenotypes = len(fluxes)
+    initial_concentrations = np.array([settings.initial_biomass, settings.initial_substrate,
+                                       settings.initial_product], dtype=float)
+    substrate_levels = settings.initial_substrate*(1 - np.arange(num_switch_points)/num_switch_points)
+
+    source_concentrations = initial_concentrations[None, :]
+    source_times = np.zeros(1)
+    source_valid = np.ones(1, dtype=bool)
+    parents = []
+    level_times = []
+    strategies = {}
+    for level in range(num_stages):
+        objective, final_phenotype, end_time = final_stage_completion(initial_concentrations, source_concentrations,
+                                                                      source_times, fluxes, settings)
+        objective = np.where(source_valid, objective, -np.inf)
+        best_source = int(np.argmax(objective))
+        if np.isfinite(objective[best_source]):
+            strategies[level + 1] = backtrack_strategy(best_source, parents, level_times, num_phenotypes,
+                                                       final_phenotype[best_source], fluxes, settings)
+        else:
+            strategies[level + 1] = None
+        if level == num_stages - 1:
+            break
+
+        # Run every phenotype from every source state until the substrate reaches every lower substrate level
+        shifted_concentrations = source_concentrations[:, None, :] - \
+            np.stack([np.zeros(num_switch_points), substrate_levels, np.zeros(num_switch_points)], axis=1)[None, :, :]
+        duration = closed_form_depletion_time(shifted_concentrations[:, :, None, :], fluxes[None, None, :, :])
+        candidate_times = source_times[:, None, None] + duration
+        valid = (source_valid[:, None, None] & (substrate_levels[None, :] <= source_concentrations[:, 1:2])[:, :, None]
+                 & np.isfinite(duration) & (candidate_times <= settings.time_end))
+        duration = np.where(valid, duration, 0)
+        candidates = closed_form_state(source_concentrations[:, None, None, :], fluxes[None, None, :, :], duration)
+        candidates[..., 1] = substrate_levels[None, :, None]
+        score = final_stage_completion(initial_concentrations, candidates.reshape(-1, 3),
+                                       np.where(valid, candidate_times, 0).reshape(-1), fluxes,
+                                       settings)[0].reshape(valid.shape)
+        score = np.where(valid, score, -np.inf)
+
+        parent = np.argmax(score, axis=0)
+        best_score = np.take_along_axis(score, parent[None, :, :], axis=0)[0]
+        source_concentrations = np.take_along_axis(candidates, parent[None, :, :, None], axis=0)[0].reshape(-1, 3)
+        source_times = np.take_along_axis(candidate_times, parent[None, :, :], axis=0)[0].reshape(-1)
+        source_valid = np.isfinite(best_score).reshape(-1)
+        parents.append(parent.reshape(-1))
+        level_times.append(source_times)
+    return strategies
+
+
+def backtrack_strategy(source, parents, level_times, num_phenotypes, final_phenotype, fluxes, settings):
+
+    """This function rebuilds the stages of the strategy that ends in the given source state of the last dynamic
+       programming level, merges consecutive stages with the same phenotype and simulates it."""
+
+    phenotypes = []
+    stage_ends = []
+    for parent, times in zip(reversed(parents), reversed(level_times)):
+        phenotypes.insert(0, source % num_phenotypes)
+        stage_ends.insert(0, times[source])
+        source = parent[source]
+    phenotypes.append(int(final_phenotype))
+
+    stage_starts = [0] + stage_ends
+    stages = []
+    for index, phenotype in enumerate(phenotypes):
+        if index < len(stage_ends) and stage_ends[index] <= stage_starts[index]:
+            continue
+        if stages and stages[-1][0] == phenotype:
+            continue
+        stages.append((phenotype, stage_starts[index]))
+    return MultiStageFermentation([list(fluxes[phenotype]) for phenotype, stage_start in stages],
+                                  [stage_start for phenotype, stage_start in stages[1:]], settings)
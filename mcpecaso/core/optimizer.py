@@ -1,73 +1,156 @@
-from scipy.optimize import minimize
+from scipy.optimize import minimize, OptimizeResult
 from .fermentation_metrics import *
 from.two_stage_dfba import *
 
 
+# The metric of batch_metrics that each objective function returns
+objective_function_metrics = {batch_productivity: 'productivity', batch_yield: 'yield', batch_end_titer: 'titer',
+                              linear_combination: 'linear_combination'}
+
+
+class EvaluationCache(object):
+
+    def __init__(self, simulate, objective_fun, settings):
+        """Caches the metrics of the batches simulated during one optimization, keyed by the decision vector.
+           COBYLA evaluates the objective and every constraint at the same point, so the batch only has to be
+           simulated once per point. simulate takes the decision vector and returns (data, time)."""
+        self.simulate = simulate
+        self.objective_fun = objective_fun
+        self.settings = settings
+        self.evaluations = {}
+
+    def __call__(self, independent_variables):
+        key = tuple(np.atleast_1d(independent_variables).astype(float))
+        if key not in self.evaluations:
+            data, time = self.simulate(key)
+            metrics = timecourse_metrics(data, time, self.settings)
+            if self.objective_fun in objective_function_metrics:
+                objective = metrics[objective_function_metrics[self.objective_fun]][()]
+            else:
+                objective = self.objective_fun(data, time, self.settings)
+            self.evaluations[key] = {'productivity': metrics['productivity'][()],
+                                     'yield': metrics['yield'][()],
+                                     'titer': metrics['titer'][()],
+                                     'objective': objective,
+                                     'time_end': time[-1]}
+        return self.evaluations[key]
+
+
 def productivity_constraint(time_switch, min_productivity, initial_concentrations,
-                            time_end, two_stage_fluxes, settings):
+                            time_end, two_stage_fluxes, settings, cache=None):
+    if cache is not None:
+        productivity = cache(time_switch)['productivity']
+        return (productivity - min_productivity)/productivity
     data, time = two_stage_timecourse(initial_concentrations, time_end, *list(time_switch), two_stage_fluxes,
-                                      settings.num_timepoints)
+                                      settings.num_timepoints, settings)
 
     return (batch_productivity(data, time, settings) - min_productivity)/batch_productivity(data, time, settings)
 
 
-def yield_constraint(time_switch, min_yield, initial_concentrations, time_end, two_stage_fluxes, settings):
+def yield_constraint(time_switch, min_yield, initial_concentrations, time_end, two_stage_fluxes, settings,
+                     cache=None):
+    if cache is not None:
+        product_yield = cache(time_switch)['yield']
+        return (product_yield - min_yield)/product_yield
     data, time = two_stage_timecourse(initial_concentrations, time_end, *list(time_switch), two_stage_fluxes,
-                                      settings.num_timepoints)
+                                      settings.num_timepoints, settings)
 
     return (batch_yield(data, time, settings) - min_yield)/batch_yield(data, time, settings)
 
 
-def titer_constraint(time_switch, min_titer, initial_concentrations, time_end, two_stage_fluxes, settings):
+def titer_constraint(time_switch, min_titer, initial_concentrations, time_end, two_stage_fluxes, settings,
+                     cache=None):
+    if cache is not None:
+        titer = cache(time_switch)['titer']
+        return (titer - min_titer)/titer
     data, time = two_stage_timecourse(initial_concentrations, time_end, *list(time_switch), two_stage_fluxes,
-                                      settings.num_timepoints)
+                                      settings.num_timepoints, settings)
 
     return (batch_end_titer(data, time, settings) - min_titer)/batch_end_titer(data, time, settings)
 
 
-def optimization_target(time_switch, initial_concentrations, time_end, two_stage_fluxes, objective_fun, settings):
+def optimization_target(time_switch, initial_concentrations, time_end, two_stage_fluxes, objective_fun, settings,
+                        cache=None):
+    if cache is not None:
+        return -cache(time_switch)['objective']
     data, time = two_stage_timecourse(initial_concentrations, time_end, *list(time_switch), two_stage_fluxes,
-                                      settings.num_timepoints)
+                                      settings.num_timepoints, settings)
 
     return -objective_fun(data, time, settings)
 
 
+def sampled_switch_time(initial_concentrations, time_end, two_stage_fluxes, settings, objective_fun=batch_productivity,
+                        min_productivity=0, min_yield=0, min_titer=0, num_switch_times=200):
+
+    """This function returns the switch time of a two stage batch with the best objective among num_switch_times
+       switch times between 0 and the substrate depletion time of stage one, evaluated with the closed form solution
+       for constant fluxes, in the same format as the result of scipy.optimize.minimize. The best switch time that
+       meets the constraints is used, or the best one overall if none does (which is then flagged as unsuccessful).
+       It is used instead of COBYLA for the 'fastest' fidelity tier."""
+
+    # Imported here since multi_stage depends on the fermentation classes, which depend on this module
+    from .multi_stage import closed_form_depletion_time
+    from .sensitivity import two_stage_closed_form
+    initial_concentrations = np.asarray(initial_concentrations[:3], dtype=float)
+    stage_one_fluxes, stage_two_fluxes = [np.asarray(fluxes[:3], dtype=float) for fluxes in two_stage_fluxes]
+    last_switch_time = min(closed_form_depletion_time(initial_concentrations, stage_one_fluxes), time_end)
+    switch_times = last_switch_time*np.linspace(0, 1, num_switch_times)
+    metrics = two_stage_closed_form(initial_concentrations, stage_one_fluxes, stage_two_fluxes, switch_times,
+                                    time_end, settings)
+    objective = metrics[objective_function_metrics[objective_fun]]
+    feasible = (metrics['productivity'] >= min_productivity) & (metrics['yield'] >= min_yield) & \
+        (metrics['titer'] >= min_titer)
+    best = np.argmax(np.where(feasible, objective, -np.inf)) if feasible.any() else np.argmax(objective)
+    return OptimizeResult(x=np.array([switch_times[best]]), fun=-objective[best], success=bool(feasible.any()),
+                          nfev=num_switch_times, message='Sampled ' + str(num_switch_times) + ' switch times')
+
+
 def optimal_switch_time(initial_concentrations, time_end, two_stage_fluxes, settings,
                         objective_fun=batch_productivity, min_productivity=0, min_yield=0, min_titer=0):
 
+    if settings.fidelity == 'fastest' and settings.kinetics == 'constant' and \
+            objective_fun in objective_function_metrics:
+        return sampled_switch_time(initial_concentrations, time_end, two_stage_fluxes, settings, objective_fun,
+                                   min_productivity, min_yield, min_titer)
+
     constraints = []
+    cache = EvaluationCache(lambda x: two_stage_timecourse(initial_concentrations, time_end, x[0], two_stage_fluxes,
+                                                           settings.num_timepoints, settings),
+                            objective_fun, settings)
 
     if min_productivity:
         constraints.append({'type': 'ineq', 'fun': productivity_constraint,
-                            'args': ([min_productivity, initial_concentrations, time_end, two_stage_fluxes, settings])})
+                            'args': ([min_productivity, initial_concentrations, time_end, two_stage_fluxes, settings,
+                                      cache])})
 
     if min_yield:
         constraints.append({'type': 'ineq', 'fun': yield_constraint,
-                            'args': ([min_yield, initial_concentrations, time_end, two_stage_fluxes, settings])})
+                            'args': ([min_yield, initial_concentrations, time_end, two_stage_fluxes, settings,
+                                      cache])})
 
     if min_titer:
         constraints.append({'type': 'ineq', 'fun': titer_constraint,
-                            'args': ([min_titer, initial_concentrations, time_end, two_stage_fluxes, settings])})
+                            'args': ([min_titer, initial_concentrations, time_end, two_stage_fluxes, settings,
+                                      cache])})
 
     opt_result = minimize(optimization_target, x0=np.array([4]),
-                          args=(initial_concentrations, time_end, two_stage_fluxes, objective_fun, settings),
+                          args=(initial_concentrations, time_end, two_stage_fluxes, objective_fun, settings, cache),
                           options={'maxiter': 200, 'catol': 1e-2}, method='COBYLA', tol=1e-2,
                           constraints=constraints
                           )
 
-    temp_data, temp_time = two_stage_timecourse(initial_concentrations, time_end, opt_result.x[0], two_stage_fluxes,
-                                                settings.num_timepoints)
-
     if opt_result.x[0] <= 0:
         opt_result.x[0] = 0
-    elif opt_result.x[0] > temp_time[-1]:
-        opt_result.x[0] = temp_time[-1]
+    elif opt_result.x[0] > cache(opt_result.x)['time_end']:
+        opt_result.x[0] = cache(opt_result.x)['time_end']
     return opt_result
 
 
 def productivity_constraint_continuous(independent_variables, min_productivity, initial_concentrations, time_end, model,
-                                       max_growth, biomass_rxn, substrate_rxn, target_rxn, settings):
+                                       max_growth, biomass_rxn, substrate_rxn, target_rxn, settings, cache=None):
 
+    if cache is not None:
+        return (cache(independent_variables)['productivity'] - min_productivity)/min_productivity
     time_switch, stage_one_factor, stage_two_factor = independent_variables
     data, time = two_stage_timecourse_continuous(initial_concentrations, time_end, time_switch, stage_one_factor,
                                                  stage_two_factor, model, max_growth, biomass_rxn, substrate_rxn,
@@ -77,8 +160,10 @@ def productivity_constraint_continuous(independent_variables, min_productivity,
 
 
 def yield_constraint_continuous(independent_variables, min_yield, initial_concentrations, time_end, model,
-                                max_growth, biomass_rxn, substrate_rxn, target_rxn, settings):
+                                max_growth, biomass_rxn, substrate_rxn, target_rxn, settings, cache=None):
 
+    if cache is not None:
+        return (cache(independent_variables)['yield'] - min_yield)/min_yield
     time_switch, stage_one_factor, stage_two_factor = independent_variables
     data, time = two_stage_timecourse_continuous(initial_concentrations, time_end, time_switch, stage_one_factor,
                                                  stage_two_factor, model, max_growth, biomass_rxn, substrate_rxn,
@@ -88,8 +173,10 @@ def yield_constraint_continuous(independent_variables, min_yield, initial_concen
 
 
 def titer_constraint_continuous(independent_variables, min_titer, initial_concentrations, time_end, model,
-                                max_growth, biomass_rxn, substrate_rxn, target_rxn, settings):
+                                max_growth, biomass_rxn, substrate_rxn, target_rxn, settings, cache=None):
 
+    if cache is not None:
+        return (cache(independent_variables)['titer'] - min_titer)/min_titer
     time_switch, stage_one_factor, stage_two_factor = independent_variables
     data, time = two_stage_timecourse_continuous(initial_concentrations, time_end, time_switch, stage_one_factor,
                                                  stage_two_factor, model, max_growth, biomass_rxn, substrate_rxn,
@@ -99,8 +186,10 @@ def titer_constraint_continuous(independent_variables, min_titer, initial_concen
 
 
 def optimization_target_continuous(independent_variables, initial_concentrations, time_end, model, max_growth,
-                                   biomass_rxn, substrate_rxn, target_rxn, objective_fun, settings):
+                                   biomass_rxn, substrate_rxn, target_rxn, objective_fun, settings, cache=None):
 
+    if cache is not None:
+        return -cache(independent_variables)['objective']
     time_switch, stage_one_factor, stage_two_factor = independent_variables
     data, time = two_stage_timecourse_continuous(initial_concentrations, time_end, time_switch, stage_one_factor,
                                                  stage_two_factor, model, max_growth, biomass_rxn, substrate_rxn,
@@ -111,45 +200,56 @@ def optimization_target_continuous(independent_variables, initial_concentrations
 
 def optimal_switch_time_continuous(initial_concentrations, time_end, model, max_growth, biomass_rxn, substrate_rxn,
                                    target_rxn, settings, objective_fun=batch_productivity, min_productivity=0,
-                                   min_yield=0, min_titer=0, extrema_type='ts_best'):
+                                   min_yield=0, min_titer=0, extrema_type='ts_best', initial_guesses=None):
+
+    """This function finds the switch time and the stage one and stage two growth rate factors (in % of max_growth)
+       of an extrema batch with COBYLA, started from several initial guesses. initial_guesses replaces the default
+       guesses of extrema_type if given, e.g. with starts taken from a coarse global grid."""
 
     constraints = [{'type': 'ineq', 'fun': lambda x: x[1] * 100},
                    {'type': 'ineq', 'fun': lambda x: x[2] * 100},
                    {'type': 'ineq', 'fun': lambda x: (100 - x[1])*100},
                    {'type': 'ineq', 'fun': lambda x: (100 - x[2])*100}]
 
-    initial_guesses = [[0, 0, 0], [0, 0, 0], [0, 0, 0]]
+    default_guesses = [[0, 0, 0], [0, 0, 0], [0, 0, 0]]
     if extrema_type == 'os_best':
-        initial_guesses = [[0, 3, 3], [0, 50, 50]]
+        default_guesses = [[0, 3, 3], [0, 50, 50]]
         constraints.append({'type': 'ineq', 'fun': lambda x: (x[1] - x[2])*1000})
         constraints.append({'type': 'ineq', 'fun': lambda x: (x[2] - x[1])*1000})
 
     if extrema_type == 'ts_sub':
-        initial_guesses = [[1, 100, 0], [5, 100, 0]]
+        default_guesses = [[1, 100, 0], [5, 100, 0]]
         constraints.append({'type': 'ineq', 'fun': lambda x: (x[1] - 100)*100})
         constraints.append({'type': 'ineq', 'fun': lambda x: (0 - x[2])*100})
 
     if extrema_type == 'ts_best':
-        initial_guesses = [[2, 100, 33], [2, 100, 75], [2, 40, 20], [2, 50, 0], [2, 75, 0]]
+        default_guesses = [[2, 100, 33], [2, 100, 75], [2, 40, 20], [2, 50, 0], [2, 75, 0]]
+    if initial_guesses is None:
+        initial_guesses = default_guesses
+
+    cache = EvaluationCache(lambda x: two_stage_timecourse_continuous(initial_concentrations, time_end, x[0], x[1],
+                                                                      x[2], model, max_growth, biomass_rxn,
+                                                                      substrate_rxn, target_rxn, settings),
+                            objective_fun, settings)
 
     if min_productivity:
         constraints.append({'type': 'ineq', 'fun': productivity_constraint_continuous,
                             'args': ([min_productivity, initial_concentrations, time_end, model, max_growth,
-                                      biomass_rxn, substrate_rxn, target_rxn, settings])})
+                                      biomass_rxn, substrate_rxn, target_rxn, settings, cache])})
     if min_yield:
         constraints.append({'type': 'ineq', 'fun': yield_constraint_continuous,
                             'args': ([min_yield, initial_concentrations, time_end, model, max_growth,
-                                      biomass_rxn, substrate_rxn, target_rxn, settings])})
+                                      biomass_rxn, substrate_rxn, target_rxn, settings, cache])})
 
     if min_titer:
         constraints.append({'type': 'ineq', 'fun': titer_constraint_continuous,
                             'args': ([min_titer, initial_concentrations, time_end, model, max_growth,
-                                      biomass_rxn, substrate_rxn, target_rxn, settings])})
+                                      biomass_rxn, substrate_rxn, target_rxn, settings, cache])})
     opt_results = []
     for i in range(len(initial_guesses)):
         opt_results.append(minimize(optimization_target_continuous, x0=np.array(initial_guesses[i]),
                                     args=(initial_concentrations, time_end, model, max_growth, biomass_rxn,
-                                          substrate_rxn, target_rxn, objective_fun, settings),
+                                          substrate_rxn, target_rxn, objective_fun, settings, cache),
                                     options={'maxiter': 1000, 'catol': 4e-2}, method='COBYLA', tol=1e-1,
                                     constraints=constraints + [{'type': 'ineq', 'fun': lambda x: (x[1] - 100)*100},
                                                                {'type': 'ineq', 'fun': lambda x: (x[0])*100}]
@@ -165,13 +265,9 @@ def optimal_switch_time_continuous(initial_concentrations, time_end, model, max_
             if abs(abs(opt_result.fun) - abs(opt.fun))/abs(opt_result.fun) < 0.05:
                 opt_result = opt
 
-    temp_data, temp_time = two_stage_timecourse_continuous(initial_concentrations, time_end, opt_result.x[0],
-                                                           opt_result.x[1], opt_result.x[2], model, max_growth,
-                                                           biomass_rxn, substrate_rxn, target_rxn, settings)
-
     if opt_result.x[0] <= 0:
         opt_result.x[0] = 0
-    elif opt_result.x[0] > temp_time[-1]:
-        opt_result.x[0] = temp_time[-1]
+    elif opt_result.x[0] > cache(opt_result.x)['time_end']:
+        opt_result.x[0] = cache(opt_result.x)['time_end']
 
     return opt_result
@@ -0,0 +1,182 @@
+import numpy as np
+import pandas as pd
+from .multi_stage import closed_form_state, closed_form_depletion_time
+from .substrate_dependent_envelopes import get_uptake_model
+from .fermentation_metrics import batch_metrics, objective_values, constraint_mask
+
+__all__ = ['best_batch_sensitivities', 'two_stage_closed_form', 'best_switch_times']
+
+flux_parameters = ['growth_rate', 'substrate_flux', 'production_rate']
+sensitivity_metrics = {'productivity': 'productivity',
+                       'yield': 'yield',
+                       'titer': 'titer',
+                       'objective value': 'objective',
+                       'switch time': 'switch_time',
+                       'end time': 'end_time'}
+
+
+def two_stage_closed_form(initial_concentrations, stage_one_fluxes, stage_two_fluxes, switch_times, time_end,
+                          settings):
+
+    """This function returns the metrics (see batch_metrics), the objective (-np.inf where the constraints in settings
+       are not met) and the end time of two stage batches with constant fluxes, from the closed form solution. All
+       arguments are broadcast against each other like in closed_form_state, so the batch time can differ between
+       batches as well. A one stage batch is a two stage batch with the same fluxes in both stages."""
+
+    switch_concentrations = closed_form_state(initial_concentrations, stage_one_fluxes, switch_times)
+    switch_concentrations[..., 1] = np.maximum(switch_concentrations[..., 1], 0)
+    depletion_time = switch_times + closed_form_depletion_time(switch_concentrations, stage_two_fluxes)
+    end_time = np.minimum(depletion_time, np.maximum(time_end, switch_times))
+    if settings.auto_time_end:
+        end_time = np.where(np.isfinite(depletion_time), depletion_time, end_time)
+    final_concentrations = closed_form_state(switch_concentrations, stage_two_fluxes, end_time - switch_times)
+    metrics = batch_metrics(initial_concentrations, final_concentrations, end_time, settings, clip=True)
+    objective = objective_values(metrics, settings)
+    metrics['objective'] = np.where(constraint_mask(metrics, settings) & np.isfinite(objective), objective, -np.inf)
+    metrics['end_time'] = end_time
+    return metrics
+
+
+def best_switch_times(initial_concentrations, stage_one_fluxes, stage_two_fluxes, time_end, settings,
+                      num_switch_times=200, iterations=60):
+
+    """This function returns the best switch time of each of a batch of two stage batches (initial_concentrations,
+       stage fluxes (K, 3) and time_end (K,)). The objective is sampled at num_switch_times switch times up to the
+       substrate depletion time of stage one, and the best sample is refined by a golden section search between its
+       neighbours, for all batches at once. The refined switch times vary smoothly with the inputs, which the
+       finite differences of best_batch_sensitivities rely on."""
+
+    def objective(switch_times):
+        return two_stage_closed_form(initial_concentrations[..., None, :], stage_one_fluxes[..., None, :],
+                                     stage_two_fluxes[..., None, :], switch_times, time_end[..., None],
+                                     settings)['objective']
+
+    last_switch_time = np.minimum(closed_form_depletion_time(initial_concentrations, stage_one_fluxes), time_end)
+    samples = last_switch_time[:, None]*np.linspace(0, 1, num_switch_times)[None, :]
+    sampled_objective = objective(samples)
+    best = np.argmax(sampled_objective, axis=1)
+    rows = np.arange(len(samples))
+    lower = samples[rows, np.maximum(best - 1, 0)]
+    upper = samples[rows, np.minimum(best + 1, num_switch_times - 1)]
+
+    ratio = (np.sqrt(5) - 1)/2
+    for iteration in range(iterations):
+        left = upper - ratio*(upper - lower)
+        right = lower + ratio*(upper - lower)
+        left_objective, right_objective = objective(np.column_stack((left, right))).T
+        keep_left = left_objective >= right_objective
+        upper = np.where(keep_left, right, upper)
+        lower = np.where(keep_left, lower, left)
+    refined = (lower + upper)/2
+    refined_objective = objective(refined[:, None])[:, 0]
+    return np.where(refined_objective >= sampled_objective[rows, best], refined, samples[rows, best])
+
+
+def perturbed_inputs(name, value, initial_concentrations, stage_fluxes, growth_rates, settings):
+
+    """This function returns the initial concentrations, stage fluxes and batch time of a batch with the input name
+       set to value, and the (growth rate, substrate flux) points whose production rates have to be looked up for
+       uptake parameters (None otherwise)."""
+
+    initial_concentrations = initial_concentrations.copy()
+    stage_fluxes = stage_fluxes.copy()
+    time_end = settings.time_end
+    if name in ['initial_biomass', 'initial_substrate', 'initial_product']:
+        initial_concentrations[['initial_biomass', 'initial_substrate', 'initial_product'].index(name)] = value
+    elif name == 'time_end':
+        time_end = value
+    elif name.startswith('uptake_params.'):
+        uptake_params = dict(settings.uptake_params, **{name[len('uptake_params.'):]: value})
+        # The unrounded uptake rates are used, since the rounding of UptakeModel.fluxes is coarser than the steps
+        stage_fluxes[:, 1] = -np.asarray(get_uptake_model(settings.uptake_fun, uptake_params)(growth_rates))
+        return initial_concentrations, stage_fluxes, time_end, stage_fluxes[:, :2]
+    else:
+        stage, flux = name.split('.')
+        stage_fluxes[['stage_one', 'stage_two'].index(stage), flux_parameters.index(flux)] = value
+    return initial_concentrations, stage_fluxes, time_end, None
+
+
+def best_batch_sensitivities(stage_one_fluxes, settings, stage_two_fluxes=None, parameters=None,
+                             production_rates=None, relative_step=1e-4, num_switch_times=200):
+
+    """This function returns the sensitivities of the metrics of the best batch of a pair of phenotypes to its
+       inputs, as a table with one row per input and metric. For two stage batches the switch time is optimized
+       again for every input, so the table shows how the best batch responds; one stage batches are given by
+       stage_one_fluxes alone.
+
+       The inputs (parameters) are settings such as 'initial_substrate', 'initial_biomass' or 'time_end', uptake
+       parameters as 'uptake_params.<name>' and the envelope fluxes as 'stage_one.<flux>' and 'stage_two.<flux>'
+       with <flux> one of flux_parameters. Changing an uptake parameter changes the substrate fluxes of both stages
+       through the uptake model and the production rates through production_rates(growth_rates, substrate_fluxes),
+       a function that returns the maximum target flux of each point (e.g. from the envelope LPs or an
+       EnvelopeSurface). All settings and fluxes, and the uptake parameters in settings if production_rates is
+       given, are used if parameters is None.
+
+       The batches of all the inputs are evaluated with the closed form solution for constant fluxes in one
+       vectorized call, and the derivatives are central differences with a step of relative_step times the input
+       (relative_step for inputs smaller than one). The scaled sensitivity is the derivative times input over
+       metric, i.e. the relative change of the metric per relative change of the input."""
+
+    if settings.kinetics != 'constant':
+        raise Exception('Sensitivities need constant kinetics')
+    two_stage = stage_two_fluxes is not None
+    stages = ['stage_one', 'stage_two'] if two_stage else ['stage_one']
+    stage_fluxes = np.array([stage_one_fluxes[:3]] + ([stage_two_fluxes[:3]] if two_stage else []), dtype=float)
+    initial_concentrations = np.array([settings.initial_biomass, settings.initial_substrate,
+                                       settings.initial_product], dtype=float)
+    if parameters is None:
+        parameters = ['initial_substrate', 'initial_biomass', 'time_end']
+        if production_rates is not None:
+            parameters += ['uptake_params.' + name for name in sorted(settings.uptake_params)]
+        parameters += [stage + '.' + flux for stage in stages for flux in flux_parameters]
+    for name in parameters:
+        if name.startswith('uptake_params.') and production_rates is None:
+            raise KeyError('Sensitivities to the uptake parameters need the production_rates function')
+
+    base_values = []
+    cases = [(initial_concentrations, stage_fluxes, settings.time_end, None)]
+    for name in parameters:
+        if name.startswith('uptake_params.'):
+            value = float(settings.uptake_params[name[len('uptake_params.'):]])
+        elif name.startswith('stage_'):
+            stage, flux = name.split('.')
+            value = stage_fluxes[stages.index(stage), flux_parameters.index(flux)]
+        else:
+            value = float(getattr(settings, name))
+        step = relative_step*max(abs(value), 1)
+        base_values.append((value, step))
+        for perturbed_value in [value + step, value - step]:
+            cases.append(perturbed_inputs(name, perturbed_value, initial_concentrations, stage_fluxes,
+                                          stage_fluxes[:, 0], settings))
+
+    # The production rates of all the uptake parameter cases are looked up in a single call
+    lookups = [index for index, case in enumerate(cases) if case[3] is not None]
+    if lookups:
+        points = np.concatenate([cases[index][3] for index in lookups])
+        rates = np.reshape(production_rates(points[:, 0], points[:, 1]), (len(lookups), len(stages)))
+        for index, case_rates in zip(lookups, rates):
+            cases[index][1][:, 2] = case_rates
+
+    initial = np.array([case[0] for case in cases])
+    stage_one = np.array([case[1][0] for case in cases])
+    stage_two = np.array([case[1][-1] for case in cases])
+    time_end = np.array([case[2] for case in cases], dtype=float)
+    if two_stage:
+        switch_times = best_switch_times(initial, stage_one, stage_two, time_end, settings, num_switch_times)
+    else:
+        switch_times = np.zeros(len(cases))
+    results = two_stage_closed_form(initial, stage_one, stage_two, switch_times, time_end, settings)
+    results['switch_time'] = switch_times
+
+    rows = []
+    for index, (name, (value, step)) in enumerate(zip(parameters, base_values)):
+        for metric, key in sensitivity_metrics.items():
+            if metric == 'switch time' and not two_stage:
+                continue
+            base, plus, minus = results[key][0], results[key][2*index + 1], results[key][2*index + 2]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                derivative = (plus - minus)/(2*step)
+                scaled = derivative*value/base if base != 0 else np.nan
+            rows.append({'parameter': name, 'parameter value': value, 'metric': metric, 'metric value': base,
+                         'derivative': derivative, 'scaled sensitivity': scaled})
+    return pd.DataFrame(rows)
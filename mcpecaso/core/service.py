@@ -0,0 +1,196 @@
+import asyncio
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from copy import deepcopy
+from .mcPECASO import mcPECASO, extrema_task, thread_safe_batches
+from .warm_start import extrema_initial_guesses
+from .sparse_lp import SparseLPModel
+from .work_queue import one_stage_task, two_stage_task, chunks
+from .candidate_reduction import two_stage_candidates, expand_two_stage_grid
+
+__all__ = ['AnalysisService']
+
+
+def thread_lp_model(lp_model):
+
+    """This function returns the model a task on a worker thread solves its LPs on. cobra models are not thread
+       safe, so every task gets its own copy, while a SparseLPModel is only read and is shared. The tasks copy the
+       model themselves, since copying a genome-scale model takes seconds and would block the event loop."""
+
+    if isinstance(lp_model, SparseLPModel):
+        return lp_model
+    return lp_model.copy()
+
+
+def envelope_data_task(pecaso, lp_model):
+
+    return pecaso.production_envelope_data(thread_lp_model(lp_model))
+
+
+class AnalysisService(object):
+
+    def __init__(self, max_workers=None, chunk_size=25, executor=None, process_executor=None):
+        """Runs mcPECASO analyses from asyncio code. The envelope and the grid of every analysis are split into
+           chunks of chunk_size fermentations that run on two shared executors: the LP and closed form chunks on
+           executor (a thread pool of max_workers threads by default), and the chunks that integrate with odeint
+           or LSODA or optimize with COBYLA (see thread_safe_batches), which SciPy does not guarantee to be
+           re-entrant, on process_executor (a process pool of max_workers processes by default, started when it is
+           first needed). At most max_workers chunks run at a time on both. Pending chunks are queued per request
+           and handed to the executors round robin, so concurrent analyses share the workers fairly no matter how
+           large their grids are. Cancelling a request, or exceeding its timeout, drops its pending chunks; the
+           chunks that are already running finish in the background and their results are discarded."""
+        self.max_workers = max_workers or multiprocessing.cpu_count()
+        self.chunk_size = chunk_size
+        self.executor = executor or ThreadPoolExecutor(self.max_workers)
+        self.process_executor = process_executor
+        self.queues = OrderedDict()
+        self.running = 0
+
+    def get_process_executor(self):
+        if self.process_executor is None:
+            self.process_executor = ProcessPoolExecutor(self.max_workers)
+        return self.process_executor
+
+    def submit(self, request, function, *args, thread_safe=True):
+        """Queues a call of function for a request and returns an asyncio future for its result. Calls that are
+           not thread_safe run on the process executor."""
+        future = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(request, deque()).append((function, args, thread_safe, future))
+        self.dispatch()
+        return future
+
+    def dispatch(self):
+        """Starts queued chunks while workers are free, taking one chunk from each request in turn."""
+        loop = asyncio.get_running_loop()
+        while self.running < self.max_workers and self.queues:
+            request, queue = next(iter(self.queues.items()))
+            function, args, thread_safe, future = queue.popleft()
+            if queue:
+                self.queues.move_to_end(request)
+            else:
+                del self.queues[request]
+            if future.cancelled():
+                continue
+            self.running += 1
+            executor = self.executor if thread_safe else self.get_process_executor()
+            executor_future = loop.run_in_executor(executor, function, *args)
+            executor_future.add_done_callback(lambda done, future=future: self.finished(done, future))
+
+    def finished(self, done, future):
+        self.running -= 1
+        if not future.cancelled():
+            if done.exception() is not None:
+                future.set_exception(done.exception())
+            else:
+                future.set_result(done.result())
+        self.dispatch()
+
+    def cancel_request(self, request):
+        """Drops the pending chunks of a request."""
+        for function, args, thread_safe, future in self.queues.pop(request, []):
+            future.cancel()
+
+    async def run_chunks(self, request, function, argument_list, thread_safe=True):
+        futures = [self.submit(request, function, *args, thread_safe=thread_safe) for args in argument_list]
+        try:
+            return await asyncio.gather(*futures)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    async def run_request(self, coroutine_function, pecaso, timeout):
+        request = object()
+        try:
+            return await asyncio.wait_for(coroutine_function(request, pecaso), timeout)
+        finally:
+            self.cancel_request(request)
+
+    async def envelope(self, request, pecaso):
+        if not pecaso.is_stale('production_envelope'):
+            return pecaso
+        pecaso.check_model_complete()
+        pecaso.mark_computed('model_check')
+        if not pecaso.model_complete_flag:
+            raise Exception('The production envelope could not be generated. The model is incomplete.')
+        lp_model = (await self.run_chunks(request, pecaso.get_lp_model, [()]))[0]
+        envelopes = (await self.run_chunks(request, envelope_data_task, [(pecaso, lp_model)]))[0]
+        pecaso.set_production_envelopes(envelopes)
+        return pecaso
+
+    async def fermentation_characteristics(self, request, pecaso):
+        await self.envelope(request, pecaso)
+        pecaso.update_objective_name()
+        settings = deepcopy(pecaso.settings)
+        flux_list = pecaso.get_flux_list()
+        if settings.scope == 'global':
+            flux_pairs, grid = two_stage_candidates(flux_list, settings)
+            for artifact, function, items, two_stage in [('one_stage', one_stage_task, flux_list, False),
+                                                         ('two_stage', two_stage_task, flux_pairs, True)]:
+                if pecaso.is_stale(artifact):
+                    results = await self.run_chunks(request, function, [(chunk, settings)
+                                                                        for chunk in chunks(items, self.chunk_size)],
+                                                    thread_safe_batches(settings, two_stage))
+                    pecaso.computed_fermentations[artifact] = [ferm for result in results for ferm in result]
+                    if artifact == 'two_stage':
+                        pecaso.computed_fermentations[artifact] = expand_two_stage_grid(
+                            flux_list, grid, pecaso.computed_fermentations[artifact], settings)
+                    pecaso.mark_computed(artifact)
+            os_ferm_list = pecaso.computed_fermentations['one_stage']
+            ts_ferm_list = pecaso.computed_fermentations['two_stage']
+        elif settings.scope == 'extrema':
+            if pecaso.is_stale('extrema'):
+                max_growth = max(pecaso.production_envelope.growth_rates)
+                extrema_types = ['ts_best', 'ts_sub', 'os_best']
+                if settings.extrema_warm_start or settings.fidelity != 'reference':
+                    initial_guesses = (await self.run_chunks(request, extrema_initial_guesses,
+                                                             [(flux_list, max_growth, settings)]))[0]
+                else:
+                    initial_guesses = {extrema_type: None for extrema_type in extrema_types}
+                lp_model = (await self.run_chunks(request, pecaso.get_lp_model, [()]))[0]
+                # The extrema searches use COBYLA, so they run in processes, each on its own copy of the model
+                pecaso.computed_fermentations['extrema'] = await self.run_chunks(
+                    request, extrema_task, [(lp_model, max_growth, pecaso.biomass_rxn.id, pecaso.substrate_rxn.id,
+                                             pecaso.target_rxn.id, extrema_type, initial_guesses[extrema_type],
+                                             settings) for extrema_type in extrema_types], thread_safe=False)
+                pecaso.mark_computed('extrema')
+            ts_ferm_list = pecaso.computed_fermentations['extrema'][:2]
+            os_ferm_list = pecaso.computed_fermentations['extrema'][2:]
+        else:
+            raise Exception('Unknown Scope')
+        pecaso.set_fermentation_results(os_ferm_list, ts_ferm_list)
+        return pecaso
+
+    def new_analysis(self, settings, kwargs):
+        kwargs['calculate_envelope'] = False
+        pecaso = mcPECASO(**kwargs)
+        if settings is not None:
+            pecaso.settings = deepcopy(settings)
+        return pecaso
+
+    async def create_analysis(self, timeout=None, settings=None, **kwargs):
+        """Creates an mcPECASO object from the keyword arguments of mcPECASO (and a copy of settings, if given) and
+           calculates its production envelope on the executor. Raises asyncio.TimeoutError if it takes longer than
+           timeout seconds."""
+        pecaso = self.new_analysis(settings, kwargs)
+        return await self.run_request(self.envelope, pecaso, timeout)
+
+    async def calculate_production_envelope(self, pecaso, timeout=None):
+        return await self.run_request(self.envelope, pecaso, timeout)
+
+    async def calculate_fermentation_characteristics(self, pecaso, timeout=None):
+        """Calculates the fermentation characteristics of an mcPECASO object like the method of the same name, with
+           the envelope and the batches run on the executor. Only stale results are recalculated."""
+        return await self.run_request(self.fermentation_characteristics, pecaso, timeout)
+
+    async def analyze(self, timeout=None, settings=None, **kwargs):
+        """Creates an mcPECASO object and calculates its envelope and fermentation characteristics, all within one
+           deadline of timeout seconds."""
+        pecaso = self.new_analysis(settings, kwargs)
+        return await self.run_request(self.fermentation_characteristics, pecaso, timeout)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+        if self.process_executor is not None:
+            self.process_executor.shutdown(wait=wait)
@@ -3,6 +3,8 @@ class Settings:
         self.uptake_fun = 'logistic'
         self.uptake_params = {'B':5}
         self.parallel = False
+        self.parallel_backend = 'processes'
+        self.num_workers = None
         self.num_points = 25
         self.objective = 'batch_productivity'
         self.initial_biomass = 0.05
@@ -17,6 +19,42 @@ class Settings:
         self.yield_constraint = 0
         self.titer_constraint = 0
         self.scope = 'global'
+        self.integrator = 'odeint'
+        self.kinetics = 'constant'
+        self.kinetic_params = {}
+        self.depletion_threshold = 1e-6
+        self.lp_backend = 'cobra'
+        self.time_grid = 'proportional'
+        self.time_resolution = 0.05
+        self.auto_time_end = False
+        self.reduce_candidates = False
+        self.extrema_warm_start = False
+        self.warm_start_points = 8
+        self.warm_start_top_k = 2
+        self.fidelity = 'reference'
+        self.fidelity_validation_samples = 0
+        self.fidelity_tolerance = 0.01
+        self.envelope_surface = False
+        self.surface_growth_points = 51
+        self.surface_uptake_points = 21
+        self.surface_max_uptake = None
+        self.kernel_backend = 'auto'
 
 
+# The settings every computed result depends on. Results are only recalculated when one of these (or one of the
+# results and model inputs they are built from) has changed since they were last calculated.
+envelope_settings = ['uptake_fun', 'uptake_params', 'num_points', 'lp_backend', 'envelope_surface',
+                     'surface_growth_points', 'surface_uptake_points', 'surface_max_uptake']
+fermentation_settings = ['objective', 'initial_biomass', 'initial_substrate', 'initial_product', 'time_end',
+                         'productivity_coefficient', 'yield_coefficient', 'titer_coefficient', 'num_timepoints',
+                         'productivity_constraint', 'yield_constraint', 'titer_constraint', 'integrator', 'kinetics',
+                         'kinetic_params', 'depletion_threshold', 'time_grid', 'time_resolution', 'auto_time_end',
+                         'reduce_candidates', 'fidelity']
+extrema_settings = ['extrema_warm_start', 'warm_start_points', 'warm_start_top_k']
+settings_dependencies = {'model_check': [],
+                         'production_envelope': envelope_settings,
+                         'one_stage': fermentation_settings,
+                         'two_stage': fermentation_settings,
+                         'extrema': envelope_settings + fermentation_settings + extrema_settings}
+
 settings = Settings()
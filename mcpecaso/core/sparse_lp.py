@@ -0,0 +1,168 @@
+import numpy as np
+import warnings
+from scipy.optimize import linprog
+from scipy.sparse import coo_matrix
+from cobra.util.solver import linear_reaction_coefficients
+from .substrate_dependent_envelopes import get_uptake_model
+
+__all__ = ['SparseLPModel', 'sparse_multi_target_envelope_calculator', 'sparse_envelope_calculator']
+
+
+class SparseLPModel(object):
+
+    def __init__(self, model):
+        """Extracts the stoichiometric matrix, flux bounds and objective of a cobra model into a compact sparse
+           representation. The object only holds numpy and scipy arrays, so it is cheap to pickle and share with
+           worker processes. LPs are solved directly with the HiGHS solver in scipy."""
+        self.reaction_ids = [rxn.id for rxn in model.reactions]
+        self.metabolite_ids = [met.id for met in model.metabolites]
+        self.reaction_index = dict(zip(self.reaction_ids, range(len(self.reaction_ids))))
+        metabolite_index = dict(zip(self.metabolite_ids, range(len(self.metabolite_ids))))
+
+        rows, columns, coefficients = [], [], []
+        for column, rxn in enumerate(model.reactions):
+            for met, coefficient in rxn.metabolites.items():
+                rows.append(metabolite_index[met.id])
+                columns.append(column)
+                coefficients.append(coefficient)
+        self.stoichiometric_matrix = coo_matrix((coefficients, (rows, columns)),
+                                                shape=(len(self.metabolite_ids), len(self.reaction_ids))).tocsr()
+        self.lower_bounds = np.array([rxn.lower_bound for rxn in model.reactions], dtype=float)
+        self.upper_bounds = np.array([rxn.upper_bound for rxn in model.reactions], dtype=float)
+        self.objective_coefficients = np.zeros(len(self.reaction_ids))
+        for rxn, coefficient in linear_reaction_coefficients(model).items():
+            self.objective_coefficients[self.reaction_index[rxn.id]] = coefficient
+        self.objective_sense = 'minimize' if model.objective.direction == 'min' else 'maximize'
+
+    def index(self, reaction):
+        """Returns the column of a reaction. Accepts cobra Reaction objects or reaction ids."""
+        return self.reaction_index[getattr(reaction, 'id', reaction)]
+
+    def objective_vector(self, reaction):
+        """Returns an objective vector that selects the flux through a single reaction."""
+        objective = np.zeros(len(self.reaction_ids))
+        objective[self.index(reaction)] = 1
+        return objective
+
+    def solve(self, objective=None, objective_sense=None, lower_bounds=None, upper_bounds=None):
+        """Solves the LP for the given objective vector and bounds (the model objective and bounds are used if
+           None). objective_sense defaults to the direction of the model objective for the model objective, and to
+           'maximize' otherwise. Returns the objective value, or None if the LP could not be solved to optimality."""
+        if objective is None:
+            objective = self.objective_coefficients
+            if objective_sense is None:
+                objective_sense = self.objective_sense
+        if objective_sense is None:
+            objective_sense = 'maximize'
+        if lower_bounds is None:
+            lower_bounds = self.lower_bounds
+        if upper_bounds is None:
+            upper_bounds = self.upper_bounds
+        sign = -1 if objective_sense == 'maximize' else 1
+
+        result = linprog(sign*objective, A_eq=self.stoichiometric_matrix, b_eq=np.zeros(len(self.metabolite_ids)),
+                         bounds=np.column_stack((lower_bounds, upper_bounds)), method='highs')
+        if result.status != 0:
+            return None
+        return sign*result.fun
+
+    def product_flux(self, biomass_flux, substrate_flux, biomass_rxn, substrate_rxn, target_rxn):
+        """Returns the maximum target flux when the biomass flux is fixed and the substrate uptake is limited to
+           substrate_flux. This is the phenotype LP used by the extrema scope. Infeasible phenotypes return NaN,
+           like the objective value of an infeasible cobra solution."""
+        lower_bounds = self.lower_bounds.copy()
+        upper_bounds = self.upper_bounds.copy()
+        lower_bounds[self.index(biomass_rxn)] = upper_bounds[self.index(biomass_rxn)] = biomass_flux
+        lower_bounds[self.index(substrate_rxn)] = substrate_flux
+        upper_bounds[self.index(substrate_rxn)] = 1000
+        product_flux = self.solve(self.objective_vector(target_rxn), 'maximize', lower_bounds, upper_bounds)
+        if product_flux is None:
+            return np.nan
+        return product_flux
+
+
+def sparse_multi_target_envelope_calculator(sparse_model, biomass_rxn, substrate_rxn, target_rxns, settings):
+
+    """This function calculates the production envelopes of several target reactions on a SparseLPModel.
+       It returns the same data as multi_target_envelope_calculator, keyed by the target reaction ids."""
+
+    n_search_points = settings.num_points
+    target_ids = [getattr(target_rxn, 'id', target_rxn) for target_rxn in target_rxns]
+    production_rates_lb = {target_id: [] for target_id in target_ids}
+    production_rates_ub = {target_id: [] for target_id in target_ids}
+    growth_rates = []
+    substrate_uptake_rates = []
+    max_growth = sparse_model.solve()
+    if max_growth is None:
+        # cobra reports an objective value of 0 for an infeasible model, so every growth rate of the grid is 0
+        print("Growth Solver wasn't feasible")
+        max_growth = 0.
+
+    growth_rates_grid = np.linspace(max_growth, 0, n_search_points)
+    sub_model_predictions = get_uptake_model(settings.uptake_fun, settings.uptake_params).fluxes(growth_rates_grid)
+
+    biomass_index = sparse_model.index(biomass_rxn)
+    substrate_index = sparse_model.index(substrate_rxn)
+    substrate_objective = sparse_model.objective_vector(substrate_rxn)
+    target_objectives = [sparse_model.objective_vector(target_id) for target_id in target_ids]
+
+    for growth_rate, sub_model_prediction in zip(growth_rates_grid, sub_model_predictions):
+        lower_bounds = sparse_model.lower_bounds.copy()
+        upper_bounds = sparse_model.upper_bounds.copy()
+        lower_bounds[biomass_index] = upper_bounds[biomass_index] = growth_rate
+        min_feasible_uptake = sparse_model.solve(substrate_objective, 'maximize', lower_bounds, upper_bounds)
+        if min_feasible_uptake is None:
+            # The growth rate cannot be reached, so the production LPs are infeasible as well and are recorded as 0
+            # like in the cobra calculator, with the uptake of the uptake model
+            print("Substrate Solver wasn't feasible for Growth Rate: ", growth_rate)
+            growth_rates.append(growth_rate)
+            substrate_uptake_rates.append(-sub_model_prediction)
+            for target_id in target_ids:
+                production_rates_lb[target_id].append(0)
+                production_rates_ub[target_id].append(0)
+            continue
+        if sub_model_prediction <= min_feasible_uptake:
+            substrate_uptake_rate = sub_model_prediction
+        else:
+            warnings.warn('The parameters used with the model for substrate uptake resulted in rates that are lower'
+                          ' than thee minimum feasible uptake for one or more cases. The minimum feasible uptake'
+                          ' rate was used in these cases')
+            substrate_uptake_rate = min_feasible_uptake
+
+        lower_bounds[substrate_index] = substrate_uptake_rate
+        growth_rates.append(growth_rate)
+        substrate_uptake_rates.append(-substrate_uptake_rate)
+        for target_id, target_objective in zip(target_ids, target_objectives):
+            production_rate_lb = sparse_model.solve(target_objective, 'minimize', lower_bounds, upper_bounds)
+            if production_rate_lb is None:
+                print("Min Solver wasn't feasible for Growth Rate: ", growth_rate,
+                      " with uptake rate: ", substrate_uptake_rate)
+                production_rates_lb[target_id].append(0)
+            else:
+                production_rates_lb[target_id].append(production_rate_lb)
+            production_rate_ub = sparse_model.solve(target_objective, 'maximize', lower_bounds, upper_bounds)
+            if production_rate_ub is None:
+                print("Max Solver wasn't feasible for Growth Rate: ", growth_rate,
+                      " with uptake rate: ", substrate_uptake_rate)
+                production_rates_ub[target_id].append(0)
+            else:
+                production_rates_ub[target_id].append(production_rate_ub)
+
+    envelopes = {}
+    for target_id in target_ids:
+        yield_lb = list(np.divide(production_rates_lb[target_id], substrate_uptake_rates))
+        yield_ub = list(np.divide(production_rates_ub[target_id], substrate_uptake_rates))
+
+        envelopes[target_id] = dict(zip(['growth_rates', 'substrate_uptake_rates',
+                                         'production_rates_lb', 'production_rates_ub', 'yield_lb', 'yield_ub'],
+                                        [list(growth_rates), list(substrate_uptake_rates),
+                                         production_rates_lb[target_id], production_rates_ub[target_id],
+                                         yield_lb, yield_ub]))
+
+    return envelopes
+
+
+def sparse_envelope_calculator(sparse_model, biomass_rxn, substrate_rxn, target_rxn, settings):
+
+    return sparse_multi_target_envelope_calculator(sparse_model, biomass_rxn, substrate_rxn, [target_rxn],
+                                                   settings)[getattr(target_rxn, 'id', target_rxn)]
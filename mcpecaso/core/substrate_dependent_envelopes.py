@@ -1,71 +1,134 @@
 import numpy as np
 import warnings
+from collections import OrderedDict
 
 
-def logistic_uptake(growth_rate, **kwargs):
+def logistic_uptake_model(growth_rates, A=-1, K=1, C=1, Q=1, v=1, B=0, min_sub=0.5, max_sub=10):
 
-    params = {'A': -1, 'K': 1, 'C': 1, 'Q': 1, 'v': 1, 'B': 0, 'min_sub': 0.5, 'max_sub': 10}
+    """This function returns the generalised logistic substrate uptake rates for an array of growth rates."""
 
-    for arg in kwargs:
-        if arg in ['A', 'K', 'C', 'Q', 'v', 'B']:
-            params[arg] = kwargs[arg]
-        else:
-            warnings.warn('One or more of the parameters specified in the settings is(are) not recognized and was(were'
-                          ' ignored. Please check documentation for a list of acceptable parameters for the specified '
-                          'uptake function.')
+    if B == 0:
+        return np.full(np.shape(growth_rates), float(max_sub))
+    logistic = A + (K - A)/(C + Q*np.exp(-B*growth_rates))**(1/v)
+    return min_sub + (max_sub - min_sub)*logistic
 
-    if params['B'] == 0:
 
-        return params['max_sub']
+def linear_uptake_model(growth_rates, m=10, c=0.5, max_sub=10):
 
-    else:
-        logistic = params['A'] + (params['K'] - params['A']) / \
-           (params['C'] + params['Q'] * np.exp(-params['B'] * growth_rate))**(1 / params['v'])
+    """This function returns the linear substrate uptake rates for an array of growth rates, capped at max_sub."""
 
-        return params['min_sub'] + (params['max_sub'] - params['min_sub'])*logistic
+    return np.minimum(m*growth_rates + c, max_sub)
 
 
-def linear_uptake(growth_rate, **kwargs):
+uptake_registry = {}
+# Least recently used validated models, bounded since every Monte Carlo sample is a distinct parameter set
+validated_uptake_models = OrderedDict()
+max_validated_uptake_models = 256
+
+
+def register_uptake_function(name, function, default_params):
+
+    """This function adds a substrate uptake model that can then be selected with settings.uptake_fun. function
+       must take an array of growth rates followed by the parameters as keyword arguments and return the uptake
+       rates (positive) for the whole array. default_params lists the accepted parameters and their defaults."""
+
+    uptake_registry[name] = (function, dict(default_params))
+    for key in [key for key in validated_uptake_models if key[0] == name]:
+        del validated_uptake_models[key]
+
+
+register_uptake_function('logistic', logistic_uptake_model,
+                         {'A': -1, 'K': 1, 'C': 1, 'Q': 1, 'v': 1, 'B': 0, 'min_sub': 0.5, 'max_sub': 10})
+register_uptake_function('linear', linear_uptake_model, {'m': 10, 'c': 0.5, 'max_sub': 10})
+
+
+class UptakeModel(object):
+
+    def __init__(self, function, params):
+        """A substrate uptake model with validated parameters, evaluated on arrays of growth rates."""
+        self.function = function
+        self.params = params
+
+    def __call__(self, growth_rates):
+        uptake_rates = self.function(np.asarray(growth_rates, dtype=float), **self.params)
+        if np.ndim(uptake_rates) == 0:
+            return float(uptake_rates)
+        return uptake_rates
+
+    def fluxes(self, growth_rates):
+        """Returns the substrate fluxes (negative for uptake) rounded as used in the LPs."""
+        return -np.around(self(growth_rates)+0.0000005, decimals=6)
+
 
-    params = {'m': 10, 'c': 0.5, 'max_sub':10}
+def get_uptake_model(uptake_fun, uptake_params):
 
-    for arg in kwargs:
-        if arg in ['m', 'c']:
-            params[arg] = kwargs[arg]
+    """This function returns the UptakeModel registered as uptake_fun with the given parameters. The parameters
+       are validated once per distinct set, so repeated calls in loops do not warn or rebuild anything."""
+
+    if uptake_fun not in uptake_registry.keys():
+        raise KeyError('Unknown substrate uptake function specified. Only ', [fun for fun in uptake_registry.keys()],
+                       'are acceptable uptake functions.')
+    try:
+        key = (uptake_fun, tuple(sorted(uptake_params.items())))
+        if key in validated_uptake_models:
+            validated_uptake_models.move_to_end(key)
+            return validated_uptake_models[key]
+    except TypeError:
+        key = None
+
+    function, params = uptake_registry[uptake_fun]
+    params = dict(params)
+    for arg in uptake_params:
+        if arg in params:
+            params[arg] = uptake_params[arg]
         else:
             warnings.warn('One or more of the parameters specified in the settings is(are) not recognized and was(were'
                           ' ignored. Please check documentation for a list of acceptable parameters for the specified '
                           'uptake function.')
+    uptake_model = UptakeModel(function, params)
+    if key is not None:
+        validated_uptake_models[key] = uptake_model
+        while len(validated_uptake_models) > max_validated_uptake_models:
+            validated_uptake_models.popitem(last=False)
+    return uptake_model
+
+
+def logistic_uptake(growth_rate, **kwargs):
+
+    return get_uptake_model('logistic', kwargs)(growth_rate)
+
+
+def linear_uptake(growth_rate, **kwargs):
 
-    if params['m'] * growth_rate + params['c'] > 10:
-        return 10
-    else:
-        return params['m'] * growth_rate + params['c']
+    return get_uptake_model('linear', kwargs)(growth_rate)
 
 
 def envelope_calculator(model, biomass_rxn, substrate_rxn, target_rxn, settings):
 
+    return multi_target_envelope_calculator(model, biomass_rxn, substrate_rxn, [target_rxn], settings)[target_rxn.id]
+
+
+def multi_target_envelope_calculator(model, biomass_rxn, substrate_rxn, target_rxns, settings):
+
+    """This function calculates the production envelopes of several target reactions in a single sweep.
+       The substrate uptake rate at each growth rate is solved once and shared by all the targets.
+       Returns a dictionary of envelope data keyed by the target reaction ids."""
+
     n_search_points = settings.num_points
-    production_rates_lb = []
-    production_rates_ub = []
+    production_rates_lb = {target_rxn.id: [] for target_rxn in target_rxns}
+    production_rates_ub = {target_rxn.id: [] for target_rxn in target_rxns}
     growth_rates = []
     substrate_uptake_rates = []
     max_growth = model.optimize().objective_value
 
-    uptake_dict = {'linear': linear_uptake, 'logistic': logistic_uptake}
-
-    if settings.uptake_fun in uptake_dict.keys():
-        uptake_fun = uptake_dict[settings.uptake_fun]
-    else:
-        raise KeyError('Unknown substrate uptake function specified. Only ', [fun for fun in uptake_dict.keys()],
-                       'are acceptable uptake functions.')
+    growth_rates_grid = np.linspace(max_growth, 0, n_search_points)
+    sub_model_predictions = get_uptake_model(settings.uptake_fun, settings.uptake_params).fluxes(growth_rates_grid)
 
     with model:
-        for growth_rate in np.linspace(max_growth, 0, n_search_points):
+        for growth_rate, sub_model_prediction in zip(growth_rates_grid, sub_model_predictions):
             biomass_rxn.bounds = (growth_rate, growth_rate)
             model.objective = substrate_rxn.id
             min_feasible_uptake = model.optimize(objective_sense='maximize').objective_value
-            sub_model_prediction = -np.around(uptake_fun(growth_rate, **settings.uptake_params)+0.0000005, decimals=6)
             if sub_model_prediction <= min_feasible_uptake:
                 substrate_uptake_rate = sub_model_prediction
             else:
@@ -75,29 +138,34 @@ def envelope_calculator(model, biomass_rxn, substrate_rxn, target_rxn, settings)
                 substrate_uptake_rate = min_feasible_uptake
 
             substrate_rxn.lower_bound = substrate_uptake_rate
-            model.objective = target_rxn.id
             growth_rates.append(growth_rate)
             substrate_uptake_rates.append(-substrate_uptake_rate)
-            sol_min = model.optimize(objective_sense='minimize')
-            if model.solver.status != 'optimal':
-                print("Min Solver wasn't feasible for Growth Rate: ", growth_rate,
-                      " with uptake rate: ", substrate_uptake_rate)
-                production_rates_lb.append(0)
-            else:
-                production_rates_lb.append(sol_min.objective_value)
-            sol_max = model.optimize(objective_sense='maximize')
-            if model.solver.status != 'optimal':
-                print("Max Solver wasn't feasible for Growth Rate: ", growth_rate,
-                      " with uptake rate: ", substrate_uptake_rate)
-                production_rates_ub.append(0)
-            else:
-                production_rates_ub.append(sol_max.objective_value)
-    yield_lb = list(np.divide(production_rates_lb, substrate_uptake_rates))
-    yield_ub = list(np.divide(production_rates_ub, substrate_uptake_rates))
-
-    data = dict(zip(['growth_rates', 'substrate_uptake_rates',
-                     'production_rates_lb', 'production_rates_ub', 'yield_lb', 'yield_ub'],
-                    [growth_rates, substrate_uptake_rates,
-                     production_rates_lb, production_rates_ub, yield_lb, yield_ub]))
-    
-    return data
+            for target_rxn in target_rxns:
+                model.objective = target_rxn.id
+                sol_min = model.optimize(objective_sense='minimize')
+                if model.solver.status != 'optimal':
+                    print("Min Solver wasn't feasible for Growth Rate: ", growth_rate,
+                          " with uptake rate: ", substrate_uptake_rate)
+                    production_rates_lb[target_rxn.id].append(0)
+                else:
+                    production_rates_lb[target_rxn.id].append(sol_min.objective_value)
+                sol_max = model.optimize(objective_sense='maximize')
+                if model.solver.status != 'optimal':
+                    print("Max Solver wasn't feasible for Growth Rate: ", growth_rate,
+                          " with uptake rate: ", substrate_uptake_rate)
+                    production_rates_ub[target_rxn.id].append(0)
+                else:
+                    production_rates_ub[target_rxn.id].append(sol_max.objective_value)
+
+    envelopes = {}
+    for target_rxn in target_rxns:
+        yield_lb = list(np.divide(production_rates_lb[target_rxn.id], substrate_uptake_rates))
+        yield_ub = list(np.divide(production_rates_ub[target_rxn.id], substrate_uptake_rates))
+
+        envelopes[target_rxn.id] = dict(zip(['growth_rates', 'substrate_uptake_rates',
+                                             'production_rates_lb', 'production_rates_ub', 'yield_lb', 'yield_ub'],
+                                            [list(growth_rates), list(substrate_uptake_rates),
+                                             production_rates_lb[target_rxn.id], production_rates_ub[target_rxn.id],
+                                             yield_lb, yield_ub]))
+
+    return envelopes
@@ -0,0 +1,127 @@
+import numpy as np
+import pandas as pd
+from .multi_stage import closed_form_state, closed_form_depletion_time
+from .fermentation_metrics import batch_metrics, objective_values, constraint_mask
+
+__all__ = ['switch_time_curves', 'rank_switch_time_curves', 'best_ranked_batch']
+
+
+def batch_end(concentrations, fluxes, start_times, settings):
+
+    """This function returns the end time of batches whose last stage starts at start_times with the given
+       concentrations: the substrate depletion time, capped at settings.time_end unless settings.auto_time_end is
+       True and the substrate is depleted."""
+
+    depletion_time = start_times + closed_form_depletion_time(concentrations, fluxes)
+    end_time = np.minimum(depletion_time, np.maximum(settings.time_end, start_times))
+    if settings.auto_time_end:
+        end_time = np.where(np.isfinite(depletion_time), depletion_time, end_time)
+    return end_time
+
+
+def curve_metrics(initial_concentrations, final_concentrations, end_time):
+
+    """This function returns the productivity, yield and titer of batches from their initial and final
+       concentrations, with negative values set to zero like in the fermentation classes. The linear combination is
+       left out since the curves can be ranked under other coefficients later."""
+
+    return batch_metrics(initial_concentrations, final_concentrations, end_time, None, clip=True)
+
+
+def switch_time_curves(flux_list, settings, num_switch_times=200):
+
+    """This function samples the productivity, yield and titer of every two stage pair of flux_list (ordered by
+       stage one index, then stage two index like the global grid) and of every one stage batch against the switch
+       time. The switch times of a pair are spread between 0 and the substrate depletion time of stage one (or
+       settings.time_end), where the metrics of the pair can still change. The closed form solution for constant
+       fluxes is used, so the curves match the dFBA simulations up to their time resolution.
+
+       The curves only depend on the phenotypes, the initial concentrations and the batch time, so they can be
+       ranked under any objective and constraints with rank_switch_time_curves without simulating again."""
+
+    if settings.kinetics != 'constant':
+        raise Exception('Switch time curves need constant kinetics')
+    fluxes = np.array(flux_list, dtype=float)[:, :3]
+    num_phenotypes = len(fluxes)
+    initial_concentrations = np.array([settings.initial_biomass, settings.initial_substrate,
+                                       settings.initial_product], dtype=float)
+    stage_one_index = np.repeat(np.arange(num_phenotypes), num_phenotypes)
+    stage_two_index = np.tile(np.arange(num_phenotypes), num_phenotypes)
+    stage_one = fluxes[stage_one_index]
+    stage_two = fluxes[stage_two_index]
+
+    last_switch_time = np.minimum(closed_form_depletion_time(initial_concentrations, stage_one), settings.time_end)
+    switch_times = last_switch_time[:, None]*np.linspace(0, 1, num_switch_times)[None, :]
+    switch_concentrations = closed_form_state(initial_concentrations, stage_one[:, None, :], switch_times)
+    switch_concentrations[..., 1] = np.maximum(switch_concentrations[..., 1], 0)
+    end_time = batch_end(switch_concentrations, stage_two[:, None, :], switch_times, settings)
+    final_concentrations = closed_form_state(switch_concentrations, stage_two[:, None, :], end_time - switch_times)
+    two_stage = curve_metrics(initial_concentrations, final_concentrations, end_time)
+    two_stage.update({'stage_one_index': stage_one_index, 'stage_two_index': stage_two_index,
+                      'switch_times': switch_times, 'end_time': end_time})
+
+    end_time = batch_end(initial_concentrations, fluxes, np.zeros(num_phenotypes), settings)
+    one_stage = curve_metrics(initial_concentrations, closed_form_state(initial_concentrations, fluxes, end_time),
+                              end_time)
+    one_stage['end_time'] = end_time
+
+    return {'fluxes': fluxes,
+            'initial_concentrations': initial_concentrations,
+            'time_end': settings.time_end,
+            'auto_time_end': settings.auto_time_end,
+            'two_stage': two_stage,
+            'one_stage': one_stage}
+
+
+def rank_switch_time_curves(curves, settings):
+
+    """This function finds the optimal switch time of every two stage pair and the objective of every one stage
+       batch for the objective, coefficients and constraints in settings. For every pair, the best sampled switch
+       time that meets the constraints is used, or the best one overall if none does (which is then flagged like
+       an unsuccessful optimization). Returns the two stage and one stage tables."""
+
+    tables = []
+    for stage in ['two_stage', 'one_stage']:
+        curve = curves[stage]
+        metrics = {metric: np.atleast_2d(curve[metric].T).T for metric in ['productivity', 'yield', 'titer']}
+        metrics['linear_combination'] = settings.productivity_coefficient*metrics['productivity'] + \
+            settings.yield_coefficient*metrics['yield'] + settings.titer_coefficient*metrics['titer']
+        productivity, product_yield, titer = metrics['productivity'], metrics['yield'], metrics['titer']
+        objective = objective_values(metrics, settings)
+        feasible = constraint_mask(metrics, settings)
+        constraint_flag = feasible.any(axis=1)
+        best = np.where(constraint_flag, np.argmax(np.where(feasible, objective, -np.inf), axis=1),
+                        np.argmax(objective, axis=1))
+        rows = np.arange(len(best))
+
+        growth_rates = curves['fluxes'][:, 0]
+        if stage == 'two_stage':
+            table = {'stage_one_growth_rate': growth_rates[curve['stage_one_index']],
+                     'stage_two_growth_rate': growth_rates[curve['stage_two_index']]}
+        else:
+            table = {'growth_rate': growth_rates}
+        table.update({'productivity': productivity[rows, best],
+                      'yield': product_yield[rows, best],
+                      'titer': titer[rows, best],
+                      'objective value': objective[rows, best],
+                      'constraint flag': constraint_flag})
+        if stage == 'two_stage':
+            table['optimal switch time'] = curve['switch_times'][rows, best]
+            table['batch time'] = curve['end_time'][rows, best]
+        else:
+            table['batch time'] = curve['end_time']
+        tables.append(pd.DataFrame(table))
+    return tables[0], tables[1]
+
+
+def best_ranked_batch(table, two_stage=True):
+
+    """This function returns the row of the best batch of a ranked table that meets the constraints (and, for two
+       stage batches, uses two different phenotypes like the global grid), or None if there is none."""
+
+    candidates = table[table['constraint flag']]
+    if two_stage:
+        candidates = candidates[candidates['stage_one_growth_rate'] != candidates['stage_two_growth_rate']]
+    if candidates.empty:
+        return None
+    return candidates.loc[candidates['objective value'].idxmax()]
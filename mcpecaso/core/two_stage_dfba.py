@@ -1,7 +1,9 @@
 import numpy as np
-from scipy.integrate import odeint
+from scipy.integrate import odeint, solve_ivp
 import warnings
 from .substrate_dependent_envelopes import *
+from .sparse_lp import SparseLPModel
+from .kernels import get_kernels, kinetics_codes, dopri_a, dopri_b, dopri_e
 
 
 def crop_dfba_timecourse_data(dfba_data, t):
@@ -9,7 +11,7 @@ def crop_dfba_timecourse_data(dfba_data, t):
     """This function takes in dFBA data and timepoints and crops them to the point where substrate
     is over. dFBA data should be in the format: [[biomass,substrate,product]...] and timepoints are
     a list of timepoints."""
-    np.warnings.filterwarnings('ignore')
+    warnings.filterwarnings('ignore')
     if any(dfba_data[:, 1] < 0):
         substrate_consumed_index = np.where(dfba_data[:, 1] < 0)[0][0]
     else:
@@ -20,21 +22,124 @@ def crop_dfba_timecourse_data(dfba_data, t):
 def dfba_fun(concentrations, time, fluxes):
 
     """This function returns the time derivatives for biomass, substrate and products respectively.
-       The concentrations are in the order: [Biomass, Substrate, Products]"""
+       The concentrations are in the order: [Biomass, Substrate, Products]. Any number of products
+       can be integrated together, fluxes should be in the same order as the concentrations."""
 
-    dcdt = []
+    fluxes = np.asarray(fluxes, dtype=float)
+    if concentrations[1] > 0:
+        return concentrations[0]*fluxes
+    else:
+        return np.zeros(len(concentrations))
+
+
+def constant_kinetics(substrate, **kwargs):
+
+    """This function returns the scaling factor applied to the fluxes of a phenotype. The fluxes are constant
+       until the substrate is depleted."""
+
+    if substrate > 0:
+        return 1
+    else:
+        return 0
+
+
+def monod_kinetics(substrate, K_s=0.1, **kwargs):
+
+    """This function returns the Monod scaling factor S/(K_s + S) applied to the fluxes of a phenotype, so that
+       the uptake (and with it growth and production) slows down as the substrate runs out."""
+
+    if substrate > 0:
+        return substrate / (K_s + substrate)
+    else:
+        return 0
+
+
+kinetics_dict = {'constant': constant_kinetics, 'monod': monod_kinetics}
+
+
+def event_integration(settings):
+
+    """This function returns True if the event terminated integrator should be used for the given settings.
+       It is used whenever it is requested or the substrate kinetics are not constant."""
+
+    return settings is not None and (settings.integrator == 'events' or settings.kinetics != 'constant')
+
+
+def closed_form_integration(settings):
+
+    """This function returns True if the closed form solution of the dFBA equations should be used instead of
+       odeint for the given settings, i.e. for the 'fast' and 'fastest' fidelity tiers with constant kinetics."""
+
+    return settings is not None and settings.fidelity != 'reference' and not event_integration(settings)
+
+
+def dfba_fun_kinetic(time, concentrations, fluxes, kinetic_fun, kinetic_params):
+
+    """This function returns the time derivatives for biomass, substrate and products respectively when the fluxes
+       are scaled by a substrate dependent kinetic function. The arguments are in the order used by solve_ivp."""
+
+    return concentrations[0]*kinetic_fun(concentrations[1], **kinetic_params)*fluxes
 
-    for i in range(len(concentrations)):
-        if concentrations[1] > 0: 
-            dcdt.append(concentrations[0]*fluxes[i])
-            
-        else:
-            dcdt.append(0)
 
-    return dcdt
+def one_stage_timecourse_events(initial_concentrations, time, fluxes, settings):
 
+    """This function integrates one stage until the substrate concentration drops to settings.depletion_threshold
+       or the last timepoint is reached. The depletion time is located exactly with an event, and the solution is
+       only evaluated at the requested timepoints before it (using dense output) and at the depletion time. If the
+       kernels of settings.kernel_backend have one (see get_kernels), the stage is integrated by the kinetic_stage
+       kernel instead of solve_ivp.
+       Returns data and timepoints in the same format as one_stage_timecourse."""
 
-def one_stage_timecourse(initial_concentrations, time, fluxes):
+    try:
+        kinetic_fun = kinetics_dict[settings.kinetics]
+    except KeyError:
+        raise KeyError('Unknown substrate kinetics specified. Only ', [fun for fun in kinetics_dict.keys()],
+                       'are acceptable kinetics.')
+
+    def substrate_depletion(event_time, concentrations, *args):
+        return concentrations[1] - settings.depletion_threshold
+    substrate_depletion.terminal = True
+    substrate_depletion.direction = -1
+
+    time = np.asarray(time, dtype=float)
+    initial_concentrations = np.asarray(initial_concentrations, dtype=float)
+    if len(time) < 2 or time[-1] <= time[0] or initial_concentrations[1] <= settings.depletion_threshold:
+        return initial_concentrations.reshape(-1, 1), time[:1]
+
+    kinetic_stage = get_kernels(settings)['kinetic_stage']
+    if kinetic_stage is not None and settings.kinetics in kinetics_codes:
+        data, time_depleted, num_reached = kinetic_stage(initial_concentrations, time, np.asarray(fluxes, dtype=float),
+                                                         kinetics_codes[settings.kinetics],
+                                                         float(settings.kinetic_params.get('K_s', 0.1)),
+                                                         settings.depletion_threshold, 1e-6, 1e-9, dopri_a, dopri_b,
+                                                         dopri_e)
+        if np.isfinite(time_depleted):
+            time = np.append(time[:num_reached], time_depleted)
+        return np.array(data), time
+
+    solution = solve_ivp(dfba_fun_kinetic, (time[0], time[-1]), initial_concentrations, method='LSODA',
+                         events=substrate_depletion, dense_output=True, rtol=1e-6, atol=1e-9,
+                         args=(np.asarray(fluxes, dtype=float), kinetic_fun, settings.kinetic_params))
+    if solution.t_events[0].size:
+        time_depleted = solution.t_events[0][0]
+        time = np.append(time[time < time_depleted], time_depleted)
+        data = solution.sol(time)
+        data[1, -1] = min(data[1, -1], settings.depletion_threshold)
+    else:
+        data = solution.sol(time)
+    return data, time
+
+
+def substrate_remaining(data, settings):
+
+    """This function returns True if substrate is still left at the end of the given timecourse data."""
+
+    if event_integration(settings):
+        return data[1][-1] > settings.depletion_threshold
+    return data[1][-1] > 0
+
+
+def one_stage_timecourse(initial_concentrations, time, fluxes, settings=None):
     
     """This function employs odeint and returns timecourse data for one stage using dFBA
         initial_concs is a vector containing initial concentrations
@@ -42,26 +147,228 @@ def one_stage_timecourse(initial_concentrations, time, fluxes):
         data[1] = Substrate Concentration
         data[2-n] = Products Concentration
         time is a timepoint vector
-        fluxes is a vector containing flux data for biomass, substrate and products respectively"""
+        fluxes is a vector containing flux data for biomass, substrate and products respectively
+        If settings request event terminated integration (or non constant kinetics), one_stage_timecourse_events
+        is used instead of odeint, and for the faster fidelity tiers one_stage_timecourse_closed_form."""
+
+    if event_integration(settings):
+        return one_stage_timecourse_events(initial_concentrations, time, fluxes, settings)
+    if closed_form_integration(settings):
+        return one_stage_timecourse_closed_form(initial_concentrations, time, fluxes)
 
-    (data, full_output) = odeint(dfba_fun, initial_concentrations, time, args=tuple([fluxes]), full_output=True)
+    (data, full_output) = odeint(dfba_fun, initial_concentrations, time, args=(np.asarray(fluxes, dtype=float),),
+                                 full_output=True)
     data, time = crop_dfba_timecourse_data(data, time)
     return data.transpose(), time
 
 
-def two_stage_timecourse(initial_concentrations, time_end, time_switch, two_stage_fluxes, num_of_points=1000):
+def stage_concentrations(initial_concentrations, fluxes, time):
+
+    """This function returns the concentrations after time hours of a stage with constant fluxes, using the closed
+       form solution of the dFBA equations (only valid while substrate is left)."""
+
+    initial_concentrations = np.asarray(initial_concentrations, dtype=float)
+    fluxes = np.asarray(fluxes, dtype=float)
+    growth_rate = fluxes[0]
+    if growth_rate != 0:
+        biomass_integral = initial_concentrations[0]*np.expm1(growth_rate*time)/growth_rate
+    else:
+        biomass_integral = initial_concentrations[0]*time
+    concentrations = initial_concentrations + fluxes*biomass_integral
+    concentrations[0] = initial_concentrations[0]*np.exp(growth_rate*time)
+    return concentrations
+
+
+def stage_depletion_time(initial_concentrations, fluxes):
+
+    """This function returns the time it takes a stage with constant fluxes to deplete the substrate, from the closed
+       form solution of the dFBA equations. Returns np.inf if the substrate is never depleted."""
+
+    biomass, substrate = initial_concentrations[0], initial_concentrations[1]
+    growth_rate, substrate_flux = fluxes[0], fluxes[1]
+    if substrate <= 0:
+        return 0
+    if biomass <= 0 or substrate_flux >= 0:
+        return np.inf
+    if growth_rate == 0:
+        return -substrate/(substrate_flux*biomass)
+    argument = 1 - substrate*growth_rate/(substrate_flux*biomass)
+    if argument <= 0:
+        return np.inf
+    return np.log(argument)/growth_rate
+
+
+def one_stage_timecourse_closed_form(initial_concentrations, time, fluxes):
+
+    """This function returns timecourse data for one stage with constant fluxes in the same format as
+       one_stage_timecourse, evaluated from the closed form solution of the dFBA equations instead of odeint. The
+       concentrations stay at their values at the substrate depletion time afterwards, and like odeint timecourses
+       the data is cropped at the first timepoint after the depletion."""
+
+    initial_concentrations = np.asarray(initial_concentrations, dtype=float)
+    fluxes = np.asarray(fluxes, dtype=float)
+    time = np.asarray(time, dtype=float)
+    depletion_time = time[0] + stage_depletion_time(initial_concentrations, fluxes)
+    if depletion_time <= time[-1]:
+        time = time[:np.searchsorted(time, depletion_time) + 1]
+    duration = np.minimum(time, depletion_time) - time[0]
+
+    growth_rate = fluxes[0]
+    if growth_rate != 0:
+        biomass_integral = initial_concentrations[0]*np.expm1(growth_rate*duration)/growth_rate
+    else:
+        biomass_integral = initial_concentrations[0]*duration
+    data = initial_concentrations[:, None] + fluxes[:, None]*biomass_integral[None, :]
+    data[0] = initial_concentrations[0]*np.exp(growth_rate*duration)
+    data[1] = np.where(time >= depletion_time, np.minimum(data[1], 0), data[1])
+    return data, time
+
+
+def stage_time_grid(time_start, time_stop, settings):
+
+    """This function returns timepoints from time_start to time_stop spaced at most settings.time_resolution apart."""
+
+    num_of_points = max(2, int(np.ceil((time_stop - time_start)/settings.time_resolution)) + 1)
+    return np.linspace(time_start, time_stop, num_of_points)
+
+
+def one_stage_time_grid(initial_concentrations, fluxes, settings):
+
+    """This function returns the timepoints a one stage batch is simulated on. With the adaptive time grid, the
+       timepoints only extend one step past the substrate depletion time (which also sets the batch time when
+       settings.auto_time_end is True), otherwise settings.num_timepoints points up to settings.time_end are used."""
+
+    if settings.time_grid != 'adaptive':
+        return np.linspace(0, settings.time_end, settings.num_timepoints)
+    if settings.kinetics == 'constant':
+        depletion_time = stage_depletion_time(initial_concentrations, fluxes)
+    else:
+        depletion_time = np.inf
+    if np.isfinite(depletion_time):
+        time_stop = depletion_time + settings.time_resolution
+        if not settings.auto_time_end:
+            time_stop = min(time_stop, settings.time_end)
+    else:
+        time_stop = settings.time_end
+    return stage_time_grid(0, time_stop, settings)
+
+
+def two_stage_timecourse_adaptive(initial_concentrations, time_end, time_switch, two_stage_fluxes, settings):
+
+    """This function generates two_stage timecourse data like two_stage_timecourse, but sizes the timepoints of each
+       stage to the duration of the stage with a spacing of settings.time_resolution. Stages stop one step after the
+       substrate is depleted, which is known from the closed form solution for constant kinetics. If
+       settings.auto_time_end is True, time_end is replaced by the depletion time of the batch for this switch
+       time, so the batch is never under or over simulated."""
+
+    stage_one_fluxes, stage_two_fluxes = two_stage_fluxes
+    closed_form = settings.kinetics == 'constant'
+    if (time_switch < 0) or np.isnan(time_switch):
+        time_switch = 0
+
+    if closed_form:
+        stage_one_depletion_time = stage_depletion_time(initial_concentrations, stage_one_fluxes)
+    else:
+        stage_one_depletion_time = np.inf
+
+    if settings.auto_time_end and closed_form:
+        if time_switch >= stage_one_depletion_time:
+            batch_depletion_time = stage_one_depletion_time
+        else:
+            batch_depletion_time = time_switch + stage_depletion_time(
+                stage_concentrations(initial_concentrations, stage_one_fluxes, time_switch), stage_two_fluxes)
+        if np.isfinite(batch_depletion_time):
+            time_end = batch_depletion_time + settings.time_resolution
+
+    if time_end <= 0:
+        return one_stage_timecourse(initial_concentrations, [0], stage_one_fluxes, settings)
+    if time_switch > time_end:
+        time_switch = time_end
+
+    stage_one_stop = min(time_switch, stage_one_depletion_time + settings.time_resolution)
+    if stage_one_stop > 0:
+        data_stage_one, time_stage_one = one_stage_timecourse(initial_concentrations,
+                                                              stage_time_grid(0, stage_one_stop, settings),
+                                                              stage_one_fluxes, settings)
+    else:
+        data_stage_one, time_stage_one = one_stage_timecourse(initial_concentrations, [0], stage_one_fluxes, settings)
+
+    stage_two_start_data = data_stage_one.transpose()[-1]
+    if substrate_remaining(data_stage_one, settings) and time_end > time_switch:
+        if closed_form:
+            stage_two_stop = min(time_end, time_switch + stage_depletion_time(stage_two_start_data, stage_two_fluxes) +
+                                 settings.time_resolution)
+        else:
+            stage_two_stop = time_end
+        data_stage_two, t_stage_two = one_stage_timecourse(stage_two_start_data,
+                                                           stage_time_grid(time_switch, stage_two_stop, settings),
+                                                           stage_two_fluxes, settings)
+    else:
+        data_stage_two, t_stage_two = one_stage_timecourse(stage_two_start_data, [time_stage_one[-1]],
+                                                           stage_two_fluxes, settings)
+
+    two_stage_data = np.concatenate((data_stage_one, data_stage_two), axis=1)
+    time = np.concatenate((time_stage_one, t_stage_two), axis=0)
+
+    if substrate_remaining(two_stage_data, settings):
+        warnings.warn("Substrate has not been depleted. Please increase your batch time.")
+    return two_stage_data, time
+
+
+def multi_stage_timecourse(initial_concentrations, switch_times, stage_fluxes, settings):
+
+    """This function generates timecourse data for a batch with any number of stages.
+       switch_times is a list of the times at which stages two to n become active
+       stage_fluxes is a list of n lists that have flux data for biomass, substrate and product respectively
+       Every stage is sampled with a spacing of settings.time_resolution. The last stage runs until the substrate is
+       depleted (one step past the closed form depletion time for constant kinetics) or settings.time_end."""
+
+    data = [np.asarray(initial_concentrations, dtype=float).reshape(-1, 1)]
+    time = [np.zeros(1)]
+    stage_starts = [0] + list(switch_times)
+    for stage, fluxes in enumerate(stage_fluxes):
+        start_data, start_time = data[-1][:, -1], time[-1][-1]
+        if not substrate_remaining(data[-1], settings):
+            break
+        if stage < len(stage_fluxes) - 1:
+            stop_time = stage_starts[stage + 1]
+        elif settings.kinetics == 'constant' and np.isfinite(stage_depletion_time(start_data, fluxes)):
+            stop_time = start_time + stage_depletion_time(start_data, fluxes) + settings.time_resolution
+            if not settings.auto_time_end:
+                stop_time = min(stop_time, max(settings.time_end, start_time))
+        else:
+            stop_time = max(settings.time_end, start_time)
+        if stop_time <= start_time:
+            continue
+        stage_data, stage_time = one_stage_timecourse(start_data, stage_time_grid(start_time, stop_time, settings),
+                                                      fluxes, settings)
+        data.append(stage_data[:, 1:])
+        time.append(stage_time[1:])
+
+    multi_stage_data = np.concatenate(data, axis=1)
+    if substrate_remaining(multi_stage_data, settings):
+        warnings.warn("Substrate has not been depleted. Please increase your batch time.")
+    return multi_stage_data, np.concatenate(time)
+
+
+def two_stage_timecourse(initial_concentrations, time_end, time_switch, two_stage_fluxes, num_of_points=1000,
+                         settings=None):
 
     """This function generates two_stage timecourse data using dfba given flux vectors for the two stages
        initial_concs is a vector containing initial concentrations
        time_end is the batch end time
        time_switch is the time at which the second stage becomes active
        Ensure t_switch < t_end
-       two_stage_fluxes is a list of two lists that has flux data for biomass, substrate and product respectively"""
+       two_stage_fluxes is a list of two lists that has flux data for biomass, substrate and product respectively
+       settings is only needed for event terminated integration and the adaptive time grid"""
     stage_one_fluxes, stage_two_fluxes = two_stage_fluxes
     stage_one_start_data = initial_concentrations
 
+    if settings is not None and settings.time_grid == 'adaptive':
+        return two_stage_timecourse_adaptive(initial_concentrations, time_end, time_switch, two_stage_fluxes, settings)
+
     if time_end <= 0:
-        two_stage_data, time = one_stage_timecourse(stage_one_start_data, [0], stage_one_fluxes)
+        two_stage_data, time = one_stage_timecourse(stage_one_start_data, [0], stage_one_fluxes, settings)
         return two_stage_data, time
 
     # These two conditions are to ensure that the optimizer functions properly
@@ -72,21 +379,24 @@ def two_stage_timecourse(initial_concentrations, time_end, time_switch, two_stag
 
     if np.floor(num_of_points*(time_switch/time_end)) != 0:
         time_stage_one = np.linspace(0, time_switch, int(num_of_points*(time_switch/time_end)))
-        data_stage_one, time_stage_one = one_stage_timecourse(stage_one_start_data, time_stage_one, stage_one_fluxes)
+        data_stage_one, time_stage_one = one_stage_timecourse(stage_one_start_data, time_stage_one, stage_one_fluxes,
+                                                              settings)
     else:
-        data_stage_one, time_stage_one = one_stage_timecourse(stage_one_start_data, [0], stage_one_fluxes)
+        data_stage_one, time_stage_one = one_stage_timecourse(stage_one_start_data, [0], stage_one_fluxes, settings)
 
     stage_two_start_data = data_stage_one.transpose()[-1]
-    if (stage_two_start_data[1] > 0) and (int(num_of_points*(time_end - time_switch)/time_end) != 0):
+    if substrate_remaining(data_stage_one, settings) and (int(num_of_points*(time_end - time_switch)/time_end) != 0):
         time_stage_two = np.linspace(time_switch, time_end, int(num_of_points*(time_end - time_switch)/time_end))
-        data_stage_two, t_stage_two = one_stage_timecourse(stage_two_start_data, time_stage_two, stage_two_fluxes)
+        data_stage_two, t_stage_two = one_stage_timecourse(stage_two_start_data, time_stage_two, stage_two_fluxes,
+                                                           settings)
     else:
-        data_stage_two, t_stage_two = one_stage_timecourse(stage_two_start_data, [time_stage_one[-1]], stage_two_fluxes)
+        data_stage_two, t_stage_two = one_stage_timecourse(stage_two_start_data, [time_stage_one[-1]], stage_two_fluxes,
+                                                           settings)
 
     two_stage_data = np.concatenate((data_stage_one, data_stage_two), axis=1)
     time = np.concatenate((time_stage_one, t_stage_two), axis=0)
 
-    if two_stage_data[1][-1] > 0:
+    if substrate_remaining(two_stage_data, settings):
         warnings.warn("Substrate has not been depleted. Please increase your batch time.")
     return two_stage_data, time
 
@@ -98,36 +408,40 @@ def two_stage_timecourse_continuous(initial_concentrations, time_end, time_switc
        time_end is the batch end time
        time_switch is the time at which the second stage becomes active
        Ensure t_switch < t_end
-       two_stage_fluxes is a list of two lists that has flux data for biomass, substrate and product respectively"""
+       two_stage_fluxes is a list of two lists that has flux data for biomass, substrate and product respectively
+       model can be a cobra model or a SparseLPModel, in which case the phenotype LPs are solved with HiGHS"""
     stage_one_start_data = initial_concentrations
-    uptake_dict = {'linear': linear_uptake, 'logistic': logistic_uptake}
-
-    if settings.uptake_fun in uptake_dict.keys():
-        uptake_fun = uptake_dict[settings.uptake_fun]
-    else:
-        raise KeyError('Unknown substrate uptake function specified. Only ', [fun for fun in uptake_dict.keys()],
-                       'are acceptable uptake functions.')
-
-    with model:
-        stage_one_biomass_flux = stage_one_factor/100*max_growth
-        stage_one_substrate_flux = -np.around(uptake_fun(stage_one_biomass_flux, **settings.uptake_params)+0.0000005,
-                                              decimals=6)
-        biomass_rxn.bounds = (stage_one_biomass_flux, stage_one_biomass_flux)
-        substrate_rxn.bounds = (stage_one_substrate_flux, 1000)
-        model.objective = target_rxn
-        stage_one_product_flux = model.optimize().objective_value
-        stage_one_fluxes = [stage_one_biomass_flux, stage_one_substrate_flux, stage_one_product_flux]
-
-        stage_two_biomass_flux = stage_two_factor/100*max_growth
-        stage_two_substrate_flux = -np.around(uptake_fun(stage_two_biomass_flux, **settings.uptake_params)+0.0000005,
-                                              decimals=6)
-        biomass_rxn.bounds = (stage_two_biomass_flux, stage_two_biomass_flux)
-        substrate_rxn.bounds = (stage_two_substrate_flux, 1000)
-        model.objective = target_rxn
-        stage_two_product_flux = model.optimize().objective_value
-        stage_two_fluxes = [stage_two_biomass_flux, stage_two_substrate_flux, stage_two_product_flux]
+    stage_one_biomass_flux = stage_one_factor/100*max_growth
+    stage_two_biomass_flux = stage_two_factor/100*max_growth
+    uptake_model = get_uptake_model(settings.uptake_fun, settings.uptake_params)
+    stage_one_substrate_flux, stage_two_substrate_flux = uptake_model.fluxes([stage_one_biomass_flux,
+                                                                              stage_two_biomass_flux])
+
+    if isinstance(model, SparseLPModel):
+        stage_one_product_flux = model.product_flux(stage_one_biomass_flux, stage_one_substrate_flux, biomass_rxn,
+                                                    substrate_rxn, target_rxn)
+        stage_two_product_flux = model.product_flux(stage_two_biomass_flux, stage_two_substrate_flux, biomass_rxn,
+                                                    substrate_rxn, target_rxn)
+    else:
+        with model:
+            biomass_rxn.bounds = (stage_one_biomass_flux, stage_one_biomass_flux)
+            substrate_rxn.bounds = (stage_one_substrate_flux, 1000)
+            model.objective = target_rxn
+            stage_one_product_flux = model.optimize().objective_value
+
+            biomass_rxn.bounds = (stage_two_biomass_flux, stage_two_biomass_flux)
+            substrate_rxn.bounds = (stage_two_substrate_flux, 1000)
+            model.objective = target_rxn
+            stage_two_product_flux = model.optimize().objective_value
+    stage_one_fluxes = [stage_one_biomass_flux, stage_one_substrate_flux, stage_one_product_flux]
+    stage_two_fluxes = [stage_two_biomass_flux, stage_two_substrate_flux, stage_two_product_flux]
+
+    if settings.time_grid == 'adaptive':
+        return two_stage_timecourse_adaptive(initial_concentrations, time_end, time_switch,
+                                             [stage_one_fluxes, stage_two_fluxes], settings)
+
     if time_end <= 0:
-        two_stage_data, time = one_stage_timecourse(stage_one_start_data, [0], stage_one_fluxes)
+        two_stage_data, time = one_stage_timecourse(stage_one_start_data, [0], stage_one_fluxes, settings)
         return two_stage_data, time
 
     # These two conditions are to ensure that the optimizer functions properly
@@ -138,21 +452,25 @@ def two_stage_timecourse_continuous(initial_concentrations, time_end, time_switc
 
     if np.floor(settings.num_timepoints * (time_switch / time_end)) != 0:
         time_stage_one = np.linspace(0, time_switch, int(settings.num_timepoints * (time_switch / time_end)))
-        data_stage_one, time_stage_one = one_stage_timecourse(stage_one_start_data, time_stage_one, stage_one_fluxes)
+        data_stage_one, time_stage_one = one_stage_timecourse(stage_one_start_data, time_stage_one, stage_one_fluxes,
+                                                              settings)
     else:
-        data_stage_one, time_stage_one = one_stage_timecourse(stage_one_start_data, [0], stage_one_fluxes)
+        data_stage_one, time_stage_one = one_stage_timecourse(stage_one_start_data, [0], stage_one_fluxes, settings)
 
     stage_two_start_data = data_stage_one.transpose()[-1]
-    if (stage_two_start_data[1] > 0) and (int(settings.num_timepoints * (time_end - time_switch) / time_end) != 0):
+    if substrate_remaining(data_stage_one, settings) and \
+       (int(settings.num_timepoints * (time_end - time_switch) / time_end) != 0):
         time_stage_two = np.linspace(time_switch, time_end, int(settings.num_timepoints * (time_end - time_switch) / time_end))
-        data_stage_two, t_stage_two = one_stage_timecourse(stage_two_start_data, time_stage_two, stage_two_fluxes)
+        data_stage_two, t_stage_two = one_stage_timecourse(stage_two_start_data, time_stage_two, stage_two_fluxes,
+                                                           settings)
     else:
-        data_stage_two, t_stage_two = one_stage_timecourse(stage_two_start_data, [time_stage_one[-1]], stage_two_fluxes)
+        data_stage_two, t_stage_two = one_stage_timecourse(stage_two_start_data, [time_stage_one[-1]], stage_two_fluxes,
+                                                           settings)
 
     two_stage_data = np.concatenate((data_stage_one, data_stage_two), axis=1)
     time = np.concatenate((time_stage_one, t_stage_two), axis=0)
 
-    if two_stage_data[1][-1] > 0:
+    if substrate_remaining(two_stage_data, settings):
         warnings.warn("Substrate has not been depleted. Please increase your batch time.")
 
     return two_stage_data, time
@@ -0,0 +1,155 @@
+import numpy as np
+import pandas as pd
+import warnings
+from copy import deepcopy
+from .substrate_dependent_envelopes import get_uptake_model
+from .sparse_lp import SparseLPModel
+from .envelope_surface import min_feasible_uptake, production_rate_bounds
+from .multi_stage import optimal_multi_stage_strategies
+
+__all__ = ['EnvelopeLPCache', 'uptake_uncertainty', 'confidence_summary', 'envelope_confidence_band']
+
+
+class EnvelopeLPCache(object):
+
+    def __init__(self, lp_model, biomass_rxn, substrate_rxn, target_rxn, num_points):
+        """Solves the parts of the production envelope that do not depend on the uptake model once (the maximum
+           growth rate and the minimum feasible uptake at every growth rate), and caches the production rate LPs by
+           (growth rate, substrate uptake rate). Envelopes for many uptake models or parameter sets then only solve
+           the LPs for uptake rates that have not been seen before. lp_model is a cobra model or a SparseLPModel."""
+        self.lp_model = lp_model
+        self.biomass_rxn = biomass_rxn
+        self.substrate_rxn = substrate_rxn
+        self.target_rxn = target_rxn
+        self.production_rates = {}
+        self.num_solves = 0
+
+        if isinstance(lp_model, SparseLPModel):
+            max_growth = lp_model.solve()
+        else:
+            max_growth = lp_model.optimize().objective_value
+        self.growth_rates = np.linspace(max_growth, 0, num_points)
+        self.min_feasible_uptakes = [self.solve_min_feasible_uptake(growth_rate) for growth_rate in self.growth_rates]
+
+    def solve_min_feasible_uptake(self, growth_rate):
+        return min_feasible_uptake(self.lp_model, self.biomass_rxn, self.substrate_rxn, growth_rate)
+
+    def solve_production_rates(self, index, substrate_uptake_rate):
+        """Returns the (minimum, maximum) target flux at growth rate number index and the given substrate uptake
+           rate (negative for uptake), solving the LPs only if this pair has not been solved before."""
+        key = (index, substrate_uptake_rate)
+        if key in self.production_rates:
+            return self.production_rates[key]
+
+        growth_rate = self.growth_rates[index]
+        self.num_solves += 1
+        production_rate_lb, production_rate_ub = production_rate_bounds(self.lp_model, self.biomass_rxn,
+                                                                        self.substrate_rxn, self.target_rxn,
+                                                                        growth_rate, substrate_uptake_rate)
+        if production_rate_lb is None:
+            print("Min Solver wasn't feasible for Growth Rate: ", growth_rate,
+                  " with uptake rate: ", substrate_uptake_rate)
+            production_rate_lb = 0
+        if production_rate_ub is None:
+            print("Max Solver wasn't feasible for Growth Rate: ", growth_rate,
+                  " with uptake rate: ", substrate_uptake_rate)
+            production_rate_ub = 0
+        self.production_rates[key] = (production_rate_lb, production_rate_ub)
+        return self.production_rates[key]
+
+    def envelope(self, uptake_fun, uptake_params):
+        """Returns the envelope data for the given uptake model in the format of envelope_calculator."""
+        sub_model_predictions = get_uptake_model(uptake_fun, uptake_params).fluxes(self.growth_rates)
+        substrate_uptake_rates = []
+        production_rates_lb = []
+        production_rates_ub = []
+        for index, sub_model_prediction in enumerate(sub_model_predictions):
+            if sub_model_prediction <= self.min_feasible_uptakes[index]:
+                substrate_uptake_rate = sub_model_prediction
+            else:
+                warnings.warn('The parameters used with the model for substrate uptake resulted in rates that are lower'
+                              ' than thee minimum feasible uptake for one or more cases. The minimum feasible uptake'
+                              ' rate was used in these cases')
+                substrate_uptake_rate = self.min_feasible_uptakes[index]
+            production_rate_lb, production_rate_ub = self.solve_production_rates(index, substrate_uptake_rate)
+            substrate_uptake_rates.append(-substrate_uptake_rate)
+            production_rates_lb.append(production_rate_lb)
+            production_rates_ub.append(production_rate_ub)
+
+        return {'growth_rates': list(self.growth_rates),
+                'substrate_uptake_rates': substrate_uptake_rates,
+                'production_rates_lb': production_rates_lb,
+                'production_rates_ub': production_rates_ub,
+                'yield_lb': list(np.divide(production_rates_lb, substrate_uptake_rates)),
+                'yield_ub': list(np.divide(production_rates_ub, substrate_uptake_rates))}
+
+
+def sample_uptake_params(uptake_params, param_distributions, num_samples, seed=None):
+
+    """This function returns num_samples uptake parameter dictionaries. param_distributions maps parameter names to
+       (mean, standard deviation) of a normal distribution; the other parameters are taken from uptake_params."""
+
+    random_state = np.random.RandomState(seed)
+    samples = {name: random_state.normal(mean, std, num_samples)
+               for name, (mean, std) in param_distributions.items()}
+    return [dict(uptake_params, **{name: samples[name][i] for name in samples}) for i in range(num_samples)]
+
+
+def uptake_uncertainty(envelope_cache, settings, param_distributions, num_samples=100, seed=None,
+                       num_switch_points=50):
+
+    """This function propagates the uncertainty of the uptake parameters to the envelope and the best one stage and
+       two stage strategies. The envelope of every sample comes from an EnvelopeLPCache, and the best strategies of
+       all the pairs and switch points of a sample are found at once with the closed form dynamic programming of
+       optimal_multi_stage_strategies. Returns a DataFrame with one row per sample and the list of envelopes."""
+
+    results = {name: [] for name in param_distributions}
+    for key in ['one_stage_productivity', 'one_stage_yield', 'one_stage_titer', 'one_stage_objective_value',
+                'two_stage_productivity', 'two_stage_yield', 'two_stage_titer', 'two_stage_objective_value',
+                'two_stage_switch_time']:
+        results[key] = []
+    envelopes = []
+    for uptake_params in sample_uptake_params(settings.uptake_params, param_distributions, num_samples, seed):
+        sample_settings = deepcopy(settings)
+        sample_settings.uptake_params = uptake_params
+        envelope = pd.DataFrame(envelope_cache.envelope(settings.uptake_fun, uptake_params))
+        envelopes.append(envelope)
+        flux_list = np.column_stack((envelope['growth_rates'], -envelope['substrate_uptake_rates'],
+                                     envelope['production_rates_ub']))
+        strategies = optimal_multi_stage_strategies(flux_list, sample_settings, 2, num_switch_points)
+        for name in param_distributions:
+            results[name].append(uptake_params[name])
+        for stage, strategy in [('one_stage', strategies[1]), ('two_stage', strategies[2])]:
+            results[stage + '_productivity'].append(np.nan if strategy is None else strategy.batch_productivity)
+            results[stage + '_yield'].append(np.nan if strategy is None else strategy.batch_yield)
+            results[stage + '_titer'].append(np.nan if strategy is None else strategy.batch_titer)
+            results[stage + '_objective_value'].append(np.nan if strategy is None else strategy.objective_value)
+        two_stage = strategies[2]
+        results['two_stage_switch_time'].append(np.nan if two_stage is None or not two_stage.switch_times
+                                                else two_stage.switch_times[0])
+    return pd.DataFrame(results), envelopes
+
+
+def confidence_summary(samples, confidence=0.95):
+
+    """This function returns the mean, standard deviation and the lower and upper bounds of the central confidence
+       interval of every column of a DataFrame of samples."""
+
+    lower, upper = (1 - confidence)/2, (1 + confidence)/2
+    return pd.DataFrame({'mean': samples.mean(), 'std': samples.std(), 'median': samples.median(),
+                         'lower': samples.quantile(lower), 'upper': samples.quantile(upper)})
+
+
+def envelope_confidence_band(envelopes, confidence=0.95):
+
+    """This function returns the median and the confidence band of the substrate uptake and production rates of a
+       list of envelopes calculated on the same growth rates."""
+
+    lower, upper = (1 - confidence)/2*100, (1 + confidence)/2*100
+    band = {'growth_rates': envelopes[0]['growth_rates'].values}
+    for column in ['substrate_uptake_rates', 'production_rates_lb', 'production_rates_ub']:
+        values = np.array([envelope[column].values for envelope in envelopes])
+        band[column + '_lower'] = np.percentile(values, lower, axis=0)
+        band[column + '_median'] = np.median(values, axis=0)
+        band[column + '_upper'] = np.percentile(values, upper, axis=0)
+    return pd.DataFrame(band)
@@ -0,0 +1,50 @@
+import numpy as np
+from .switch_time_curves import switch_time_curves, rank_switch_time_curves
+
+__all__ = ['extrema_initial_guesses']
+
+
+def extrema_initial_guesses(flux_list, max_growth, settings):
+
+    """This function returns the COBYLA starts of the three extrema searches, taken from a coarse global grid of
+       settings.warm_start_points envelope points: the settings.warm_start_top_k best feasible two stage pairs and
+       one stage batches, and the traditional two stage pair, with their growth rates converted to factors of
+       max_growth and the optimal switch times of the grid. The ts_best search keeps its first default start, whose
+       stage one is fixed at the maximum growth rate, so that traditional strategies are still preferred when they
+       are nearly as good. Searches without a feasible coarse batch get None, i.e. their default starts.
+
+       The coarse grid is ranked from the closed form switch time curves, so it costs far less than the searches.
+       Without constant kinetics every pair of the grid would need its own COBYLA optimization, which can cost more
+       than the searches it seeds, so all the searches get their default starts then."""
+
+    extrema_types = ['ts_best', 'ts_sub', 'os_best']
+    if settings.kinetics != 'constant':
+        return {extrema_type: None for extrema_type in extrema_types}
+    indices = np.unique(np.around(np.linspace(0, len(flux_list) - 1, settings.warm_start_points)).astype(int))
+    coarse_flux_list = [flux_list[index] for index in indices]
+    two_stage_table, one_stage_table = rank_switch_time_curves(switch_time_curves(coarse_flux_list, settings), settings)
+
+    def factor(growth_rate):
+        return 100*growth_rate/max_growth
+
+    two_stage = two_stage_table[two_stage_table['constraint flag'] &
+                                (two_stage_table['stage_one_growth_rate'] != two_stage_table['stage_two_growth_rate'])]
+    two_stage = two_stage.sort_values('objective value', ascending=False).head(settings.warm_start_top_k)
+    one_stage = one_stage_table[one_stage_table['constraint flag']]
+    one_stage = one_stage.sort_values('objective value', ascending=False).head(settings.warm_start_top_k)
+    traditional = two_stage_table[(two_stage_table['stage_one_growth_rate'] ==
+                                   two_stage_table['stage_one_growth_rate'].max()) &
+                                  (two_stage_table['stage_two_growth_rate'] ==
+                                   two_stage_table['stage_two_growth_rate'].min())]
+
+    guesses = {'ts_best': [[2, 100, 33]] + [[row['optimal switch time'], factor(row['stage_one_growth_rate']),
+                                             factor(row['stage_two_growth_rate'])] for _, row in two_stage.iterrows()],
+               'ts_sub': [[row['optimal switch time'], 100, 0] for _, row in traditional.iterrows()],
+               'os_best': [[0, factor(row['growth_rate']), factor(row['growth_rate'])]
+                           for _, row in one_stage.iterrows()]}
+    if two_stage.empty:
+        guesses['ts_best'] = None
+    for extrema_type in extrema_types[1:]:
+        if not guesses[extrema_type]:
+            guesses[extrema_type] = None
+    return guesses
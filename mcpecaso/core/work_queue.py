@@ -0,0 +1,293 @@
+import os
+import time
+import uuid
+import pickle
+import socket
+import argparse
+import warnings
+import traceback
+import threading
+import multiprocessing
+from .Fermentation import OneStageFermentation, TwoStageFermentation
+from .candidate_reduction import two_stage_candidates, expand_two_stage_grid
+
+__all__ = ['FileWorkQueue', 'run_worker', 'start_local_workers', 'run_sweep']
+
+
+class FileWorkQueue(object):
+
+    def __init__(self, path, max_retries=3, stale_timeout=None):
+        """A work queue backed by a directory. Tasks are pickled files that move between the pending, running,
+           done and failed subdirectories with atomic renames, so any number of workers on any number of hosts can
+           share the queue as long as they see the same directory (for example on a network file system).
+           Failed tasks are retried up to max_retries times. If stale_timeout (in seconds) is given, running tasks
+           that have not finished within it are assumed to belong to a dead worker and are put back in the queue."""
+        self.path = path
+        self.max_retries = max_retries
+        self.stale_timeout = stale_timeout
+        for folder in ['pending', 'running', 'done', 'failed']:
+            os.makedirs(os.path.join(self.path, folder), exist_ok=True)
+
+    def task_path(self, folder, task_id):
+        return os.path.join(self.path, folder, task_id + '.pkl')
+
+    def write(self, folder, task_id, contents):
+        """Writes a file to a queue folder atomically, so that readers never see partial files."""
+        temp_path = os.path.join(self.path, folder, '.' + task_id + '.' + uuid.uuid4().hex + '.tmp')
+        with open(temp_path, 'wb') as f:
+            pickle.dump(contents, f)
+        os.replace(temp_path, self.task_path(folder, task_id))
+
+    def submit(self, function, *args):
+        """Adds a call of function (which must be picklable, e.g. a module level function or class) with the
+           given arguments to the queue and returns its task id."""
+        task_id = '{:020d}-{}'.format(time.time_ns(), uuid.uuid4().hex[:8])
+        self.write('pending', task_id, {'task_id': task_id, 'function': function, 'args': args, 'attempts': 0})
+        return task_id
+
+    def claim(self):
+        """Moves the oldest pending task to running and returns it, or returns None if there is no pending task."""
+        for file_name in sorted(os.listdir(os.path.join(self.path, 'pending'))):
+            if not file_name.endswith('.pkl'):
+                continue
+            task_id = file_name[:-4]
+            try:
+                os.rename(self.task_path('pending', task_id), self.task_path('running', task_id))
+            except FileNotFoundError:
+                # Another worker claimed this task first
+                continue
+            os.utime(self.task_path('running', task_id))
+            with open(self.task_path('running', task_id), 'rb') as f:
+                return pickle.load(f)
+        return None
+
+    def complete(self, task, result):
+        self.write('done', task['task_id'], {'task_id': task['task_id'], 'result': result})
+        try:
+            os.remove(self.task_path('running', task['task_id']))
+        except FileNotFoundError:
+            pass
+
+    def fail(self, task, error):
+        """Puts a failed task back in the queue, or moves it to failed once it has used up its retries."""
+        task['attempts'] += 1
+        task['error'] = error
+        if task['attempts'] <= self.max_retries:
+            self.write('pending', task['task_id'], task)
+        else:
+            self.write('failed', task['task_id'], task)
+        try:
+            os.remove(self.task_path('running', task['task_id']))
+        except FileNotFoundError:
+            pass
+
+    def heartbeat(self, task):
+        """Marks a running task as alive, so that requeue_stale leaves it running."""
+        try:
+            os.utime(self.task_path('running', task['task_id']))
+        except FileNotFoundError:
+            pass
+
+    def requeue_stale(self):
+        """Treats running tasks without a heartbeat (see run_worker) for longer than stale_timeout as failed, since
+           their worker has died: they count as an attempt and are put back in the queue, or moved to failed once
+           they have used up their retries, so a task that kills its workers is not retried forever."""
+        if self.stale_timeout is None:
+            return
+        for file_name in os.listdir(os.path.join(self.path, 'running')):
+            if not file_name.endswith('.pkl'):
+                continue
+            task_id = file_name[:-4]
+            # The task is moved aside first, so that only one of several waiters requeues it
+            stale_path = os.path.join(self.path, 'running', '.' + task_id + '.' + uuid.uuid4().hex + '.tmp')
+            try:
+                if time.time() - os.path.getmtime(self.task_path('running', task_id)) <= self.stale_timeout:
+                    continue
+                os.rename(self.task_path('running', task_id), stale_path)
+            except FileNotFoundError:
+                continue
+            with open(stale_path, 'rb') as f:
+                task = pickle.load(f)
+            os.replace(stale_path, self.task_path('running', task_id))
+            self.fail(task, 'The worker did not send a heartbeat for ' + str(self.stale_timeout) + ' s')
+
+    def status(self, task_id):
+        for folder in ['done', 'failed', 'running', 'pending']:
+            if os.path.exists(self.task_path(folder, task_id)):
+                return folder
+        return None
+
+    def result(self, task_id):
+        with open(self.task_path('done', task_id), 'rb') as f:
+            return pickle.load(f)['result']
+
+    def wait(self, task_ids, timeout=None, poll_interval=0.1):
+        """Blocks until all the given tasks are done and returns their results in the same order. Raises an
+           Exception if one of the tasks failed permanently or the timeout (in seconds) is exceeded."""
+        start_time = time.time()
+        remaining = set(task_ids)
+        while remaining:
+            self.requeue_stale()
+            for task_id in list(remaining):
+                status = self.status(task_id)
+                if status == 'done':
+                    remaining.remove(task_id)
+                elif status == 'failed':
+                    with open(self.task_path('failed', task_id), 'rb') as f:
+                        error = pickle.load(f)['error']
+                    raise Exception('Task ' + task_id + ' failed after ' + str(self.max_retries + 1) +
+                                    ' attempts:\n' + error)
+            if remaining:
+                if timeout is not None and time.time() - start_time > timeout:
+                    raise Exception('Timed out waiting for ' + str(len(remaining)) + ' tasks')
+                time.sleep(poll_interval)
+        return [self.result(task_id) for task_id in task_ids]
+
+
+def run_worker(path, max_retries=3, stale_timeout=None, poll_interval=0.5, idle_timeout=None, max_tasks=None,
+               heartbeat_interval=None):
+
+    """This function runs a worker that executes tasks from the queue at path until it has been idle for
+       idle_timeout seconds (forever if None) or has executed max_tasks tasks. While a task runs, a background
+       thread sends a heartbeat every heartbeat_interval seconds (a third of stale_timeout if None, or 10 s), so
+       that tasks longer than stale_timeout are not requeued. Returns the number of tasks run."""
+
+    queue = FileWorkQueue(path, max_retries, stale_timeout)
+    if heartbeat_interval is None:
+        heartbeat_interval = 10 if stale_timeout is None else stale_timeout/3
+    num_tasks = 0
+    idle_since = time.time()
+    while max_tasks is None or num_tasks < max_tasks:
+        task = queue.claim()
+        if task is None:
+            if idle_timeout is not None and time.time() - idle_since > idle_timeout:
+                break
+            time.sleep(poll_interval)
+            continue
+        finished = threading.Event()
+
+        def send_heartbeats(task=task):
+            while not finished.wait(heartbeat_interval):
+                queue.heartbeat(task)
+
+        heartbeat_thread = threading.Thread(target=send_heartbeats, daemon=True)
+        heartbeat_thread.start()
+        try:
+            result = task['function'](*task['args'])
+        except Exception:
+            queue.fail(task, socket.gethostname() + ': ' + traceback.format_exc())
+        else:
+            queue.complete(task, result)
+        finally:
+            finished.set()
+            heartbeat_thread.join()
+        num_tasks += 1
+        idle_since = time.time()
+    return num_tasks
+
+
+def start_local_workers(path, num_workers, use_threads=False, **kwargs):
+
+    """This function starts num_workers local workers on the queue at path, as processes or threads. Keyword
+       arguments are passed on to run_worker; set idle_timeout so that the workers exit once the queue is empty.
+       Returns the started workers."""
+
+    workers = []
+    for i in range(num_workers):
+        if use_threads:
+            worker = threading.Thread(target=run_worker, args=(path,), kwargs=kwargs, daemon=True)
+        else:
+            worker = multiprocessing.Process(target=run_worker, args=(path,), kwargs=kwargs, daemon=True)
+        worker.start()
+        workers.append(worker)
+    return workers
+
+
+def envelope_task(pecaso, lp_model):
+
+    """This function calculates the production envelopes of an mcPECASO object in a worker, on the same code path
+       as calculate_production_envelope (see mcPECASO.production_envelope_data). lp_model is a cobra model or a
+       SparseLPModel."""
+
+    return pecaso.production_envelope_data(lp_model)
+
+
+def one_stage_task(flux_list, settings):
+
+    return [OneStageFermentation(fluxes, settings) for fluxes in flux_list]
+
+
+def two_stage_task(flux_pairs, settings):
+
+    return [TwoStageFermentation(stage_one_fluxes, stage_two_fluxes, settings)
+            for stage_one_fluxes, stage_two_fluxes in flux_pairs]
+
+
+def chunks(items, chunk_size):
+    return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+
+def run_sweep(pecaso_list, queue, chunk_size=25, timeout=None):
+
+    """This function runs the envelope and global grid of every mcPECASO object in pecaso_list on the workers of
+       the given FileWorkQueue. Envelopes that are stale (not calculated yet, see calculate_envelope=False, or
+       calculated with settings or inputs that have changed since) are computed first, then the one stage batches
+       and the two stage pairs are split into tasks of chunk_size fermentations. The results are added to the
+       mcPECASO objects as calculate_fermentation_characteristics would. Workers have to be started separately
+       (see run_worker and start_local_workers)."""
+
+    envelope_tasks = {}
+    for index, pecaso in enumerate(pecaso_list):
+        if pecaso.settings.scope != 'global':
+            raise Exception('Only the global scope can be run on a work queue')
+        if pecaso.is_stale('production_envelope'):
+            if pecaso.is_stale('model_check'):
+                pecaso.check_model_complete()
+                pecaso.mark_computed('model_check')
+            if pecaso.model_complete_flag:
+                envelope_tasks[index] = queue.submit(envelope_task, pecaso, pecaso.get_lp_model())
+            else:
+                warnings.warn("The production envelope could not be generated.")
+    start_time = time.time()
+    envelopes = queue.wait(list(envelope_tasks.values()), timeout)
+    for index, envelope_data in zip(envelope_tasks.keys(), envelopes):
+        pecaso_list[index].set_production_envelopes(envelope_data)
+
+    grid_tasks = {}
+    for index, pecaso in enumerate(pecaso_list):
+        if pecaso.is_stale('production_envelope'):
+            continue
+        pecaso.update_objective_name()
+        flux_list = pecaso.get_flux_list()
+        flux_pairs, grid = two_stage_candidates(flux_list, pecaso.settings)
+        grid_tasks[index] = ([queue.submit(one_stage_task, chunk, pecaso.settings)
+                              for chunk in chunks(flux_list, chunk_size)],
+                             [queue.submit(two_stage_task, chunk, pecaso.settings)
+                              for chunk in chunks(flux_pairs, chunk_size)], flux_list, grid)
+
+    for index, (os_task_ids, ts_task_ids, flux_list, grid) in grid_tasks.items():
+        remaining_time = None if timeout is None else timeout - (time.time() - start_time)
+        os_ferm_list = [ferm for result in queue.wait(os_task_ids, remaining_time) for ferm in result]
+        ts_ferm_list = expand_two_stage_grid(flux_list, grid, [ferm for result in queue.wait(ts_task_ids,
+                                                                                              remaining_time)
+                                                               for ferm in result], pecaso_list[index].settings)
+        pecaso_list[index].computed_fermentations['one_stage'] = os_ferm_list
+        pecaso_list[index].computed_fermentations['two_stage'] = ts_ferm_list
+        pecaso_list[index].mark_computed('one_stage')
+        pecaso_list[index].mark_computed('two_stage')
+        pecaso_list[index].set_fermentation_results(os_ferm_list, ts_ferm_list)
+    print("Completed analysis in ", str(time.time() - start_time), "s")
+    return pecaso_list
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs an mcPECASO worker on a file work queue.')
+    parser.add_argument('path', help='queue directory shared with the submitting host')
+    parser.add_argument('--max-retries', type=int, default=3)
+    parser.add_argument('--stale-timeout', type=float, default=None)
+    parser.add_argument('--idle-timeout', type=float, default=None)
+    parser.add_argument('--max-tasks', type=int, default=None)
+    parser.add_argument('--heartbeat-interval', type=float, default=None)
+    arguments = parser.parse_args()
+    run_worker(arguments.path, arguments.max_retries, arguments.stale_timeout, idle_timeout=arguments.idle_timeout,
+               max_tasks=arguments.max_tasks, heartbeat_interval=arguments.heartbeat_interval)
@@ -421,9 +421,9 @@ def multi_two_stage_char_contours(pecaso_list):
 
             for row, characteristic in enumerate(characteristics):
                 max_characteristic = max(
-                    [max(pecaso.two_stage_characteristics[characteristic]) for pecaso in pecaso_list])
+                    [np.nanmax(pecaso.two_stage_characteristics[characteristic]) for pecaso in pecaso_list])
                 min_characteristic = min(
-                    [min(pecaso.two_stage_characteristics[characteristic]) for pecaso in pecaso_list])
+                    [np.nanmin(pecaso.two_stage_characteristics[characteristic]) for pecaso in pecaso_list])
                 fig = make_subplots(rows=1, cols=len(pecaso_list),
                                     subplot_titles=[pecaso.condition for pecaso in pecaso_list],
                                     horizontal_spacing=0.05, print_grid=False)
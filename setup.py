@@ -13,4 +13,6 @@ setuptools.setup(
     author_email='kraj593@gmail.com',
     description='Two stage fermentation simulator to predict optimal operating points.',
     install_requires=requirements,
+    extras_require={'yaml': ['pyyaml'], 'numba': ['numba']},
+    entry_points={'console_scripts': ['mcpecaso-run=mcpecaso.core.batch_runner:main']},
 )
@@ -0,0 +1,25 @@
+import pytest
+from mcpecaso.core import mcPECASO
+
+cobra_io = pytest.importorskip('cobra.io')
+
+
+def textbook_pecaso():
+    model = cobra_io.load_model('textbook')
+    pecaso = mcPECASO(model=model, biomass_rxn=model.reactions.Biomass_Ecoli_core,
+                      substrate_rxn=model.reactions.EX_glc__D_e, target_rxn=model.reactions.EX_ac_e,
+                      calculate_envelope=False)
+    pecaso.settings.num_points = 6
+    return pecaso
+
+
+def test_uptake_uncertainty():
+    pecaso = textbook_pecaso()
+    summary = pecaso.calculate_uptake_uncertainty({'B': (5, 0.5)}, num_samples=3, seed=0)
+    cache = pecaso.envelope_lp_cache
+    assert summary is not None and 'two_stage_objective_value' in summary.index
+    pecaso.calculate_uptake_uncertainty({'B': (5, 0.5)}, num_samples=3, seed=0)
+    assert pecaso.envelope_lp_cache is cache
+    pecaso.settings.num_points = 5
+    pecaso.calculate_uptake_uncertainty({'B': (5, 0.5)}, num_samples=3, seed=0)
+    assert pecaso.envelope_lp_cache is not cache